@@ -0,0 +1,83 @@
+"""
+The benchmark of adding a list of entries: one "UPSERT" statement for each entry, as Database.add_entries did
+before, against the multi-row "UPSERT" of Database.add_entries. It needs a PostgreSQL database, the entries are
+added into a temporary chat which is removed at the end.
+
+    python -m benchmarks.add_entries config/config.json
+"""
+import datetime as dt
+import json
+import sys
+import time
+import psycopg2.extensions
+from psycopg2 import sql
+from birthdaybot.db.database import Database
+
+SIZES = (10, 100, 500, 2000)
+CHAT_ID = -1000000001
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """The cursor counting the statements sent to the server"""
+    statements = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.statements += 1
+        return super().execute(query, vars)
+
+
+class CountingDatabase(Database):
+    def _connect(self):
+        connection = super()._connect()
+        connection.cursor_factory = CountingCursor
+        return connection
+
+
+def add_entries_by_rows(database: Database, chat_id: int, entries: list):
+    """Adds the entries like Database.add_entries did before the multi-row statement"""
+    with database.cursor() as cur:
+        cur.execute(sql.SQL("SELECT time_recall FROM chats WHERE chat_id = {}").format(sql.Literal(chat_id)))
+        time_recall = cur.fetchone()[0]
+
+    for name, entry_date, entry_time in entries:
+        with database.cursor() as cur:
+            moment = dt.datetime.combine(entry_date, entry_time or time_recall)
+            cur.execute(sql.SQL("INSERT INTO notes(chat_id, name, datetime) VALUES ({0}, {1}, {2})"
+                                "ON CONFLICT (chat_id, name) DO UPDATE SET datetime = excluded.datetime").format(
+                sql.Literal(chat_id), sql.Literal(name), sql.Literal(moment)))
+
+
+def measure(function, database: Database, entries: list) -> tuple:
+    with database.cursor() as cur:
+        cur.execute(sql.SQL("DELETE FROM notes WHERE chat_id = {};").format(sql.Literal(CHAT_ID)))
+    CountingCursor.statements = 0
+    start = time.perf_counter()
+    function(database, CHAT_ID, entries)
+    return CountingCursor.statements, (time.perf_counter() - start) * 1000
+
+
+def main(config_path: str):
+    with open(config_path) as file:
+        database = CountingDatabase(json.load(file))
+
+    with database.cursor() as cur:
+        cur.execute(sql.SQL("INSERT INTO conversations(chat_id) VALUES ({0}) ON CONFLICT DO NOTHING;"
+                            "INSERT INTO chats(chat_id) VALUES ({0}) ON CONFLICT DO NOTHING;").format(
+            sql.Literal(CHAT_ID)))
+    try:
+        print("{:>6}{:>16}{:>14}{:>16}{:>14}".format("size", "rows: queries", "rows: ms", "batch: queries",
+                                                      "batch: ms"))
+        for size in SIZES:
+            entries = [("benchmark {}".format(number), dt.date(2000, 1 + number % 12, 1 + number % 28), None)
+                       for number in range(size)]
+            rows = measure(add_entries_by_rows, database, entries)
+            batch = measure(lambda db, chat_id, items: db.add_entries(chat_id, set(items)), database, entries)
+            print("{:>6}{:>16}{:>14.1f}{:>16}{:>14.1f}".format(size, rows[0], rows[1], batch[0], batch[1]))
+    finally:
+        with database.cursor() as cur:
+            cur.execute(sql.SQL("DELETE FROM conversations WHERE chat_id = {};").format(sql.Literal(CHAT_ID)))
+        database.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else "config/config.json")
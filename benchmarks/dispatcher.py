@@ -0,0 +1,110 @@
+"""
+The benchmark of the dispatching of the updates to a handler blocking for HANDLER_TIME (as a request to
+the database or to Telegram does): the usual sequential Dispatcher against the ChatDispatcher with different
+numbers of the workers. The order of the updates within each chat is checked.
+
+The second part runs a handler changing the chat_data, which is saved through BotPersistence into a fake
+database answering in HANDLER_TIME, so the writes of the persistence are measured too.
+
+    python -m benchmarks.dispatcher
+"""
+import threading
+import time
+import telegram
+from queue import Queue
+from telegram.ext import Dispatcher, TypeHandler
+from birthdaybot.dispatcher import ChatDispatcher
+from birthdaybot.persistence import BotPersistence
+
+UPDATES = 1000
+CHATS = 50
+HANDLER_TIME = 0.005
+WORKERS = [1, 4, 16]
+
+
+class LatencyDatabase:
+    """The database answering each write in HANDLER_TIME"""
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_conversations(self):
+        return {}
+
+    def update_conversations(self, conversations: dict):
+        time.sleep(HANDLER_TIME)
+
+    def update_chat_data(self, chat_data: dict):
+        time.sleep(HANDLER_TIME)
+
+    def update_user_data(self, user_data: dict):
+        time.sleep(HANDLER_TIME)
+
+
+def create_bot() -> telegram.Bot:
+    bot = telegram.Bot("123456:TOKEN")
+    # The bot doesn't request its user from Telegram
+    bot._bot = telegram.User(123456, "bot", True, username="bot")
+    return bot
+
+
+def create_updates(bot: telegram.Bot) -> list:
+    return [telegram.Update.de_json({"update_id": update_id,
+                                     "message": {"message_id": update_id, "date": 0, "text": "text",
+                                                 "chat": {"id": update_id % CHATS, "type": "private"}}}, bot)
+            for update_id in range(UPDATES)]
+
+
+def run(dispatcher: Dispatcher, updates: list) -> (float, bool):
+    processed = {}
+    lock = threading.Lock()
+
+    def handler(update, context):
+        if dispatcher.persistence:
+            context.chat_data['updates'] = context.chat_data.get('updates', 0) + 1
+        else:
+            time.sleep(HANDLER_TIME)
+        with lock:
+            processed.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    dispatcher.add_handler(TypeHandler(telegram.Update, handler))
+    started = time.monotonic()
+    for update in updates:
+        dispatcher.process_update(update)
+    if isinstance(dispatcher, ChatDispatcher):
+        dispatcher.join()
+    duration = time.monotonic() - started
+    if isinstance(dispatcher, ChatDispatcher):
+        dispatcher.stop()
+
+    in_order = sum(map(len, processed.values())) == len(updates) and \
+        all(chat_updates == sorted(chat_updates) for chat_updates in processed.values())
+    return duration, in_order
+
+
+def main():
+    bot = create_bot()
+    updates = create_updates(bot)
+    print("{} updates in {} chats, {:.0f} ms per update".format(UPDATES, CHATS, HANDLER_TIME * 1e3))
+    print("{:<22}{:>8}{:>12}{:>10}".format("dispatcher", "time, s", "updates/s", "in order"))
+
+    for persistence in (None, lambda: BotPersistence(LatencyDatabase(), store_bot_data=False)):
+        if persistence:
+            print("through BotPersistence")
+        cases = [("Dispatcher", lambda: Dispatcher(bot, Queue(), workers=1, use_context=True,
+                                                   persistence=persistence and persistence()))]
+        cases += [("ChatDispatcher({})".format(workers),
+                   lambda workers=workers: ChatDispatcher(bot, Queue(), workers=1, use_context=True,
+                                                          persistence=persistence and persistence(),
+                                                          chat_workers=workers))
+                  for workers in WORKERS]
+        for name, create in cases:
+            duration, in_order = run(create(), updates)
+            print("{:<22}{:>8.2f}{:>12.0f}{:>10}".format(name, duration, UPDATES / duration, str(in_order)))
+
+
+if __name__ == '__main__':
+    main()
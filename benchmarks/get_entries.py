@@ -0,0 +1,135 @@
+"""
+The benchmark of loading the schedule: the range scan of notes_fire_at_idx done by Database.get_entries
+on a table of NOTES notes, for the windows crossing the end of the year and the end of February.
+It needs a PostgreSQL database and a superuser: the notes are added into a temporary chat with the triggers
+disabled (session_replication_role), so the seeding isn't slowed down by the notifies, and they're removed
+at the end.
+
+    python -m benchmarks.get_entries config/config.json
+"""
+import datetime as dt
+import json
+import sys
+import time
+from psycopg2 import sql
+from birthdaybot.db.database import Database, DEFAULT_TIMEZONE, _get_period_condition
+
+NOTES = 10000000
+CHAT_ID = -1000000002
+USER_ID = -1000000002
+
+
+def seed(database: Database):
+    with database.cursor() as cur:
+        cur.execute(sql.SQL("INSERT INTO conversations(chat_id) VALUES ({0}) ON CONFLICT DO NOTHING;"
+                            "INSERT INTO chats(chat_id) VALUES ({0}) ON CONFLICT DO NOTHING;"
+                            "INSERT INTO users(user_id, chat_id) VALUES ({1}, {0}) ON CONFLICT DO NOTHING;").format(
+            sql.Literal(CHAT_ID), sql.Literal(USER_ID)))
+
+    # The notes are spread over all the days of a leap year (including the 29th of February) and the minutes
+    # of a day, fire_at is computed here because the trigger computing it is disabled
+    with database.pool.connection() as connection:
+        connection.autocommit = False
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SET LOCAL session_replication_role = replica;")
+                cur.execute(sql.SQL("INSERT INTO notes(chat_id, name, datetime, fire_at) "
+                                    "SELECT {0}, 'get_entries benchmark ' || n, moment, "
+                                    "next_fire_at(moment, {1}, now()) "
+                                    "FROM generate_series(0, {2} - 1) AS n, "
+                                    "LATERAL (SELECT '2000-01-01 00:00'::timestamp AT TIME ZONE {1} + "
+                                    "(n % 366) * interval '1 day' + (n % 1440) * interval '1 minute' AS moment) m;"
+                                    ).format(sql.Literal(CHAT_ID), sql.Literal(DEFAULT_TIMEZONE),
+                                             sql.Literal(NOTES)))
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            if not connection.closed:
+                connection.autocommit = True
+
+    with database.cursor() as cur:
+        cur.execute("ANALYZE notes;")
+
+
+def clean(database: Database):
+    with database.pool.connection() as connection:
+        connection.autocommit = False
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SET LOCAL session_replication_role = replica;")
+                cur.execute(sql.SQL("DELETE FROM notes WHERE chat_id = {};").format(sql.Literal(CHAT_ID)))
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            if not connection.closed:
+                connection.autocommit = True
+
+    with database.cursor() as cur:
+        cur.execute(sql.SQL("DELETE FROM users WHERE user_id = {0};"
+                            "DELETE FROM conversations WHERE chat_id = {1};").format(sql.Literal(USER_ID),
+                                                                                     sql.Literal(CHAT_ID)))
+
+
+def get_windows(now: dt.datetime) -> list:
+    """Returns the next windows crossing the end of the year and the end of February"""
+    year_end = dt.datetime(now.year, 12, 31, tzinfo=dt.timezone.utc)
+    february_end = dt.datetime(now.year, 2, 28, tzinfo=dt.timezone.utc)
+    if february_end < now:
+        february_end = february_end.replace(year=now.year + 1)
+    return [("Dec 31 - Jan 1", year_end, year_end + dt.timedelta(days=2)),
+            ("Feb 28 - Mar 1", february_end, february_end + dt.timedelta(days=2)),
+            ("next 24 hours", now, now + dt.timedelta(days=1))]
+
+
+def explain(database: Database, start_time: dt.datetime, finish_time: dt.datetime):
+    query = sql.SQL("EXPLAIN (ANALYZE, BUFFERS) "
+                    "SELECT notes.note_id, notes.chat_id, notes.name, notes.fire_at, users.language_code "
+                    "FROM notes INNER JOIN users ON notes.chat_id = users.chat_id "
+                    "WHERE {};").format(_get_period_condition(start_time, finish_time))
+    with database.cursor() as cur:
+        cur.execute(query)
+        for row in cur.fetchall():
+            print(row[0])
+
+
+def main(config_path: str):
+    with open(config_path) as file:
+        database = Database(json.load(file))
+
+    try:
+        started = time.perf_counter()
+        seed(database)
+        print("{} notes were added in {:.1f} s".format(NOTES, time.perf_counter() - started))
+
+        windows = get_windows(dt.datetime.now(dt.timezone.utc))
+        print()
+        explain(database, windows[0][1], windows[0][2])
+        print()
+
+        print("{:<16}{:>26}{:>10}{:>10}".format("window", "start", "entries", "ms"))
+        for name, start_time, finish_time in windows:
+            started = time.perf_counter()
+            entries = database.get_entries(start_time, finish_time)
+            duration = (time.perf_counter() - started) * 1000
+            print("{:<16}{:>26}{:>10}{:>10.1f}".format(name, start_time.isoformat(timespec='minutes'),
+                                                       len(entries), duration))
+
+        # The notes of the 29th of February are recalled on the 1st of March in non-leap years
+        february = windows[1]
+        leap_day = sum(1 for entry in database.get_entries(february[1], february[2])
+                       if entry.name.startswith('get_entries benchmark ') and
+                       int(entry.name.rsplit(' ', 1)[1]) % 366 == 59)
+        print("notes of the 29th of February in the Feb 28 - Mar 1 window: {}".format(leap_day))
+    finally:
+        clean(database)
+        database.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else "config/config.json")
@@ -0,0 +1,42 @@
+"""
+The benchmark of the localization: reading the files on each call, as the localization did before the catalog,
+against the in-memory catalog.
+
+    python -m benchmarks.localization
+"""
+import codecs
+import json
+import os
+import timeit
+from birthdaybot.localization import localization
+
+DIRECTORY = os.path.join(os.path.dirname(localization.__file__))
+CALLS = 20000
+
+
+def read_info(language_code: str, name: str) -> str:
+    with codecs.open(os.path.join(DIRECTORY, language_code, "info", name + ".html"), 'r', 'utf-8') as file:
+        return file.read()
+
+
+def read_menu(language_code: str, name: str) -> dict:
+    with open(os.path.join(DIRECTORY, language_code, "menu", name + ".json")) as file:
+        return json.load(file)
+
+
+def main():
+    cases = [
+        ("recall_message + format", lambda: read_info("en", "recall_message").format("Name"),
+         lambda: localization.recall_message("en").format("Name")),
+        ("start_info", lambda: read_info("ru", "start_info"), lambda: localization.start_info("ru")),
+        ("main_menu", lambda: read_menu("en", "main"), lambda: localization.main_menu("en")),
+    ]
+    print("{:<26}{:>14}{:>14}{:>10}".format("call", "files, us", "catalog, us", "speedup"))
+    for name, files, catalog in cases:
+        before = min(timeit.repeat(files, number=CALLS, repeat=3)) / CALLS * 1e6
+        after = min(timeit.repeat(catalog, number=CALLS, repeat=3)) / CALLS * 1e6
+        print("{:<26}{:>14.2f}{:>14.2f}{:>9.0f}x".format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+The benchmark of the parsing of a list of entries: the regular expressions applied to each line, as
+the lists were parsed before the parser, against the precompiled single-pass parser.
+
+The corpus of CORPUS_LINES lines mixes the correct lines, the hyphenated names, the localized names
+of the months and the incorrect lines.
+
+    python -m benchmarks.parser
+"""
+import datetime as dt
+import random
+import re
+import time
+from birthdaybot import parser
+from birthdaybot.localization import date
+
+CORPUS_LINES = 100000
+
+
+def old_parse(text: str, language_code: str = 'en'):
+    """
+    The parsing of the list as process_entries did it before the parser (without sending the errors).
+    """
+    incorrect_lines = set()
+    entries = set()
+    for line in text.splitlines():
+        line.strip()
+        if not re.match(
+                r"^[\w ]+ *- *((0?[1-9])|([1-2][0-9])|(3[0-1]))(( +[а-яА-Яa-zA-Z]{3,9})|([./]((0?[1-9])|(1[0-2]))))"
+                r"( +((0?[0-9])|(1[0-9])|(2[0-3])):([0-5][0-9])(:[0-5][0-9])?)?$",
+                line, re.IGNORECASE):
+            incorrect_lines.add(line)
+        else:
+            name, date_entry = [x.strip() for x in line.split('-')]
+
+            time_entry = None
+            _splits = re.split(r'[ ./]+', date_entry, maxsplit=2)
+            if len(_splits) == 2:
+                day, month = _splits
+            else:
+                day, month, time_entry = _splits
+                time_entry = time_entry.split(':')
+                if len(time_entry) == 2:
+                    time_entry = dt.time(hour=int(time_entry[0]), minute=int(time_entry[1]))
+                else:
+                    time_entry = dt.time(hour=int(time_entry[0]), minute=int(time_entry[1]),
+                                         second=int(time_entry[2]))
+
+            if re.match(r'^[a-zA-Zа-яА-Я]+$', month):
+                month = date.MONTHS[language_code].get(month, 0)
+
+            year = dt.datetime.now().year
+            try:
+                date_entry = dt.date(year=year, month=int(month), day=int(day))
+                entries.add((name, date_entry, time_entry))
+            except ValueError:
+                incorrect_lines.add(line)
+    return entries, incorrect_lines
+
+
+def make_corpus(size: int) -> str:
+    generator = random.Random(0)
+    months = [name for names in date.MONTHS.values() for name in names]
+    lines = []
+    for number in range(size):
+        day = generator.randint(1, 28)
+        kind = number % 8
+        if kind == 0:
+            line = "Name {} - {}.{:02}".format(number, day, generator.randint(1, 12))
+        elif kind == 1:
+            line = "Name {} - {} {}".format(number, day, generator.choice(months))
+        elif kind == 2:
+            line = "Name {} - {}/{} 10:30".format(number, day, generator.randint(1, 12))
+        elif kind == 3:
+            line = "Mary-Jane {} - {} march 09:15:30".format(number, day)
+        elif kind == 4:
+            line = "Анна {} - {} {}".format(number, day, generator.choice(months))
+        elif kind == 5:
+            line = "Name {} - 31.02".format(number)
+        elif kind == 6:
+            line = "Name {} - {} smarch".format(number, day)
+        else:
+            line = "not an entry {}".format(number)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def measure(function, text: str) -> float:
+    started = time.perf_counter()
+    function(text)
+    return time.perf_counter() - started
+
+
+def main():
+    text = make_corpus(CORPUS_LINES)
+    today = dt.date.today()
+    result = parser.parse(text, today)
+    old_entries, old_errors = old_parse(text)
+    print("{} lines".format(CORPUS_LINES))
+    print("{:<12}{:>10}{:>12}{:>10}{:>10}".format("", "time, s", "lines/s", "entries", "errors"))
+    for name, function, entries, errors in (
+            ("regex", old_parse, len(old_entries), len(old_errors)),
+            ("parser", lambda corpus: parser.parse(corpus, today), len(result.entries), len(result.errors))):
+        duration = min(measure(function, text) for _ in range(3))
+        print("{:<12}{:>10.3f}{:>12.0f}{:>10}{:>10}".format(name, duration, CORPUS_LINES / duration,
+                                                          entries, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+The benchmark of the reconciliation of the scheduled recalls after an update of the notes: the nested scan
+of the jobs and the entries, as the callback did before the registry, against the RecallScheduler.
+
+The JobQueue is replaced with a fake one, so only the bookkeeping is measured.
+
+    python -m benchmarks.scheduler
+"""
+import datetime as dt
+import time
+from birthdaybot.db.database import Entry
+from birthdaybot.scheduler import RecallScheduler
+
+SIZES = [1000, 10000, 100000, 1000000]
+NESTED_LIMIT = 10000
+CHANGED = 100
+
+
+class FakeJob:
+    def __init__(self, context):
+        self.context = context
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.queue = []
+
+    def run_once(self, callback, when, context=None):
+        job = FakeJob(context)
+        self.queue.append(job)
+        return job
+
+    def jobs(self):
+        return [job for job in self.queue if not job.removed]
+
+
+def make_entries(size: int, start: dt.datetime) -> list:
+    return [Entry(note_id, note_id % 5000, "name{}".format(note_id), start + dt.timedelta(seconds=note_id * 7), "en")
+            for note_id in range(size)]
+
+
+def change(entries: list) -> list:
+    step = max(len(entries) // CHANGED, 1)
+    changed = list(entries)
+    for index in range(0, len(entries), step)[:CHANGED]:
+        entry = entries[index]
+        changed[index] = Entry(entry.note_id, entry.chat_id, entry.name, entry.entry_date + dt.timedelta(hours=1),
+                               entry.language_code)
+    return changed
+
+
+def nested_scan(job_queue: FakeJobQueue, entries: list):
+    for job in job_queue.jobs():
+        exist = False
+        for entry in entries:
+            if job.context.note_id == entry.note_id:
+                if job.context.chat_id == entry.chat_id and job.context.name == entry.name and \
+                        job.context.entry_date == entry.entry_date:
+                    exist = True
+                    break
+                job.schedule_removal()
+                job_queue.run_once(callback=None, when=entry.entry_date, context=entry)
+                break
+        if not exist:
+            job.schedule_removal()
+
+
+def measure_nested(entries: list, changed: list) -> float:
+    job_queue = FakeJobQueue()
+    for entry in entries:
+        job_queue.run_once(callback=None, when=entry.entry_date, context=entry)
+    started = time.perf_counter()
+    nested_scan(job_queue, changed)
+    return time.perf_counter() - started
+
+
+def measure_registry(entries: list, changed: list) -> (float, int):
+    scheduler = RecallScheduler(FakeJobQueue(), callback=None)
+    for entry in entries:
+        scheduler.schedule(entry)
+    step = max(len(entries) // CHANGED, 1)
+    started = time.perf_counter()
+    for index in range(0, len(changed), step)[:CHANGED]:
+        scheduler.schedule(changed[index])
+    return time.perf_counter() - started, scheduler.buckets
+
+
+def main():
+    start = dt.datetime(2030, 1, 1, tzinfo=dt.timezone.utc)
+    print("{:>9}{:>16}{:>16}{:>10}".format("entries", "nested, ms", "registry, ms", "jobs"))
+    for size in SIZES:
+        entries = make_entries(size, start)
+        changed = change(entries)
+        nested = "{:.1f}".format(measure_nested(entries, changed) * 1e3) if size <= NESTED_LIMIT else "-"
+        registry, buckets = measure_registry(entries, changed)
+        print("{:>9}{:>16}{:>16.2f}{:>10}".format(size, nested, registry * 1e3, buckets))
+
+
+if __name__ == '__main__':
+    main()
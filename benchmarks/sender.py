@@ -0,0 +1,110 @@
+"""
+The benchmark of the delivery of a burst of recalls to a fake Bot which imitates the limits of Telegram:
+sending from the pool of the JobQueue, as the recalls were sent before the sender, against the RecallSender.
+
+The fake Bot answers after LATENCY seconds and raises RetryAfter when more than GLOBAL_LIMIT messages
+were sent during the last second or more than one message was sent to a chat during the last second.
+
+    python -m benchmarks.sender
+"""
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import RetryAfter
+from birthdaybot.sender import RecallSender
+
+MESSAGES = 300
+CHATS = 200
+LATENCY = 0.05
+GLOBAL_LIMIT = 30
+# The APScheduler used by the JobQueue runs the jobs by 10 threads
+JOB_QUEUE_WORKERS = 10
+
+
+class FakeBot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sent = collections.deque()
+        self._chats = {}
+        self.delivered = 0
+        self.rejected = 0
+
+    def sendMessage(self, chat_id: int, text: str, **kwargs):
+        time.sleep(LATENCY)
+        with self._lock:
+            now = time.monotonic()
+            while self._sent and self._sent[0] < now - 1:
+                self._sent.popleft()
+            if len(self._sent) >= GLOBAL_LIMIT or self._chats.get(chat_id, -1.0) > now - 1:
+                self.rejected += 1
+                raise RetryAfter(1)
+            self._sent.append(now)
+            self._chats[chat_id] = now
+            self.delivered += 1
+
+
+def chat_of(number: int) -> int:
+    return number % CHATS
+
+
+def run_job_queue() -> dict:
+    bot = FakeBot()
+    latencies = []
+    lost = [0]
+    due = time.time()
+
+    def send(number: int):
+        try:
+            bot.sendMessage(chat_id=chat_of(number), text="recall")
+            latencies.append(time.time() - due)
+        except RetryAfter:
+            lost[0] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(JOB_QUEUE_WORKERS) as executor:
+        list(executor.map(send, range(MESSAGES)))
+    return {"duration": time.monotonic() - started, "delivered": bot.delivered, "lost": lost[0],
+            "rejected": bot.rejected, "max_queue": MESSAGES, "latencies": latencies}
+
+
+def run_sender() -> dict:
+    bot = FakeBot()
+    sender = RecallSender(bot)
+    due = time.time()
+    started = time.monotonic()
+    for number in range(MESSAGES):
+        sender.submit(chat_of(number), "recall", due=due)
+    sender.start()
+
+    max_queue = 0
+    while sender.sent + sender.failed < MESSAGES:
+        max_queue = max(max_queue, sender.stats["queue"])
+        time.sleep(0.01)
+    duration = time.monotonic() - started
+    sender.stop()
+
+    latency = sender.latency.to_dict()
+    return {"duration": duration, "delivered": bot.delivered, "lost": sender.failed, "rejected": bot.rejected,
+            "max_queue": max_queue, "average": latency["average"], "max": latency["max"]}
+
+
+def main():
+    print("{} recalls to {} chats, {:.0f} ms per request, {} messages/s allowed".format(
+        MESSAGES, CHATS, LATENCY * 1e3, GLOBAL_LIMIT))
+    print("{:<12}{:>8}{:>11}{:>6}{:>10}{:>11}{:>13}{:>13}".format(
+        "", "time, s", "delivered", "lost", "rejected", "msg/s", "avg lat, s", "max lat, s"))
+    for name, run in (("job queue", run_job_queue), ("sender", run_sender)):
+        result = run()
+        if "latencies" in result:
+            latencies = result["latencies"]
+            result["average"] = sum(latencies) / len(latencies) if latencies else 0.0
+            result["max"] = max(latencies, default=0.0)
+        print("{:<12}{:>8.2f}{:>11}{:>6}{:>10}{:>11.1f}{:>13.2f}{:>13.2f}".format(
+            name, result["duration"], result["delivered"], result["lost"], result["rejected"],
+            result["delivered"] / result["duration"], result["average"], result["max"]))
+        print("{:<12}max queue depth: {}".format("", result["max_queue"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+The load test of the webhook: the keep-alive clients post the synthetic updates to the local WebhookServer.
+The updates are taken from the queue by a thread that imitates the dispatcher.
+
+    python -m benchmarks.webhook
+"""
+import http.client
+import json
+import queue
+import threading
+import time
+import telegram
+from birthdaybot.webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+UPDATES = 4000
+CLIENTS = 8
+PORT = 18443
+
+
+def make_update(update_id: int) -> bytes:
+    return json.dumps({"update_id": update_id,
+                       "message": {"message_id": update_id, "date": int(time.time()),
+                                   "chat": {"id": update_id % 500, "type": "private"},
+                                   "from": {"id": update_id % 500, "is_bot": False, "first_name": "User"},
+                                   "text": "/start"}}).encode()
+
+
+def post_updates(server: WebhookServer, numbers: range, statuses: dict, lock: threading.Lock):
+    connection = http.client.HTTPConnection(*server.address)
+    headers = {SECRET_TOKEN_HEADER: server.secret_token, 'Content-Type': 'application/json'}
+    for number in numbers:
+        connection.request('POST', server.url_path, body=make_update(number), headers=headers)
+        response = connection.getresponse()
+        response.read()
+        with lock:
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+    connection.close()
+
+
+def run(name: str, max_pending: int, process_time: float):
+    bot = telegram.Bot("123456:" + "A" * 35)
+    update_queue = queue.Queue()
+    server = WebhookServer(bot, update_queue, "https://example.com/hook", port=PORT, max_pending=max_pending)
+    server.start(set_webhook=False)
+
+    stopping = threading.Event()
+
+    def dispatch():
+        while not stopping.is_set():
+            try:
+                update_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if process_time:
+                time.sleep(process_time)
+
+    dispatcher = threading.Thread(target=dispatch, daemon=True)
+    dispatcher.start()
+
+    statuses = {}
+    lock = threading.Lock()
+    clients = [threading.Thread(target=post_updates,
+                                args=(server, range(number, UPDATES, CLIENTS), statuses, lock))
+               for number in range(CLIENTS)]
+    started = time.monotonic()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.monotonic() - started
+
+    stopping.set()
+    dispatcher.join()
+    server.stop()
+    print("{:<22}{:>8.2f}{:>12.0f}{:>10}{:>10}".format(name, duration, UPDATES / duration,
+                                                      statuses.get(200, 0), statuses.get(429, 0)))
+
+
+def main():
+    print("{} updates, {} keep-alive clients".format(UPDATES, CLIENTS))
+    print("{:<22}{:>8}{:>12}{:>10}{:>10}".format("dispatcher", "time, s", "requests/s", "200", "429"))
+    run("fast", max_pending=1000, process_time=0.0)
+    run("slow (1 ms/update)", max_pending=100, process_time=0.001)
+
+
+if __name__ == '__main__':
+    main()
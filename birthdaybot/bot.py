@@ -2,42 +2,123 @@
 Module for all the actions with the Bot
 """
 import birthdaybot.db.database as db
+import birthdaybot.importer as importer
+import csv
 import telegram
 import birthdaybot.handlers as handlers
 import birthdaybot.jobs as jobs
 import logging
+import signal
+import tempfile
+import threading
 import birthdaybot.menus as menus
 from datetime import timedelta, datetime
+from functools import partial
 from birthdaybot.localization import localization
+from birthdaybot.ledger import RecallLedger
 from birthdaybot.persistence import BotPersistence
+from birthdaybot.scheduler import RecallScheduler
+from birthdaybot.sender import RecallSender
+from birthdaybot.sharding import ShardCoordinator
+from birthdaybot.webhook import WebhookServer
 from birthdaybot.db.database import Database
 from birthdaybot.db.notify import DatabaseNotify
-from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, PicklePersistence
+from birthdaybot.dispatcher import ChatDispatcher
+from queue import Queue
+from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, PicklePersistence, \
+    JobQueue
+from telegram.utils.request import Request
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
+# The minimum interval between the updates of the progress of an import (in seconds)
+IMPORT_PROGRESS_INTERVAL = 2.0
+# The number of the threads of the dispatcher running the asynchronous handlers
+DISPATCHER_WORKERS = 4
+# The maximum number of the entries of a chat waiting for the "Accept" or the "Cancel" button
+MAX_PENDING_ENTRIES = 10000
+
 
 class BirthdayBot:
-    def __init__(self, token: str, database: Database):
-        persistence = BotPersistence(database, store_bot_data=False)
+    def __init__(self, token: str, database: Database, write_interval: float = None,
+                 notify_debounce: float = 0.0, coordinator: ShardCoordinator = None, polling: bool = True,
+                 catch_up_period: timedelta = timedelta(days=1), webhook_url: str = None,
+                 webhook_address: tuple = ('127.0.0.1', 8443), webhook_queue_size: int = 1000,
+                 dispatch_workers: int = None, state_cache_size: int = None):
+        """
+        :param token: the token of the bot
+        :param database: the Database instance
+        :param write_interval: the interval of saving the changed data of the persistence
+        :param notify_debounce: the time during which the changes of the database are collected into one batch
+        :param coordinator: the ShardCoordinator instance if the scheduler is sharded between several workers
+        :param polling: if False, the bot doesn't receive updates and works just as a worker of the scheduler
+        :param catch_up_period: the period before the start which is checked for the recalls that weren't sent
+        :param webhook_url: the public URL of the webhook, if it's specified, the updates are received by
+                            the webhook instead of polling
+        :param webhook_address: the tuple (address, port) of the local server of the webhook
+        :param webhook_queue_size: the maximum number of the updates received by the webhook and waiting for
+                                   the dispatcher
+        :param dispatch_workers: the number of the workers processing the updates of different chats
+                                 concurrently, if it isn't specified, the updates are processed one by one
+        :param state_cache_size: the maximum number of the chats and the users whose states are kept in memory,
+                                 if it's specified, the states are loaded on the first access instead of the start
+        """
+        # The workers would wait for each other in the pool of connections, if it were smaller
+        if dispatch_workers and database.pool.size < dispatch_workers:
+            raise ValueError("The pool of connections to the database ({}) is smaller than the number of "
+                             "the workers of the dispatcher ({})".format(database.pool.size, dispatch_workers))
+
+        persistence = BotPersistence(database, store_bot_data=False, write_interval=write_interval,
+                                     cache_size=state_cache_size)
 
         self.database = database
-        self.database_notify = DatabaseNotify(self.database.credentials)
+        self.database_notify = DatabaseNotify(self.database.credentials, debounce=notify_debounce,
+                                              sent_time=lambda notify: db.get_notify_time(notify.payload))
 
-        self.updater = Updater(token=token, use_context=True, persistence=persistence)
+        if dispatch_workers:
+            self.updater = Updater(dispatcher=self._create_dispatcher(token, persistence, dispatch_workers))
+        else:
+            self.updater = Updater(token=token, use_context=True, persistence=persistence)
         self.dispatcher = self.updater.dispatcher
         self.job_queue = self.updater.job_queue
+        self.coordinator = coordinator
+        self.polling = polling
+        self.catch_up_period = catch_up_period
+        self.ledger = RecallLedger(database)
+        self.sender = RecallSender(self.updater.bot, on_sent=self.ledger.record)
+        self.send_recalls = partial(jobs.recall_send_callback, sender=self.sender, coordinator=coordinator)
+        self.scheduler = RecallScheduler(self.job_queue, self.send_recalls)
 
-        # Dictionary with the chat_id and entries of this chat that a user want to add.
-        # This dict will be cleared when the user will press the "accept" or the "cancel" button
-        self.entries = {}
+        self.webhook = None
+        if webhook_url is not None:
+            self.webhook = WebhookServer(self.updater.bot, self.updater.update_queue, webhook_url,
+                                         listen=webhook_address[0], port=webhook_address[1],
+                                         max_pending=webhook_queue_size)
 
         # Time limits to update the jobs every day and
         # also check adding new entries into the database in this period
         self.start_time = None
         self.finish_time = None
 
+    @staticmethod
+    def _create_dispatcher(token: str, persistence: BotPersistence, workers: int) -> ChatDispatcher:
+        """
+        Creates the dispatcher processing the updates of different chats concurrently.
+
+        :param token: the token of the bot
+        :param persistence: the persistence of the bot
+        :param workers: the number of the workers
+        :return: ChatDispatcher
+        """
+        # Each worker may send a request to Telegram at the same time
+        bot = telegram.Bot(token, request=Request(con_pool_size=workers + DISPATCHER_WORKERS + 4))
+        job_queue = JobQueue()
+        dispatcher = ChatDispatcher(bot, Queue(), workers=DISPATCHER_WORKERS, job_queue=job_queue,
+                                    persistence=persistence, use_context=True, chat_workers=workers)
+        job_queue.set_dispatcher(dispatcher)
+        return dispatcher
+
     def run(self):
         """
         The entrypoint of the bot. Define the ConversationHandler and specify all the handlers.
@@ -46,7 +127,8 @@ class BirthdayBot:
             entry_points=[CommandHandler('start', handlers.start_handler)],
             states={
                 handlers.MAIN_MENU: [MessageHandler(Filters.text & ~Filters.command, handlers.main_menu_handler)],
-                handlers.ADD_LISTS: [MessageHandler(Filters.text & ~Filters.command, self.add_lists_handler)]
+                handlers.ADD_LISTS: [MessageHandler(Filters.text & ~Filters.command, self.add_lists_handler),
+                                     MessageHandler(Filters.document, self.import_document_handler, run_async=True)]
             },
             fallbacks=[CommandHandler('stop', handlers.stop_bot_handler)],
 
@@ -59,7 +141,16 @@ class BirthdayBot:
         self.database_notify.listen(db.NOTIFY_UPDATE_NOTES)
         self.database_notify.listen(db.NOTIFY_DELETE_NOTES)
         # Run the listener and pass to it the callback function with the arguments
-        self.database_notify.run(self.process_notify)
+        self.database_notify.run(self.process_notify, self.resync)
+
+        # Claim the partitions of this worker before the entries are loaded
+        if self.coordinator is not None:
+            self.coordinator.rebalance()
+            self.job_queue.run_repeating(jobs.rebalance_callback, interval=self.coordinator.heartbeat,
+                                         first=self.coordinator.heartbeat, context=self)
+
+        # Send the recalls missed while the bot was stopped
+        self.job_queue.run_once(jobs.catch_up_callback, when=0, context=self)
 
         # Every day run the check of entries function to add new jobs
         self.job_queue.run_repeating(jobs.process_entries_callback, interval=86400, first=0,
@@ -67,8 +158,55 @@ class BirthdayBot:
 
         self.dispatcher.add_handler(conversation_handler)
 
-        self.updater.start_polling()
-        self.updater.idle()
+        self.ledger.start()
+        self.sender.start()
+        if not self.polling:
+            # Just the jobs are run, the updates are received by another process
+            self.job_queue.start()
+            self._wait_for_signal()
+            self.job_queue.stop()
+        elif self.webhook is not None:
+            self._run_webhook()
+        else:
+            self.updater.start_polling()
+            self.updater.idle()
+
+        self.sender.stop()
+        self.ledger.stop()
+        self.database_notify.stop()
+        if self.coordinator is not None:
+            self.coordinator.leave()
+        self.database.close()
+
+    def _run_webhook(self):
+        """
+        Receives the updates by the webhook until the process receives a signal.
+        """
+        dispatcher = threading.Thread(target=self.dispatcher.start, name="dispatcher")
+        dispatcher.start()
+        self.job_queue.start()
+        self.webhook.start()
+
+        self._wait_for_signal()
+
+        self.webhook.stop()
+        self.job_queue.stop()
+        self.dispatcher.stop()
+        dispatcher.join()
+        if self.dispatcher.persistence:
+            self.dispatcher.update_persistence()
+            self.dispatcher.persistence.flush()
+
+    @staticmethod
+    def _wait_for_signal():
+        """
+        Blocks until the process receives SIGINT, SIGTERM or SIGABRT.
+        """
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(sig, lambda signum, frame: stop.set())
+        while not stop.wait(1):
+            pass
 
     def add_lists_handler(self, update: telegram.Update, context: telegram.ext.CallbackContext):
         # Get language code and get the dictionary of the main menu
@@ -81,9 +219,8 @@ class BirthdayBot:
 
         # If the user pressed the 'Cancel' button
         if text == accept_cancel_menu[menus.CANCEL_BUTTON]:
-            # Remove the list of entries
-            if chat_id in self.entries:
-                self.entries.pop(chat_id)
+            # Remove the pending entries
+            self.database.discard_entries(chat_id)
             context.bot.sendMessage(chat_id=chat_id,
                                     text=localization.cancel(code),
                                     reply_markup=menus.get_main_menu(code))
@@ -91,10 +228,10 @@ class BirthdayBot:
 
         # If the user pressed the 'Accept' button
         elif text == accept_cancel_menu[menus.ACCEPT_BUTTON]:
-            # Add new entries into the database and clear the list
-            if chat_id in self.entries:
-                self.database.add_entries(chat_id, self.entries[chat_id])
-                self.entries.pop(chat_id)
+            # Move the pending entries into the notes. They may have been purged, if the list waited too long
+            if not self.database.accept_entries(chat_id):
+                context.bot.sendMessage(chat_id=chat_id, text=localization.accept_empty(code))
+                return None
 
             context.bot.sendMessage(chat_id=chat_id,
                                     text=localization.accept(code),
@@ -103,21 +240,109 @@ class BirthdayBot:
 
         # If the user sends a message
         else:
+            # The entries wait in the database until the user presses a button
             entries = handlers.process_entries(text, update, context)
-            self.entries.setdefault(chat_id, set())
-            self.entries[chat_id] |= entries
+            rejected = self.database.stage_entries(chat_id, entries, MAX_PENDING_ENTRIES)
+            if rejected:
+                context.bot.sendMessage(chat_id=chat_id,
+                                        text=localization.pending_limit(code).format(rejected, MAX_PENDING_ENTRIES))
 
-    def process_notify(self, pid: int, notify: str):
+    def import_document_handler(self, update: telegram.Update, context: telegram.ext.CallbackContext):
+        """
+        The handler of the documents sent in the ADD_LISTS state. The entries of a document are imported into
+        the database at once, the user sees the progress and then the summary of the rejected records.
+        """
+        code = update.effective_user.language_code
+        chat_id = update.effective_chat.id
+        document = update.message.document
+
+        document_format = importer.detect_format(document.file_name, document.mime_type)
+        if document_format is None:
+            context.bot.sendMessage(chat_id=chat_id, text=localization.import_unsupported(code))
+            return
+
+        message = context.bot.sendMessage(chat_id=chat_id, text=localization.import_progress(code).format(0))
+        # The import just counts the processed records, since it holds a transaction. The progress is sent
+        # by another thread, so a slow or failed request to Telegram doesn't delay or abort the import
+        processed = [0]
+        finished = threading.Event()
+
+        def report_progress():
+            shown = 0
+            # The message is edited rarely not to exceed the limits of Telegram
+            while not finished.wait(IMPORT_PROGRESS_INTERVAL):
+                if processed[0] == shown:
+                    continue
+                shown = processed[0]
+                try:
+                    context.bot.editMessageText(chat_id=chat_id, message_id=message.message_id,
+                                                text=localization.import_progress(code).format(shown))
+                except telegram.error.TelegramError as e:
+                    logging.warning("The progress of the import of the chat {} wasn't sent: {}".format(chat_id, e))
+
+        reporter = threading.Thread(target=report_progress, name="import_progress", daemon=True)
+        reporter.start()
+        try:
+            with tempfile.TemporaryFile() as file:
+                context.bot.get_file(document.file_id).download(out=file)
+                file.seek(0)
+                result = importer.import_document(self.database, chat_id, file, document_format,
+                                                  lambda count: processed.__setitem__(0, count))
+        except (UnicodeDecodeError, csv.Error) as e:
+            logging.info("The document of the chat {} wasn't imported: {}".format(chat_id, e))
+            context.bot.editMessageText(chat_id=chat_id, message_id=message.message_id,
+                                        text=localization.import_unsupported(code))
+            return
+        finally:
+            finished.set()
+            reporter.join()
+
+        template = localization.import_summary(code)
+        limit = jobs.MESSAGE_LIMIT - len(template.format(result.added, len(result.errors), ""))
+        context.bot.editMessageText(chat_id=chat_id, message_id=message.message_id,
+                                    text=template.format(result.added, len(result.errors),
+                                                         handlers.format_errors(result.errors, limit)),
+                                    parse_mode=telegram.ParseMode.HTML)
+
+    def resync(self):
+        """
+        This function will be called when the listener of the database was reconnected. The notifies sent
+        while the connection was lost are missed, so all the scheduled entries are reloaded.
+        """
+        if self.finish_time is None:
+            return
+
+        logging.info("The scheduled entries are reloaded after the gap of the notifies")
+        partitions = None
+        if self.coordinator is not None:
+            partitions = (self.coordinator.partitions, self.coordinator.owned)
+        jobs.resync_entries_jobs(self.scheduler, self.database, self.finish_time, partitions)
+
+    def process_notify(self, notifies: list):
         """
         This function will be called when the trigger function will run.
-        This method processes the notify and passes the notify into a specific function.
+        This method merges the changed rows of the batch of notifies and passes them into a specific function.
 
-        :param pid: the pid of process that raise the notify
-        :param notify: the text of the notify
+        :param notifies: the list of the received notifies
         """
-        if notify == db.NOTIFY_UPDATE_NOTES:
-            jobs.process_updating_entry_callback(self.job_queue, self.database, self.finish_time)
-        elif notify == db.NOTIFY_INSERT_NOTES:
-            jobs.process_inserting_entry_callback(self.job_queue, self.database, self.finish_time)
-        elif notify == db.NOTIFY_DELETE_NOTES:
-            jobs.process_deleting_entry_callback(self.job_queue, self.database, self.finish_time)
+        changes = []
+        for notify in notifies:
+            changes.extend(db.parse_notify_payload(notify.channel, notify.payload))
+
+        # The changes of the chats of other workers are processed by them
+        if self.coordinator is not None:
+            changes = [change for change in changes if self.coordinator.owns(change.chat_id)]
+
+        operations = {db.NOTIFY_INSERT_NOTES: [], db.NOTIFY_UPDATE_NOTES: [], db.NOTIFY_DELETE_NOTES: []}
+        for change in db.merge_changes(changes):
+            operations[change.operation].append(change)
+
+        if operations[db.NOTIFY_DELETE_NOTES]:
+            jobs.process_deleting_entry_callback(self.scheduler, self.database, self.finish_time,
+                                                 operations[db.NOTIFY_DELETE_NOTES])
+        if operations[db.NOTIFY_UPDATE_NOTES]:
+            jobs.process_updating_entry_callback(self.scheduler, self.database, self.finish_time,
+                                                 operations[db.NOTIFY_UPDATE_NOTES])
+        if operations[db.NOTIFY_INSERT_NOTES]:
+            jobs.process_inserting_entry_callback(self.scheduler, self.database, self.finish_time,
+                                                  operations[db.NOTIFY_INSERT_NOTES])
@@ -4,6 +4,7 @@ get and process the parameters received from the command line
 """
 import os
 import json
+from datetime import timedelta
 from argparse import ArgumentParser
 
 
@@ -37,6 +38,71 @@ class Configurator:
                             help='The token to work with the bot.',
                             type=str)
 
+        parser.add_argument('--write-interval',
+                            help='Save the changed data of users and chats into the database in batches '
+                                 'every WRITE_INTERVAL seconds instead of saving it immediately.',
+                            type=float,
+                            default=None)
+
+        parser.add_argument('--notify-debounce',
+                            help='Collect the changes of the database during NOTIFY_DEBOUNCE seconds '
+                                 'and process them at once.',
+                            type=float,
+                            default=0.5)
+
+        parser.add_argument('--partitions',
+                            help='Share the scheduler between several processes of the bot, the chats are divided '
+                                 'into PARTITIONS partitions. It must be the same for all processes.',
+                            type=int,
+                            default=None)
+
+        parser.add_argument('--worker-id',
+                            help='The unique id of this process among the processes sharing the scheduler.',
+                            type=str,
+                            default=None)
+
+        parser.add_argument('--no-polling',
+                            help="Don't receive updates, the process works just as a worker of the scheduler.",
+                            action='store_true')
+
+        parser.add_argument('--webhook-url',
+                            help='Receive updates by the webhook with this public URL instead of polling.',
+                            type=str,
+                            default=None)
+
+        parser.add_argument('--webhook-listen',
+                            help='The address of the local server of the webhook.',
+                            type=str,
+                            default='127.0.0.1')
+
+        parser.add_argument('--webhook-port',
+                            help='The port of the local server of the webhook.',
+                            type=int,
+                            default=8443)
+
+        parser.add_argument('--webhook-queue',
+                            help='The maximum number of updates waiting for processing, Telegram is asked to '
+                                 'retry the updates received above this limit.',
+                            type=int,
+                            default=1000)
+
+        parser.add_argument('--dispatch-workers',
+                            help='Process the updates of different chats concurrently by DISPATCH_WORKERS workers, '
+                                 'the updates of one chat are processed in order.',
+                            type=int,
+                            default=None)
+
+        parser.add_argument('--state-cache',
+                            help='Load the states of the chats and the users on the first access and keep '
+                                 'STATE_CACHE recently used ones in memory instead of loading all of them at start.',
+                            type=int,
+                            default=None)
+
+        parser.add_argument('--catch-up',
+                            help='At startup send the recalls missed during CATCH_UP hours before the start.',
+                            type=float,
+                            default=24)
+
         return parser
 
     def _get_parameters(self, args):
@@ -59,6 +125,106 @@ class Configurator:
 
         return self._parameters.token
 
+    def get_write_interval(self):
+        """
+        Returns the interval (in seconds) of saving the changed data into the database or None
+        if the data must be saved immediately.
+
+        :return: interval
+        """
+
+        return self._parameters.write_interval
+
+    def get_notify_debounce(self) -> float:
+        """
+        Returns the time (in seconds) during which the changes of the database are collected into one batch.
+
+        :return: debounce time
+        """
+
+        return self._parameters.notify_debounce
+
+    def get_partitions(self):
+        """
+        Returns the number of partitions of the sharded scheduler or None if the scheduler isn't sharded.
+
+        :return: number of partitions
+        """
+
+        return self._parameters.partitions
+
+    def get_worker_id(self):
+        """
+        Returns the id of the worker of the sharded scheduler or None to generate it.
+
+        :return: worker id
+        """
+
+        return self._parameters.worker_id
+
+    def is_polling(self) -> bool:
+        """
+        Returns True if the bot must receive updates.
+
+        :return: bool
+        """
+
+        return not self._parameters.no_polling
+
+    def get_webhook_url(self):
+        """
+        Returns the public URL of the webhook or None if the updates are received by polling.
+
+        :return: URL
+        """
+
+        return self._parameters.webhook_url
+
+    def get_webhook_address(self) -> tuple:
+        """
+        Returns the address and the port of the local server of the webhook.
+
+        :return: tuple
+        """
+
+        return self._parameters.webhook_listen, self._parameters.webhook_port
+
+    def get_webhook_queue_size(self) -> int:
+        """
+        Returns the maximum number of the updates received by the webhook and waiting for processing.
+
+        :return: size of the queue
+        """
+
+        return self._parameters.webhook_queue
+
+    def get_dispatch_workers(self):
+        """
+        Returns the number of the workers processing the updates concurrently or None to process them one by one.
+
+        :return: number of workers
+        """
+
+        return self._parameters.dispatch_workers
+
+    def get_state_cache_size(self):
+        """
+        Returns the number of the states of the chats and the users kept in memory or None to load all of them.
+
+        :return: size of the cache
+        """
+
+        return self._parameters.state_cache
+
+    def get_catch_up_period(self) -> timedelta:
+        """
+        Returns the period before the start which is checked for the missed recalls.
+
+        :return: timedelta
+        """
+
+        return timedelta(hours=self._parameters.catch_up)
+
     def get_dbconfig(self) -> dict:
         """
         Returns a json object from a file containing configurations
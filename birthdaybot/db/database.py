@@ -2,87 +2,107 @@
 This module implements the database interaction and other methods to provide getting data easier.
 """
 import datetime as dt
+import io
 import logging
-from birthdaybot.db.db_connection import DatabaseConnection
+import uuid
+import psycopg2
+import psycopg2.errors
+from birthdaybot.db.db_connection import PooledDatabaseConnection
 from collections import defaultdict
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 
 NOTIFY_INSERT_NOTES = 'insert_notes'
 NOTIFY_UPDATE_NOTES = 'update_notes'
 NOTIFY_DELETE_NOTES = 'delete_notes'
 
+# The maximum length of the payload of a notify (PostgreSQL limits it with 8000 bytes)
+NOTIFY_PAYLOAD_LIMIT = 7900
+# The setting of a transaction whose updates of notes aren't notified
+SKIP_NOTIFY_SETTING = 'birthdaybot.skip_notify'
+
+# The time zone of the chats which haven't chosen another one
+DEFAULT_TIMEZONE = 'Europe/Moscow'
+# The local time of recalling of the entries added without a time into a chat without time_recall
+DEFAULT_RECALL_TIME = dt.time(12, 0)
+
+# The key of the advisory lock taken while the schema is migrated
+SCHEMA_LOCK = 7431001
+
+
+class Database(PooledDatabaseConnection):
+    FETCH_SIZE = 2000
 
-class Database(DatabaseConnection):
     def __init__(self, json_obj):
         super().__init__(json_obj)
-        self.connection.autocommit = True
-        self._create_tables()
 
-    def _create_tables(self):
+        # The number of rows received at once by a server-side cursor
+        self.fetch_size = int(json_obj.get("PG_FETCH_SIZE", self.FETCH_SIZE))
+
+        # The names of the columns of each table and the built "UPSERT" queries for each set of columns
+        self._columns = {}
+        self._upsert_queries = {}
+
+        self._migrate()
+        self.invalidate_schema_cache()
+
+    def get_schema_version(self) -> int:
         """
-        Creates tables if they don't exist.
+        Method gets the version of the schema of the database.
+
+        :return: the number of the last applied migration or 0 if no migration was applied
         """
-        with self.connection.cursor() as cur:
-            # Create the enum for the type of a chat
-            cur.execute("DO $$ "
-                        "BEGIN "
-                        "IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'chat_type') THEN "
-                        "CREATE TYPE chat_type AS ENUM ('private', 'group', 'channel', 'supergroup'); "
-                        "END IF; "
-                        "END $$;")
-
-            cur.execute("CREATE TABLE IF NOT EXISTS Conversations ("
-                        "chat_id integer CONSTRAINT conversations_pkey PRIMARY KEY,"
-                        "main_menu_state integer NULL);")
-
-            cur.execute("CREATE TABLE IF NOT EXISTS Chats ("
-                        "chat_id integer CONSTRAINT chats_pkey PRIMARY KEY REFERENCES conversations "
-                        "ON DELETE CASCADE ON UPDATE CASCADE,"
-                        "title varchar(256),"
-                        "description varchar(256),"
-                        "photo varchar(1000),"
-                        "type chat_type,"
-                        "time_recall timetz NOT NULL DEFAULT '12:00 MSK');")
-
-            cur.execute("CREATE TABLE IF NOT EXISTS Users ("
-                        "user_id integer CONSTRAINT users_pkey PRIMARY KEY,"
-                        "chat_id integer REFERENCES conversations ON DELETE SET NULL ON UPDATE CASCADE,"
-                        "username varchar(32),"
-                        "first_name varchar(256),"
-                        "last_name varchar(256),"
-                        "is_bot boolean,"
-                        "language_code varchar(10) DEFAULT 'en');")
-
-            cur.execute("CREATE TABLE IF NOT EXISTS Notes ("
-                        "note_id serial UNIQUE,"
-                        "chat_id integer REFERENCES conversations ON DELETE CASCADE ON UPDATE CASCADE,"
-                        "name varchar(4096) NOT NULL UNIQUE,"
-                        "datetime timestamptz(0) NOT NULL,"
-                        "CONSTRAINT notes_pkey PRIMARY KEY(chat_id, name));")
-
-            cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION notify_notes() RETURNS trigger AS $$ "
-                                "BEGIN "
-                                "IF (TG_OP = 'DELETE') THEN "
-                                "PERFORM pg_notify(CAST({} AS text), tg_name);"
-                                "ELSIF (TG_OP = 'UPDATE') THEN "
-                                "PERFORM pg_notify(CAST({} AS text), tg_name);"
-                                "ELSIF (TG_OP = 'INSERT') THEN "
-                                "PERFORM pg_notify(CAST({} AS text), tg_name);"
-                                "END IF;"
-                                "RETURN NULL; "
-                                "END; "
-                                "$$ LANGUAGE plpgsql;").format(sql.Literal(NOTIFY_DELETE_NOTES),
-                                                               sql.Literal(NOTIFY_UPDATE_NOTES),
-                                                               sql.Literal(NOTIFY_INSERT_NOTES)))
-
-            cur.execute(sql.SQL("DO $$"
-                                "BEGIN IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notify_notes') THEN "
-                                "CREATE TRIGGER notify_notes "
-                                "AFTER INSERT OR UPDATE OR DELETE ON notes "
-                                "FOR EACH STATEMENT "
-                                "EXECUTE PROCEDURE notify_notes();"
-                                "END IF;"
-                                "END; $$;"))
+        with self.cursor() as cur:
+            try:
+                cur.execute("SELECT max(version) FROM schema_version;")
+            except psycopg2.errors.UndefinedTable:
+                return 0
+            return cur.fetchone()[0] or 0
+
+    def _migrate(self):
+        """
+        Applies the migrations which weren't applied yet. A usual start just reads the version of the schema,
+        so no DDL is run and no locks of the catalog are taken.
+
+        Each migration is applied in its own transaction with the record of its version. The workers started
+        at the same time are serialized by an advisory lock, so a migration is applied once.
+        """
+        if self.get_schema_version() >= SCHEMA_VERSION:
+            return
+
+        with self.pool.connection() as connection:
+            with connection.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s);", (SCHEMA_LOCK,))
+            try:
+                connection.autocommit = False
+                with connection.cursor() as cur:
+                    cur.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                                "version integer CONSTRAINT schema_version_pkey PRIMARY KEY,"
+                                "description text NOT NULL,"
+                                "applied_at timestamptz NOT NULL DEFAULT now());")
+                    cur.execute("SELECT coalesce(max(version), 0) FROM schema_version;")
+                    version = cur.fetchone()[0]
+                connection.commit()
+
+                for number, migration in MIGRATIONS:
+                    if number <= version:
+                        continue
+                    description = migration.__doc__.strip()
+                    logging.info("Migrating the schema to the version {}: {}".format(number, description))
+                    with connection.cursor() as cur:
+                        migration(cur)
+                        cur.execute("INSERT INTO schema_version(version, description) VALUES (%s, %s);",
+                                    (number, description))
+                    connection.commit()
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                if not connection.closed:
+                    connection.autocommit = True
+                    with connection.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(%s);", (SCHEMA_LOCK,))
 
     def update_conversations(self, conversations: dict):
         """
@@ -136,6 +156,70 @@ class Database(DatabaseConnection):
         """
         return self.get_data("users")
 
+    def invalidate_schema_cache(self, table_name: str = None):
+        """
+        Method drops the cached names of the columns and the built queries of the table (or all tables),
+        it must be called after the schema of the table was changed.
+
+        :param table_name: the name of a table or None to drop the cache of all tables
+        """
+        if table_name is None:
+            self._columns = {}
+            self._upsert_queries = {}
+        else:
+            self._columns.pop(table_name, None)
+            self._upsert_queries = {key: query for key, query in self._upsert_queries.items()
+                                    if key[0] != table_name}
+
+    def get_columns(self, table_name: str) -> tuple:
+        """
+        Method returns the names of the columns of the table in the order they're defined. The names are
+        received from the database once and then taken from the cache.
+
+        :param table_name: the name of a table
+        :return: tuple containing the names of the columns
+        """
+        columns = self._columns.get(table_name)
+        if columns is None:
+            with self.cursor() as cur:
+                query = sql.SQL("SELECT column_name FROM information_schema.columns WHERE table_name = {} "
+                                "ORDER BY ordinal_position;").format(sql.Literal(table_name))
+                cur.execute(query)
+                columns = tuple(column[0] for column in cur.fetchall())
+
+            # Don't cache the result if the table doesn't exist
+            if columns:
+                self._columns[table_name] = columns
+        return columns
+
+    def _get_upsert_query(self, table_name: str, columns: tuple) -> sql.Composed:
+        """
+        Method returns the "UPSERT" query for the set of columns of the table. The first column is the key.
+        The query is built once for each set of columns and contains placeholders instead of values.
+
+        :param table_name: the name of a table
+        :param columns: the names of the columns
+        :return: the query
+        """
+        query = self._upsert_queries.get((table_name, columns))
+        if query is None:
+            # Build the SQL-string to use "UPSERT" function
+            setting_columns = list(
+                map(lambda x: sql.SQL("{0} = excluded.{0}").format(sql.Identifier(x)), columns[1:]))
+
+            # Build a query
+            query = sql.SQL("INSERT INTO {0}({1}) "
+                            "VALUES ({2}) "
+                            "ON CONFLICT ({3}) DO UPDATE SET "
+                            "{4}").format(
+                sql.Identifier(table_name),
+                sql.SQL(',').join(map(sql.Identifier, columns)),
+                sql.SQL(',').join(sql.Placeholder() * len(columns)),
+                sql.Identifier(columns[0]),
+                sql.SQL(',').join(setting_columns))
+            self._upsert_queries[(table_name, columns)] = query
+        return query
+
     def get_data(self, table_name: str) -> dict:
         """
         Method builds a query to get all data from the table of the database.
@@ -143,19 +227,16 @@ class Database(DatabaseConnection):
         :param table_name: the name of a table
         :return: dictionary containing id and a list of arguments
         """
-        with self.connection.cursor() as cur:
-            query = sql.SQL("SELECT column_name FROM information_schema.columns WHERE table_name = {};").format(
-                sql.Literal(table_name))
-            cur.execute(query)
-
-            columns = [column[0] for column in cur.fetchall()]
+        columns = self.get_columns(table_name)
 
-            if not columns:
-                logging.warning("The names of columns from the Chats table weren't received")
-                return {}
+        if not columns:
+            logging.warning("The names of columns from the {} table weren't received".format(table_name))
+            return {}
 
+        with self.cursor() as cur:
             # Get all data and create a dictionary
-            query = sql.SQL("SELECT * FROM {}").format(sql.Identifier(table_name))
+            query = sql.SQL("SELECT {} FROM {}").format(sql.SQL(',').join(map(sql.Identifier, columns)),
+                                                        sql.Identifier(table_name))
             cur.execute(query)
             data = cur.fetchall()
 
@@ -164,6 +245,29 @@ class Database(DatabaseConnection):
             else:
                 return {}
 
+    def get_row(self, table_name: str, key) -> dict:
+        """
+        Method gets one row of the table by the value of its first column.
+
+        :param table_name: the name of a table
+        :param key: the value of the first column
+        :return: dictionary containing the other columns and their values or None if there is no such row
+        """
+        columns = self.get_columns(table_name)
+
+        if not columns:
+            logging.warning("The names of columns from the {} table weren't received".format(table_name))
+            return None
+
+        with self.cursor() as cur:
+            query = sql.SQL("SELECT {} FROM {} WHERE {} = %s").format(
+                sql.SQL(',').join(map(sql.Identifier, columns)), sql.Identifier(table_name),
+                sql.Identifier(columns[0]))
+            cur.execute(query, (key,))
+            row = cur.fetchone()
+
+        return {columns[i]: row[i] for i in range(1, len(columns))} if row else None
+
     def update_data(self, table_name: str, data: dict):
         """
         Method builds a query to update all data of the table of the database.
@@ -172,38 +276,23 @@ class Database(DatabaseConnection):
         :param data: dictionary containing ids and a list of arguments with it
         """
         if data:
-            # Iterate through all ids
-            for id, data_dict in data.items():
-                with self.connection.cursor() as cur:
-                    # Get all the names of the columns of the table
-                    query = sql.SQL("SELECT column_name FROM information_schema.columns WHERE table_name = {};").format(
-                        sql.Literal(table_name))
-                    cur.execute(query)
-                    columns = [column[0] for column in cur.fetchall() if column[0] in data[id] or 'id' in column[0]]
+            # Get all the names of the columns of the table
+            table_columns = self.get_columns(table_name)
+
+            if not table_columns:
+                logging.warning("The names of columns from the {} table weren't received".format(table_name))
+                return
+
+            with self.cursor() as cur:
+                # Iterate through all ids
+                for id, data_dict in data.items():
+                    columns = tuple(column for column in table_columns if column in data_dict or 'id' in column)
 
                     # Build a list containing all values of this id
                     values = [id]
-                    values.extend(data[id].get(column) for column in columns[1:])
-
-                    if not columns:
-                        logging.warning("The names of columns from the {} table weren't received".format(table_name))
-                        return {}
-
-                    # Build the SQL-string to use "UPSERT" function
-                    setting_columns = list(
-                        map(lambda x: sql.SQL("{0} = excluded.{0}").format(sql.Identifier(x)), columns[1:]))
-
-                    # Build a query
-                    query = sql.SQL("INSERT INTO {0}({1}) "
-                                    "VALUES ({2}) "
-                                    "ON CONFLICT ({3}) DO UPDATE SET "
-                                    "{4}").format(
-                        sql.Identifier(table_name),
-                        sql.SQL(',').join(map(sql.Identifier, columns)),
-                        sql.SQL(',').join(map(sql.Literal, values)),
-                        sql.Identifier(columns[0]),
-                        sql.SQL(',').join(setting_columns))
-                    cur.execute(query)
+                    values.extend(data_dict.get(column) for column in columns[1:])
+
+                    cur.execute(self._get_upsert_query(table_name, columns), values)
 
     def update_chat_data(self, chat_data: dict):
         """
@@ -224,59 +313,353 @@ class Database(DatabaseConnection):
 
     def add_entries(self, chat_id: int, entries: set):
         """
-        Method adds new entries into the database. The method gets recall time from the other table and set this time
-        into the notes table. This datetime will be compared with the date and the time at the moment.
+        Method adds new entries into the database. The recall time is taken from the chats table for the entries
+        which have no time, the date and the time are the local ones of the time zone of the chat.
+        All entries are inserted by one multi-row "UPSERT" statement, so the whole list is sent in one round trip,
+        in one transaction and the notify_notes trigger fires once.
 
         :param chat_id: the id of the chat
-        :param entries: the set that contains tuples containing the name and the date of an entry
+        :param entries: the set that contains tuples containing the name, the date and the time of an entry
         """
+        if not entries:
+            return
 
-        # Get recall time from the chats table for this chat_id
-        with self.connection.cursor() as cur:
-            query = sql.SQL("SELECT time_recall FROM chats WHERE chat_id = {}").format(sql.Literal(chat_id))
-            cur.execute(query)
-            time_recall = cur.fetchone()[0]
+        # The same name may be passed several times with different dates, but a row can't be affected
+        # twice by one "UPSERT" statement
+        values = list({name: (name, entry_date, time) for name, entry_date, time in entries}.values())
 
-        for name, entry_date, time in entries:
-            with self.connection.cursor() as cur:
-                if not time:
-                    time = time_recall
-                entry_date = dt.datetime.combine(entry_date, time)
+        with self.cursor() as cur:
+            query = _get_insert_notes_query(chat_id, sql.SQL("(VALUES %s) AS v(name, date, time)"))
+            execute_values(cur, query.as_string(cur), values,
+                           template="(%s, %s::date, %s::time)", page_size=len(values))
 
-                query = sql.SQL("INSERT INTO notes(chat_id, name, datetime) VALUES ({0}, {1}, {2})"
-                                "ON CONFLICT (chat_id, name) DO UPDATE SET datetime = excluded.datetime").format(
-                    sql.Literal(chat_id), sql.Literal(name), sql.Literal(entry_date))
-                cur.execute(query)
+    def import_entries(self, chat_id: int, chunks) -> int:
+        """
+        Method imports a large number of entries into the chat. The chunks of entries are copied into
+        a temporary table by COPY and then merged into the notes table by one statement, everything is done
+        in one transaction. If a name is repeated, the last entry is taken.
+
+        :param chat_id: the id of the chat
+        :param chunks: the iterable of lists of tuples (the number of the line, the name, the date, the time)
+        :return: the number of the added or updated entries
+        """
+        with self.pool.connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection.cursor() as cur:
+                    # The state of the conversation may still wait for the persistence to be written
+                    cur.execute(_get_insert_conversation_query(chat_id))
+                    cur.execute("CREATE TEMPORARY TABLE import_notes ("
+                                "line integer, name varchar(4096), date date, time time) ON COMMIT DROP;")
+                    for chunk in chunks:
+                        data = io.StringIO()
+                        for entry in chunk:
+                            data.write('\t'.join(_get_copy_value(value) for value in entry))
+                            data.write('\n')
+                        data.seek(0)
+                        cur.copy_expert("COPY import_notes(line, name, date, time) FROM STDIN", data)
+
+                    cur.execute(_get_insert_notes_query(chat_id, sql.SQL(
+                        "(SELECT DISTINCT ON (name) name, date, time FROM import_notes "
+                        "ORDER BY name, line DESC) AS v")))
+                    count = cur.rowcount
+                connection.commit()
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                if not connection.closed:
+                    connection.autocommit = True
+        return count
+
+    def stage_entries(self, chat_id: int, entries: set, limit: int) -> int:
+        """
+        Method puts the entries typed by a user into the pending_notes table, where they wait until they're
+        accepted or discarded. The entry staged with the same name is replaced. The chat can't have more than
+        limit pending entries, the rest of the new names are rejected.
+
+        :param chat_id: the id of the chat
+        :param entries: the set that contains tuples containing the name, the date and the time of an entry
+        :param limit: the maximum number of the pending entries of the chat
+        :return: the number of the rejected entries
+        """
+        if not entries:
+            return 0
+
+        values = list({name: (name, entry_date, time) for name, entry_date, time in entries}.values())
+
+        with self.cursor() as cur:
+            # The state of the conversation may still wait for the persistence to be written
+            cur.execute(_get_insert_conversation_query(chat_id))
+            # Just the names which aren't pending yet are limited, the staged ones are replaced anyway
+            query = sql.SQL("WITH v AS (SELECT e.name, e.date, e.time, EXISTS (SELECT 1 FROM pending_notes "
+                            "WHERE chat_id = {0} AND name = e.name) AS staged "
+                            "FROM (VALUES %s) AS e(name, date, time)), "
+                            "new AS (SELECT name, date, time FROM v WHERE NOT staged "
+                            "LIMIT greatest({1} - (SELECT count(*) FROM pending_notes WHERE chat_id = {0}), 0)) "
+                            "INSERT INTO pending_notes(chat_id, name, date, time) "
+                            "SELECT {0}, name, date, time FROM v WHERE staged "
+                            "UNION ALL SELECT {0}, name, date, time FROM new "
+                            "ON CONFLICT (chat_id, name) DO UPDATE "
+                            "SET date = excluded.date, time = excluded.time, staged_at = now()").format(
+                sql.Literal(chat_id), sql.Literal(limit))
+            execute_values(cur, query.as_string(cur), values,
+                           template="(%s, %s::date, %s::time)", page_size=len(values))
+            return len(values) - cur.rowcount
+
+    def accept_entries(self, chat_id: int) -> int:
+        """
+        Method moves the pending entries of the chat into the notes table by one statement.
+
+        :param chat_id: the id of the chat
+        :return: the number of the added or updated entries, 0 if there were no pending entries (e.g. they
+                 were purged)
+        """
+        with self.cursor() as cur:
+            cur.execute(sql.SQL("WITH v AS (DELETE FROM pending_notes WHERE chat_id = {} "
+                                "RETURNING name, date, time) {};").format(
+                sql.Literal(chat_id), _get_insert_notes_query(chat_id, sql.SQL("v"))))
+            return cur.rowcount
+
+    def discard_entries(self, chat_id: int):
+        """
+        Method removes the pending entries of the chat.
+
+        :param chat_id: the id of the chat
+        """
+        with self.cursor() as cur:
+            cur.execute(sql.SQL("DELETE FROM pending_notes WHERE chat_id = {};").format(sql.Literal(chat_id)))
+
+    def purge_pending_entries(self, older_than: dt.datetime):
+        """
+        This method removes the pending entries which were abandoned by the users.
+
+        :param older_than: the oldest time of staging of the kept entries
+        """
+        with self.cursor() as cur:
+            cur.execute(sql.SQL("DELETE FROM pending_notes WHERE staged_at < {};").format(sql.Literal(older_than)))
 
     def get_entries(self, start_time: dt.datetime, finish_time: dt.datetime) -> list:
         """
         This method gets all entries from the notes table and returns these values + language_code of a user.
-        Method gets entries having the datetime value is during the specific period (from start_time to finish_time).
+        Method gets entries which must be recalled during the specific period (from start_time to finish_time),
+        the date of an entry is its fire_at.
 
         :param start_time: the start of the period
         :param finish_time: the end of the period
-        :return: the tuple: (chat_id, name, datetime, language_code)
+        :return: the list of Entry
         """
-        with self.connection.cursor() as cur:
-            query = sql.SQL("SELECT notes.note_id, notes.chat_id, notes.name, notes.datetime, users.language_code "
+        return list(self.iter_entries(start_time, finish_time))
+
+    def iter_entries(self, start_time: dt.datetime, finish_time: dt.datetime, fetch_size: int = None,
+                     partitions: tuple = None):
+        """
+        This method is the same as get_entries, but the entries are read by a server-side cursor and yielded
+        by chunks of fetch_size rows, so the whole period is never held in memory.
+        A connection of the pool is borrowed until the generator is exhausted or closed.
+
+        :param start_time: the start of the period
+        :param finish_time: the end of the period
+        :param fetch_size: the number of rows received from the database at once
+        :param partitions: the tuple (the number of partitions, the partitions of chats) to get just the entries
+                           of these partitions, or None to get the entries of all chats
+        :return: the generator of Entry
+        """
+        fetch_size = fetch_size or self.fetch_size
+        condition = sql.SQL("{} AND {}").format(_get_period_condition(start_time, finish_time),
+                                                _get_partitions_condition(partitions))
+
+        query = sql.SQL("SELECT notes.note_id, notes.chat_id, notes.name, notes.fire_at, users.language_code "
+                        "FROM notes INNER JOIN users ON notes.chat_id = users.chat_id "
+                        "WHERE {};").format(condition)
+
+        with self.pool.connection() as connection:
+            # A server-side cursor exists just inside a transaction
+            connection.autocommit = False
+            try:
+                with connection.cursor(name="entries_{}".format(uuid.uuid4().hex)) as cur:
+                    cur.itersize = fetch_size
+                    cur.execute(query)
+                    while True:
+                        rows = cur.fetchmany(fetch_size)
+                        if not rows:
+                            break
+                        for entry in rows:
+                            yield Entry(*entry)
+            finally:
+                if not connection.closed:
+                    connection.rollback()
+                    connection.autocommit = True
+
+    def get_entries_by_ids(self, note_ids: list, start_time: dt.datetime, finish_time: dt.datetime) -> list:
+        """
+        This method gets the entries with the specific ids from the notes table and returns these values +
+        language_code of a user. Just the entries which must be recalled during the period are returned.
+
+        :param note_ids: the ids of the notes
+        :param start_time: the start of the period
+        :param finish_time: the end of the period
+        :return: the list of Entry
+        """
+        if not note_ids:
+            return []
+
+        with self.cursor() as cur:
+            query = sql.SQL("SELECT notes.note_id, notes.chat_id, notes.name, notes.fire_at, users.language_code "
                             "FROM notes INNER JOIN users ON notes.chat_id = users.chat_id "
-                            "WHERE datetime BETWEEN {}::timestamp AND {}::timestamp;").format(
-                sql.Literal(start_time), sql.Literal(finish_time))
+                            "WHERE notes.note_id = ANY({}) AND {};").format(
+                sql.Literal(list(note_ids)), _get_period_condition(start_time, finish_time))
             cur.execute(query)
-            entries = [Entry(entry[0], entry[1], entry[2], entry[3], entry[4]) for entry in cur.fetchall()]
+            entries = [Entry(*entry) for entry in cur.fetchall()]
         return entries
 
+    def get_missed_entries(self, start_time: dt.datetime, finish_time: dt.datetime,
+                           partitions: tuple = None) -> list:
+        """
+        This method gets the entries which had to be recalled during the period, but weren't recorded
+        into the recall_ledger table as sent. The sent occurrences are excluded by one anti-join
+        using the primary key of the ledger.
+
+        :param start_time: the start of the period
+        :param finish_time: the end of the period
+        :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
+        :return: the list of Entry
+        """
+        with self.cursor() as cur:
+            query = sql.SQL("SELECT notes.note_id, notes.chat_id, notes.name, notes.fire_at, users.language_code "
+                            "FROM notes INNER JOIN users ON notes.chat_id = users.chat_id "
+                            "WHERE {} AND {} AND NOT EXISTS ("
+                            "SELECT 1 FROM recall_ledger WHERE recall_ledger.note_id = notes.note_id "
+                            "AND recall_ledger.occurrence = (notes.fire_at AT TIME ZONE 'UTC')::date);").format(
+                _get_period_condition(start_time, finish_time), _get_partitions_condition(partitions))
+            cur.execute(query)
+            entries = [Entry(*entry) for entry in cur.fetchall()]
+        return entries
+
+    def roll_forward(self, before: dt.datetime, partitions: tuple = None) -> int:
+        """
+        This method moves fire_at of the notes which were recalled before the moment to their next occurrence.
+        The notes recalled after the moment are kept to be found by get_missed_entries. The listeners aren't
+        notified about the moved notes, so they must be scheduled after this call.
+
+        :param before: the moment
+        :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
+        :return: the number of the moved notes
+        """
+        with self.pool.connection() as connection:
+            connection.autocommit = False
+            try:
+                with connection.cursor() as cur:
+                    # The moved notes aren't notified: the caller schedules them, and all the overdue notes
+                    # would be sent to the listeners every day otherwise
+                    cur.execute("SELECT set_config(%s, 'on', true);", (SKIP_NOTIFY_SETTING,))
+                    cur.execute(sql.SQL("UPDATE notes SET fire_at = next_fire_at(datetime, chat_timezone(chat_id), "
+                                        "now()) WHERE notes.fire_at < {} AND {};").format(
+                        sql.Literal(before), _get_partitions_condition(partitions)))
+                    count = cur.rowcount
+                connection.commit()
+            except Exception:
+                if not connection.closed:
+                    connection.rollback()
+                raise
+            finally:
+                if not connection.closed:
+                    connection.autocommit = True
+        return count
+
+    def add_ledger_records(self, records: list):
+        """
+        This method records the sent recalls into the recall_ledger table by one statement.
+        The records of the notes deleted after sending are skipped.
+
+        :param records: the list of tuples (note_id, occurrence date, sent_at)
+        """
+        if not records:
+            return
+
+        with self.cursor() as cur:
+            execute_values(cur, "INSERT INTO recall_ledger(note_id, occurrence, sent_at) "
+                                "SELECT note_id, v.occurrence, v.sent_at "
+                                "FROM (VALUES %s) AS v(note_id, occurrence, sent_at) JOIN notes USING (note_id) "
+                                "ON CONFLICT (note_id, occurrence) DO NOTHING", records,
+                           template="(%s::integer, %s::date, %s::timestamptz)", page_size=len(records))
+
+    def purge_ledger(self, older_than: dt.date):
+        """
+        This method removes the records of the ledger which are too old to be checked.
+
+        :param older_than: the date of the oldest kept occurrence
+        """
+        with self.cursor() as cur:
+            cur.execute(sql.SQL("DELETE FROM recall_ledger WHERE occurrence < {};").format(sql.Literal(older_than)))
+
     def notify(self, notify):
         """
         This method notifies the database of the event with the name 'notify'.
 
         :param notify: the name of the channel
         """
-        with self.connection.cursor() as cur:
+        with self.cursor() as cur:
             query = sql.SQL("NOTIFY {};").format(sql.Identifier(notify))
             cur.execute(query)
 
 
+def _get_period_condition(start_time: dt.datetime, finish_time: dt.datetime) -> sql.Composed:
+    """
+    Function builds the condition selecting the notes which must be recalled during the period,
+    it uses the index of fire_at.
+    """
+    return sql.SQL("notes.fire_at >= {} AND notes.fire_at < {}").format(sql.Literal(start_time),
+                                                                         sql.Literal(finish_time))
+
+
+def _get_insert_notes_query(chat_id: int, source: sql.Composable) -> sql.Composed:
+    """
+    Function builds the "UPSERT" query adding the entries of the source into the chat. The source must have
+    the columns "name", "date" and "time" (may be NULL), they're the local ones of the time zone of the chat.
+    """
+    return sql.SQL("INSERT INTO notes(chat_id, name, datetime) "
+                   "SELECT {0}, v.name, (v.date + COALESCE(v.time, "
+                   "(SELECT time_recall::time FROM chats WHERE chat_id = {0}), {1})) "
+                   "AT TIME ZONE chat_timezone({0}) "
+                   "FROM {2} "
+                   "ON CONFLICT (chat_id, name) DO UPDATE SET datetime = excluded.datetime").format(
+        sql.Literal(chat_id), sql.Literal(DEFAULT_RECALL_TIME), source)
+
+
+def _get_insert_conversation_query(chat_id: int) -> sql.Composed:
+    """
+    Function builds the query adding the row of the conversation of the chat, which the other tables refer to,
+    if it doesn't exist yet.
+    """
+    return sql.SQL("INSERT INTO conversations(chat_id) VALUES ({}) ON CONFLICT (chat_id) DO NOTHING;").format(
+        sql.Literal(chat_id))
+
+
+def _get_copy_value(value) -> str:
+    """
+    Function returns the value in the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _get_partitions_condition(partitions: tuple) -> sql.Composed:
+    """
+    Function builds the condition selecting the notes of the chats of the partitions.
+
+    :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
+    """
+    if partitions is None:
+        return sql.SQL("TRUE").format()
+
+    count, selected = partitions
+    return sql.SQL("((notes.chat_id % {0}) + {0}) % {0} = ANY({1})").format(sql.Literal(count),
+                                                                          sql.Literal(list(selected)))
+
+
 class Entry:
     def __init__(self, note_id: int, chat_id: int, name: str, entry_date: dt.datetime, language_code: str):
         self.note_id = note_id
@@ -284,3 +667,339 @@ class Entry:
         self.name = name
         self.entry_date = entry_date
         self.language_code = language_code
+
+
+class NoteChange:
+    """
+    The change of a row of the notes table received from the payload of a notify.
+    """
+
+    def __init__(self, operation: str, note_id: int, chat_id: int, entry_date: dt.datetime):
+        self.operation = operation
+        self.note_id = note_id
+        self.chat_id = chat_id
+        self.entry_date = entry_date
+
+
+def parse_notify_payload(notify: str, payload: str) -> list:
+    """
+    Function parses the payload sent by the notify_notes trigger.
+
+    :param notify: the name of the channel (the operation)
+    :param payload: the payload: "sent|note_id,chat_id,epoch;note_id,chat_id,epoch...", epoch is the fire_at
+                    of a note
+    :return: the list of NoteChange
+    """
+    changes = []
+    payload = payload.rpartition('|')[2] if payload else payload
+    for item in payload.split(';') if payload else []:
+        try:
+            note_id, chat_id, epoch = item.split(',')
+            changes.append(NoteChange(notify, int(note_id), int(chat_id),
+                                      dt.datetime.fromtimestamp(int(epoch), tz=dt.timezone.utc)))
+        except ValueError:
+            logging.warning("Incorrect item of the payload of the notify {}: {}".format(notify, item))
+    return changes
+
+
+def get_notify_time(payload: str) -> float:
+    """
+    Function returns the time (epoch) when the notify_notes trigger sent the payload or None.
+    """
+    sent, separator, _ = (payload or '').partition('|')
+    try:
+        return float(sent) if separator else None
+    except ValueError:
+        return None
+
+
+def merge_changes(changes: list) -> list:
+    """
+    Function merges the changes of the same notes, so only the last state of each note is left.
+    An inserted note that was updated later stays inserted.
+
+    :param changes: the list of NoteChange in the order they were received
+    :return: the list of NoteChange
+    """
+    merged = {}
+    for change in changes:
+        previous = merged.pop(change.note_id, None)
+        if previous is not None and previous.operation == NOTIFY_INSERT_NOTES and \
+                change.operation == NOTIFY_UPDATE_NOTES:
+            change = NoteChange(NOTIFY_INSERT_NOTES, change.note_id, change.chat_id, change.entry_date)
+        merged[change.note_id] = change
+    return list(merged.values())
+
+
+# The migrations of the schema are defined below. A migration is a function receiving a cursor, it's applied once
+# in a transaction and its docstring is recorded as its description. The versions must never be changed or
+# reused: a new change of the schema is added as a new migration at the end of MIGRATIONS.
+# The first migrations use "IF NOT EXISTS", since they're applied to the databases created before the versioning.
+
+
+def _create_base_tables(cur):
+    """
+    Creates the tables of the conversations, the chats, the users and the notes.
+    """
+    # Create the enum for the type of a chat
+    cur.execute("DO $$ "
+                "BEGIN "
+                "IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'chat_type') THEN "
+                "CREATE TYPE chat_type AS ENUM ('private', 'group', 'channel', 'supergroup'); "
+                "END IF; "
+                "END $$;")
+
+    cur.execute("CREATE TABLE IF NOT EXISTS Conversations ("
+                "chat_id integer CONSTRAINT conversations_pkey PRIMARY KEY,"
+                "main_menu_state integer NULL);")
+
+    cur.execute("CREATE TABLE IF NOT EXISTS Chats ("
+                "chat_id integer CONSTRAINT chats_pkey PRIMARY KEY REFERENCES conversations "
+                "ON DELETE CASCADE ON UPDATE CASCADE,"
+                "title varchar(256),"
+                "description varchar(256),"
+                "photo varchar(1000),"
+                "type chat_type,"
+                "time_recall timetz NOT NULL DEFAULT '12:00 MSK');")
+
+    cur.execute("CREATE TABLE IF NOT EXISTS Users ("
+                "user_id integer CONSTRAINT users_pkey PRIMARY KEY,"
+                "chat_id integer REFERENCES conversations ON DELETE SET NULL ON UPDATE CASCADE,"
+                "username varchar(32),"
+                "first_name varchar(256),"
+                "last_name varchar(256),"
+                "is_bot boolean,"
+                "language_code varchar(10) DEFAULT 'en');")
+
+    cur.execute("CREATE TABLE IF NOT EXISTS Notes ("
+                "note_id serial UNIQUE,"
+                "chat_id integer REFERENCES conversations ON DELETE CASCADE ON UPDATE CASCADE,"
+                "name varchar(4096) NOT NULL UNIQUE,"
+                "datetime timestamptz(0) NOT NULL,"
+                "CONSTRAINT notes_pkey PRIMARY KEY(chat_id, name));")
+
+
+def _add_fire_at(cur):
+    """
+    Adds the time zones of the chats and the next instant of recalling of the notes.
+    """
+    # The time zone of a chat, the recalls of its notes are sent at the local time of the chat
+    cur.execute(sql.SQL("ALTER TABLE chats ADD COLUMN IF NOT EXISTS timezone varchar(64) NOT NULL "
+                        "DEFAULT {};").format(sql.Literal(DEFAULT_TIMEZONE)))
+
+    cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION chat_timezone(chat integer) RETURNS text AS $$ "
+                        "SELECT coalesce((SELECT timezone FROM chats WHERE chat_id = chat), {}); "
+                        "$$ LANGUAGE sql STABLE;").format(sql.Literal(DEFAULT_TIMEZONE)))
+
+    # Birthdays recur every year: the function returns the first instant not earlier than "after" when
+    # the local month, day and time of the moment come in the time zone. The 29th of February is
+    # celebrated on the 1st of March in non-leap years
+    cur.execute("CREATE OR REPLACE FUNCTION next_fire_at(moment timestamptz, tz text, after timestamptz) "
+                "RETURNS timestamptz AS $$ "
+                "DECLARE "
+                "local timestamp := moment AT TIME ZONE tz; "
+                "first_year integer := extract(year FROM after AT TIME ZONE tz); "
+                "fire timestamptz; "
+                "BEGIN "
+                "FOR y IN first_year .. first_year + 1 LOOP "
+                "fire := ((make_date(y, extract(month FROM local)::integer, 1) + "
+                "(extract(day FROM local)::integer - 1)) + local::time) AT TIME ZONE tz; "
+                "IF fire >= after THEN "
+                "RETURN fire; "
+                "END IF; "
+                "END LOOP; "
+                "RETURN fire; "
+                "END; "
+                "$$ LANGUAGE plpgsql STABLE;")
+
+    # The next instant of recalling of a note in UTC, the schedule is loaded by a range scan of it
+    cur.execute("ALTER TABLE notes DROP COLUMN IF EXISTS recall_key;")
+    cur.execute("ALTER TABLE notes ADD COLUMN IF NOT EXISTS fire_at timestamptz;")
+    cur.execute("CREATE INDEX IF NOT EXISTS notes_fire_at_idx ON notes (fire_at);")
+
+    # fire_at is recomputed when the moment or the chat of a note or the time zone of a chat is changed
+    cur.execute("CREATE OR REPLACE FUNCTION set_fire_at() RETURNS trigger AS $$ "
+                "BEGIN "
+                "NEW.fire_at := next_fire_at(NEW.datetime, chat_timezone(NEW.chat_id), now()); "
+                "RETURN NEW; "
+                "END; "
+                "$$ LANGUAGE plpgsql;")
+
+    cur.execute("CREATE OR REPLACE FUNCTION update_chat_fire_at() RETURNS trigger AS $$ "
+                "BEGIN "
+                "IF TG_OP = 'INSERT' OR OLD.timezone IS DISTINCT FROM NEW.timezone THEN "
+                "UPDATE notes SET fire_at = next_fire_at(datetime, NEW.timezone, now()) "
+                "WHERE chat_id = NEW.chat_id; "
+                "END IF; "
+                "RETURN NULL; "
+                "END; "
+                "$$ LANGUAGE plpgsql;")
+
+    cur.execute("DO $$"
+                "BEGIN "
+                "IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notes_fire_at') THEN "
+                "CREATE TRIGGER notes_fire_at "
+                "BEFORE INSERT OR UPDATE OF datetime, chat_id ON notes "
+                "FOR EACH ROW "
+                "EXECUTE PROCEDURE set_fire_at();"
+                "END IF; "
+                "IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'chats_fire_at') THEN "
+                "CREATE TRIGGER chats_fire_at "
+                "AFTER INSERT OR UPDATE OF timezone ON chats "
+                "FOR EACH ROW "
+                "EXECUTE PROCEDURE update_chat_fire_at();"
+                "END IF; "
+                "END; $$;")
+
+    cur.execute("UPDATE notes SET fire_at = next_fire_at(datetime, chat_timezone(chat_id), now()) "
+                "WHERE fire_at IS NULL;")
+
+
+def _add_scheduler_tables(cur):
+    """
+    Adds the tables of the workers of the scheduler and of the sent recalls.
+    """
+    # The workers of the scheduler sharing the partitions of chats
+    cur.execute("CREATE TABLE IF NOT EXISTS scheduler_workers ("
+                "worker_id varchar(256) CONSTRAINT scheduler_workers_pkey PRIMARY KEY,"
+                "heartbeat timestamptz NOT NULL);")
+
+    # The recalls that were sent, one row for each occurrence of a note
+    cur.execute("CREATE TABLE IF NOT EXISTS recall_ledger ("
+                "note_id integer REFERENCES notes(note_id) ON DELETE CASCADE,"
+                "occurrence date NOT NULL,"
+                "sent_at timestamptz NOT NULL DEFAULT now(),"
+                "CONSTRAINT recall_ledger_pkey PRIMARY KEY(note_id, occurrence));")
+
+
+def _add_notify_payload(cur):
+    """
+    Replaces the trigger of the notifies by the ones sending the changed rows.
+    """
+    # The trigger sends the changed rows of notes as the payload: "sent|note_id,chat_id,epoch;note_id,...",
+    # where sent is the time of the statement and epoch is the fire_at of a note.
+    # The rows are split into several notifies, if they don't fit into the limit of the payload
+    cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION notify_notes() RETURNS trigger AS $$ "
+                        "DECLARE "
+                        "channel text; "
+                        "items text[]; "
+                        "item text; "
+                        "payload text := ''; "
+                        "sent text := extract(epoch FROM clock_timestamp())::numeric(16, 3)::text; "
+                        "BEGIN "
+                        "IF (TG_OP = 'DELETE') THEN "
+                        "channel := {0}; "
+                        "SELECT array_agg(concat_ws(',', note_id, chat_id, extract(epoch FROM fire_at)::bigint)) "
+                        "INTO items FROM old_notes; "
+                        "ELSE "
+                        "channel := CASE TG_OP WHEN 'UPDATE' THEN {1} ELSE {2} END; "
+                        "SELECT array_agg(concat_ws(',', note_id, chat_id, extract(epoch FROM fire_at)::bigint)) "
+                        "INTO items FROM new_notes; "
+                        "END IF; "
+                        "FOREACH item IN ARRAY coalesce(items, ARRAY[]::text[]) LOOP "
+                        "IF length(payload) + length(item) >= {3} THEN "
+                        "PERFORM pg_notify(channel, sent || '|' || payload); "
+                        "payload := ''; "
+                        "END IF; "
+                        "payload := CASE WHEN payload = '' THEN item ELSE payload || ';' || item END; "
+                        "END LOOP; "
+                        "IF payload <> '' THEN "
+                        "PERFORM pg_notify(channel, sent || '|' || payload); "
+                        "END IF; "
+                        "RETURN NULL; "
+                        "END; "
+                        "$$ LANGUAGE plpgsql;").format(sql.Literal(NOTIFY_DELETE_NOTES),
+                                                       sql.Literal(NOTIFY_UPDATE_NOTES),
+                                                       sql.Literal(NOTIFY_INSERT_NOTES),
+                                                       sql.Literal(NOTIFY_PAYLOAD_LIMIT)))
+
+    # Transition tables can't be used by a trigger for several events, so there is a trigger for each one.
+    # The old trigger without the payload is replaced by them
+    cur.execute(sql.SQL("DO $$"
+                        "BEGIN "
+                        "IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notify_notes') THEN "
+                        "DROP TRIGGER notify_notes ON notes; "
+                        "END IF; "
+                        "IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notify_notes_insert') THEN "
+                        "CREATE TRIGGER notify_notes_insert "
+                        "AFTER INSERT ON notes REFERENCING NEW TABLE AS new_notes "
+                        "FOR EACH STATEMENT "
+                        "EXECUTE PROCEDURE notify_notes();"
+                        "END IF; "
+                        "IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notify_notes_update') THEN "
+                        "CREATE TRIGGER notify_notes_update "
+                        "AFTER UPDATE ON notes REFERENCING NEW TABLE AS new_notes "
+                        "FOR EACH STATEMENT "
+                        "EXECUTE PROCEDURE notify_notes();"
+                        "END IF; "
+                        "IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'notify_notes_delete') THEN "
+                        "CREATE TRIGGER notify_notes_delete "
+                        "AFTER DELETE ON notes REFERENCING OLD TABLE AS old_notes "
+                        "FOR EACH STATEMENT "
+                        "EXECUTE PROCEDURE notify_notes();"
+                        "END IF; "
+                        "END; $$;"))
+
+
+def _add_pending_notes(cur):
+    """
+    Adds the table of the entries waiting for the acceptance.
+    """
+    # The entries typed by a user and waiting for the "Accept" or the "Cancel" button
+    cur.execute("CREATE TABLE IF NOT EXISTS pending_notes ("
+                "chat_id integer REFERENCES conversations ON DELETE CASCADE ON UPDATE CASCADE,"
+                "name varchar(4096) NOT NULL,"
+                "date date NOT NULL,"
+                "time time,"
+                "staged_at timestamptz NOT NULL DEFAULT now(),"
+                "CONSTRAINT pending_notes_pkey PRIMARY KEY(chat_id, name));")
+
+
+def _keep_local_time_of_notes(cur):
+    """
+    Keeps the local time of the notes of a chat when its time zone is changed.
+    """
+    # The moment of a note is the local date and time of recalling in the time zone of the chat, so it's moved
+    # to the new time zone and fire_at is recomputed by the notes_fire_at trigger. The notes added before
+    # the chat was created have the default time zone
+    cur.execute(sql.SQL("CREATE OR REPLACE FUNCTION update_chat_fire_at() RETURNS trigger AS $$ "
+                        "DECLARE "
+                        "old_timezone text; "
+                        "BEGIN "
+                        "IF TG_OP = 'INSERT' THEN "
+                        "old_timezone := {}; "
+                        "ELSE "
+                        "old_timezone := OLD.timezone; "
+                        "END IF; "
+                        "IF old_timezone IS DISTINCT FROM NEW.timezone THEN "
+                        "UPDATE notes SET datetime = (datetime AT TIME ZONE old_timezone) AT TIME ZONE NEW.timezone "
+                        "WHERE chat_id = NEW.chat_id; "
+                        "END IF; "
+                        "RETURN NULL; "
+                        "END; "
+                        "$$ LANGUAGE plpgsql;").format(sql.Literal(DEFAULT_TIMEZONE)))
+
+
+def _skip_notify_setting(cur):
+    """
+    Lets a transaction update the notes without the notifies.
+    """
+    cur.execute("DROP TRIGGER IF EXISTS notify_notes_update ON notes;")
+    cur.execute(sql.SQL("CREATE TRIGGER notify_notes_update "
+                        "AFTER UPDATE ON notes REFERENCING NEW TABLE AS new_notes "
+                        "FOR EACH STATEMENT "
+                        "WHEN (current_setting({}, true) IS DISTINCT FROM 'on') "
+                        "EXECUTE PROCEDURE notify_notes();").format(sql.Literal(SKIP_NOTIFY_SETTING)))
+
+
+MIGRATIONS = (
+    (1, _create_base_tables),
+    (2, _add_fire_at),
+    (3, _add_scheduler_tables),
+    (4, _add_notify_payload),
+    (5, _add_pending_notes),
+    (6, _keep_local_time_of_notes),
+    (7, _skip_notify_setting),
+)
+# The version of the schema used by this code
+SCHEMA_VERSION = MIGRATIONS[-1][0]
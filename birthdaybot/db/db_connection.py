@@ -1,12 +1,19 @@
 """
 This module implements the database connection.
 """
+import logging
+import time
 import psycopg2
-import sys
 from abc import ABC
+from contextlib import contextmanager
+from birthdaybot.db.pool import ConnectionPool
 
 
 class DatabaseConnection(ABC):
+    # The number of attempts to connect to the database and the delay between them (in seconds)
+    CONNECT_ATTEMPTS = 5
+    CONNECT_DELAY = 1
+
     def __init__(self, json_obj):
         self._name = json_obj["PG_NAME"]
         self._user = json_obj["PG_USER"]
@@ -15,21 +22,58 @@ class DatabaseConnection(ABC):
         self._port = json_obj["PG_PORT"]
         self._credentials = json_obj
 
+        self._open()
+
+    def _open(self):
         self.connection = self._connect()
 
     def _connect(self):
-        try:
-            connection = psycopg2.connect(database=self._name,
-                                          user=self._user,
-                                          password=self._password,
-                                          host=self._host,
-                                          port=self._port)
-
-            return connection
-        except psycopg2.OperationalError as e:
-            print("Error: {}".format(e), file=sys.stderr)
-            exit(-2)
+        """
+        Opens a new connection to the database. If the database isn't available, the connection is retried
+        several times and then the last OperationalError is raised.
+        """
+        for attempt in range(1, self.CONNECT_ATTEMPTS + 1):
+            try:
+                return psycopg2.connect(database=self._name,
+                                        user=self._user,
+                                        password=self._password,
+                                        host=self._host,
+                                        port=self._port)
+            except psycopg2.OperationalError as e:
+                if attempt == self.CONNECT_ATTEMPTS:
+                    raise
+                logging.warning("Connection to the database failed ({}), retrying: {}".format(attempt, e))
+                time.sleep(self.CONNECT_DELAY * attempt)
+
+    def close(self):
+        self.connection.close()
 
     @property
     def credentials(self):
         return self._credentials
+
+
+class PooledDatabaseConnection(DatabaseConnection):
+    """
+    The connection to the database which borrows a connection from the pool for each operation.
+    The size of the pool is taken from the PG_POOL_SIZE parameter of the configuration.
+    """
+    DEFAULT_POOL_SIZE = 4
+
+    def _open(self):
+        self.pool = ConnectionPool(self._connect, int(self._credentials.get("PG_POOL_SIZE", self.DEFAULT_POOL_SIZE)))
+        # Open the first connection at once to check that the database is available
+        with self.pool.connection():
+            pass
+
+    @contextmanager
+    def cursor(self):
+        """
+        The context manager borrows a connection from the pool and returns a cursor of it.
+        """
+        with self.pool.connection() as connection:
+            with connection.cursor() as cur:
+                yield cur
+
+    def close(self):
+        self.pool.closeall()
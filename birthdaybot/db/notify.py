@@ -1,62 +1,268 @@
 """
 This module implements the class that sets up notifies and implements listening to a database.
-The listening is implemented in a separate process.
+The listening is implemented in a separate thread which sleeps until the connection receives a notify
+or the listening is stopped, the received notifies are passed into the callable function by another thread.
 """
+import os
 import psycopg2
 import psycopg2.extensions
 import logging
-from select import select
+import queue
+import selectors
+import time
 from psycopg2 import sql
-from threading import Thread
+from threading import Thread, Lock
 from birthdaybot.db.db_connection import DatabaseConnection
+from birthdaybot.metrics import LatencyStats
+
+# The items of the queue of the notifies which aren't notifies
+_RESYNC = object()
+_STOP = object()
 
 
 class DatabaseNotify(DatabaseConnection):
-    TIMEOUT = 3
+    # The interval (in seconds) of checking an idle connection
+    KEEPALIVE = 30
+    # The maximum delay (in seconds) between the attempts to reconnect
+    MAX_RECONNECT_DELAY = 60
 
-    def __init__(self, json_obj):
+    def __init__(self, json_obj, debounce: float = 0.0, max_pending: int = 10000, sent_time=None):
+        """
+        :param json_obj: the configurations of the database
+        :param debounce: the time (in seconds) during which the notifies are collected into one batch
+        :param max_pending: the maximum number of the received notifies waiting for the callable function,
+                            the listening is paused while the queue is full
+        :param sent_time: the function returning the time (epoch) when a notify was sent or None, it's used
+                          to measure the lag between sending a notify and passing it into the callable function
+        """
         super().__init__(json_obj)
 
         self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         self.__listening = False
+        self._channels = set()
+        self._listener = None
+        self._dispatcher = None
+
+        # The listener is woken up by writing into the pipe
+        self._wakeup_reader, self._wakeup_writer = os.pipe()
+        os.set_blocking(self._wakeup_reader, False)
+        os.set_blocking(self._wakeup_writer, False)
+
+        self.debounce = debounce
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._sent_time = sent_time
+
+        # The counters of the notifies
+        self._stats_lock = Lock()
+        self._received = 0
+        self._coalesced = 0
+        self._batches = 0
+        self._reconnects = 0
+        self.lag = LatencyStats()
+
+    def __listen(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
+            connection_key = selector.register(self.connection, selectors.EVENT_READ)
 
-    def __listen(self, callable_function, *args):
-        if self.__listening:
-            logging.warning("You're trying to run listening to the database, but it is already listening")
-        else:
-            self.__listening = True
             while self.__listening:
-                if select([self.connection], [], [], self.TIMEOUT) != ([], [], []):
+                try:
+                    events = selector.select(self.KEEPALIVE)
+                    if not events:
+                        # Check that the idle connection is still alive
+                        with self.connection.cursor() as cur:
+                            cur.execute("SELECT 1;")
+                    if not self.__listening:
+                        break
+
                     self.connection.poll()
                     while self.connection.notifies:
-                        pid, notify = self.connection.notifies.pop()
+                        notify = self.connection.notifies.pop(0)
 
-                        # Call the callable function and pass it the dictionary of arguments
-                        callable_function(pid, notify)
+                        with self._stats_lock:
+                            self._received += 1
+                        self._put(notify)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    logging.error("The connection of the listener of the database was lost: {}".format(e))
+                    selector.unregister(connection_key.fd)
+                    if not self._reconnect():
+                        break
+                    connection_key = selector.register(self.connection, selectors.EVENT_READ)
+                    # The notifies sent while the connection was lost are missed
+                    self._put(_RESYNC)
 
-    def listen(self, notify):
-        """Subscribe to a PostgreSQL NOTIFY"""
+        self._put(_STOP)
+        self.connection.close()
+
+    def _put(self, item):
+        """
+        Puts the item into the queue of the dispatcher. If the queue is full, the listening waits for
+        the callable function.
+        """
+        while True:
+            try:
+                self._pending.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not self.__listening and item is not _STOP:
+                    return
+
+    def _wait(self, timeout: float) -> bool:
+        """
+        Sleeps until the timeout expires or the listening is stopped.
+
+        :return: True if the listening was stopped
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
+            selector.select(timeout)
+        return not self.__listening
+
+    def _reconnect(self) -> bool:
+        """
+        Opens a new connection and subscribes it to the notifies, it's retried until the listening is stopped.
+
+        :return: True if the connection was opened
+        """
+        try:
+            self.connection.close()
+        except psycopg2.Error:
+            pass
+
+        delay = self.CONNECT_DELAY
+        while self.__listening:
+            try:
+                self.connection = self._connect()
+                self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                for channel in self._channels:
+                    self._execute_listen("LISTEN", channel)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logging.error("The listener of the database wasn't reconnected: {}".format(e))
+                if self._wait(delay):
+                    return False
+                delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+                continue
+
+            with self._stats_lock:
+                self._reconnects += 1
+            logging.info("The listener of the database was reconnected")
+            return True
+        return False
+
+    def __dispatch(self, callable_function, resync_function):
+        """
+        Collects the received notifies during the debounce window and passes them into the callable function
+        as one batch. After the listener was reconnected, the resync function is called instead.
+        """
+        carried = None
+        while True:
+            item, carried = (carried, None) if carried is not None else (self._pending.get(), None)
+            if item is _STOP:
+                return
+            if item is _RESYNC:
+                self._call(resync_function)
+                continue
+
+            batch = [item]
+            deadline = time.monotonic() + self.debounce
+            while True:
+                try:
+                    remaining = deadline - time.monotonic()
+                    item = self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP or item is _RESYNC:
+                    carried = item
+                    break
+                batch.append(item)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._coalesced += len(batch) - 1
+
+            if self._sent_time is not None:
+                sent = [sent for sent in map(self._sent_time, batch) if sent is not None]
+                if sent:
+                    self.lag.add(max(0.0, time.time() - min(sent)))
+
+            # Call the callable function and pass it the batch of the notifies
+            self._call(callable_function, batch)
+
+    @staticmethod
+    def _call(function, *args):
+        if function is None:
+            return
+        try:
+            function(*args)
+        except Exception as e:
+            logging.exception("The notifies weren't processed: {}".format(e))
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns the counters of the notifies: the received notifies, the notifies coalesced into another batch,
+        the batches passed into the callable function, the reconnections of the listener and the lag
+        between sending the notifies and processing them.
+        """
+        with self._stats_lock:
+            return {"received": self._received,
+                    "coalesced": self._coalesced,
+                    "batches": self._batches,
+                    "pending": self._pending.qsize(),
+                    "reconnects": self._reconnects,
+                    "lag": self.lag.to_dict()}
+
+    def _execute_listen(self, command: str, notify: str):
         with self.connection.cursor() as cur:
-            query = sql.SQL("LISTEN {};").format(sql.Identifier(notify))
+            query = sql.SQL("{} {};").format(sql.SQL(command), sql.Identifier(notify))
             cur.execute(query)
 
+    def listen(self, notify):
+        """Subscribe to a PostgreSQL NOTIFY, the subscription is restored after reconnecting"""
+        self._channels.add(notify)
+        self._execute_listen("LISTEN", notify)
+
     def remove(self, notify):
         """Unsubscribe a PostgreSQL LISTEN"""
-        with self.connection.cursor() as cur:
-            query = sql.SQL("UNLISTEN {};").format(sql.Identifier(notify))
-            cur.execute(query)
+        self._channels.discard(notify)
+        self._execute_listen("UNLISTEN", notify)
 
     def stop(self):
-        """Call to stop the listen thread"""
+        """Stops the listening at once and waits until the received notifies are processed"""
         self.__listening = False
+        try:
+            os.write(self._wakeup_writer, b'\0')
+        except BlockingIOError:
+            pass
 
-    def run(self, callable_function, **kwargs):
+        for thread in (self._listener, self._dispatcher):
+            if thread is not None:
+                thread.join()
+        self._listener = self._dispatcher = None
+
+    def run(self, callable_function, resync_function=None):
         """
-        Start listening in a separate process and return that as an instance
+        Start listening in a separate thread and return that as an instance
 
-        :param callable_function: the function that will be called when a notify will be occurred
-        :param kwargs: a dictionary containing arguments and its values
+        :param callable_function: the function that will be called with the list of the received notifies
+        :param resync_function: the function that will be called without arguments after the connection was
+                                restored, since the notifies sent while it was lost are missed
         """
-        proc = Thread(target=self.__listen, args=(callable_function, kwargs))
-        proc.start()
-        return proc
+        if self.__listening:
+            logging.warning("You're trying to run listening to the database, but it is already listening")
+            return self._listener
+
+        # Drop the wakeup of the previous stop
+        try:
+            while os.read(self._wakeup_reader, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+        self.__listening = True
+        self._dispatcher = Thread(target=self.__dispatch, args=(callable_function, resync_function),
+                                  name="notify_dispatcher", daemon=True)
+        self._dispatcher.start()
+        self._listener = Thread(target=self.__listen, name="notify_listener")
+        self._listener.start()
+        return self._listener
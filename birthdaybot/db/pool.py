@@ -0,0 +1,149 @@
+"""
+This module implements the thread-safe pool of connections to the database.
+"""
+import logging
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """The exception is raised when no connection was returned into the pool during the timeout"""
+
+
+class ConnectionPool:
+    """
+    The pool keeps at most `size` connections. A connection is borrowed for one operation and then returned
+    into the pool, so the threads of the bot may work with the database in parallel.
+
+    A connection that was idle longer than health_check_interval seconds is checked before it's borrowed,
+    a broken or closed connection is replaced with a new one.
+    """
+
+    def __init__(self, connect, size: int, autocommit: bool = True, health_check_interval: float = 30.0):
+        """
+        :param connect: the function that opens a new connection
+        :param size: the maximum number of connections
+        :param autocommit: the autocommit mode of all connections
+        :param health_check_interval: the idle time (in seconds) after which a connection is checked
+        """
+        if size < 1:
+            raise ValueError("The size of the pool must be positive")
+
+        self._connect = connect
+        self._size = size
+        self._autocommit = autocommit
+        self._health_check_interval = health_check_interval
+
+        # Idle connections with the time they were returned into the pool
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _open(self):
+        connection = self._connect()
+        connection.autocommit = self._autocommit
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_alive(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self._health_check_interval:
+            return True
+
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def getconn(self, timeout: float = None):
+        """
+        Borrows a connection from the pool. If all connections are borrowed, waits until one is returned.
+
+        :param timeout: the maximum time to wait (in seconds) or None to wait forever
+        :return: connection
+        """
+        if self._closed:
+            raise psycopg2.InterfaceError("The pool is closed")
+        if not self._semaphore.acquire(timeout=timeout):
+            raise PoolTimeout("No connection was available during {} seconds".format(timeout))
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, idle_since = self._idle.pop()
+
+                if self._is_alive(connection, idle_since):
+                    return connection
+
+                logging.warning("A broken connection to the database was dropped from the pool")
+                self._close(connection)
+
+            return self._open()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def putconn(self, connection, discard: bool = False):
+        """
+        Returns the borrowed connection into the pool.
+
+        :param connection: the connection
+        :param discard: if True, the connection will be closed instead of reusing
+        """
+        try:
+            if not discard and not connection.closed and not self._closed:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+            else:
+                self._close(connection)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._close(connection)
+        finally:
+            self._semaphore.release()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        The context manager borrows a connection and returns it back into the pool. If the connection was lost
+        during the operation, it's closed and the next operation will use a new one.
+        """
+        connection = self.getconn(timeout)
+        discard = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(connection, discard)
+
+    def closeall(self):
+        """
+        Closes all idle connections, the borrowed connections will be closed when they're returned.
+        """
+        self._closed = True
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop()[0])
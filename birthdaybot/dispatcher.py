@@ -0,0 +1,159 @@
+"""
+This module contains the dispatcher processing the updates of different chats concurrently.
+"""
+import collections
+import threading
+import telegram
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher
+from birthdaybot.persistence import LazyDict
+
+
+class ChatDispatcher(Dispatcher):
+    """
+    The dispatcher runs the handlers on a pool of workers. The updates of one chat are processed one by one
+    in the order they were received, so the states of the ConversationHandler (which is kept per chat) change
+    in the same order as with the usual dispatcher, while a slow chat doesn't stall other chats.
+
+    The chats take turns: a worker processes one update of a chat and then the chat is put into the end
+    of the queue of the pool, if it has other updates.
+    """
+
+    def __init__(self, *args, chat_workers: int = 8, max_pending: int = 1000, **kwargs):
+        """
+        :param chat_workers: the number of the workers processing the updates
+        :param max_pending: the maximum number of the updates taken from the update queue and waiting for
+                            the workers, the update queue isn't read while this limit is reached
+        """
+        super().__init__(*args, **kwargs)
+        self.chat_workers = chat_workers
+        self.max_pending = max_pending
+
+        self._executor = ThreadPoolExecutor(max_workers=chat_workers, thread_name_prefix="chat_worker")
+        # The queues of the updates of the chats which are being processed
+        self._chats = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        # While the dispatcher is stopping, the workers aren't resubmitted to the pool which is shutting down
+        self._stopping = False
+
+    @staticmethod
+    def _get_key(update: object):
+        """
+        Returns the key serializing the update: the id of its chat or of its user, or None if the update
+        may be processed in any order.
+        """
+        if isinstance(update, telegram.Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return 'user', update.effective_user.id
+        return None
+
+    def process_update(self, update: object):
+        """
+        Passes the update to the workers. If too many updates are waiting for the workers, the call is blocked.
+        """
+        # The errors of polling aren't related to a chat, the updates passed after stopping are processed at once
+        if isinstance(update, TelegramError) or self._stopping:
+            super().process_update(update)
+            return
+
+        key = self._get_key(update)
+        with self._condition:
+            while self._pending >= self.max_pending:
+                self._condition.wait()
+            self._pending += 1
+
+            if key is None:
+                self._executor.submit(self._run_update, update)
+            elif key in self._chats:
+                self._chats[key].append(update)
+            else:
+                self._chats[key] = collections.deque([update])
+                self._executor.submit(self._run_chat, key)
+
+    def _run_update(self, update: object):
+        self._process(update)
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify_all()
+
+    def _run_chat(self, key):
+        while True:
+            with self._condition:
+                update = self._chats[key][0]
+
+            self._process(update)
+
+            with self._condition:
+                updates = self._chats[key]
+                updates.popleft()
+                self._pending -= 1
+                self._condition.notify_all()
+                if not updates:
+                    del self._chats[key]
+                    return
+                if not self._stopping:
+                    self._executor.submit(self._run_chat, key)
+                    return
+            # The rest of the updates of the chat are processed by this worker while the dispatcher is stopping
+
+    def _process(self, update: object):
+        # The data of the chat and the user of the update isn't evicted from the cache of the persistence
+        # while the update is processed, otherwise the changes made after the eviction would be lost
+        pinned = self._get_pinned(update)
+        for data, key in pinned:
+            data.pin(key)
+        try:
+            super().process_update(update)
+        except Exception:
+            self.logger.exception('An uncaught error was raised while processing an update')
+        finally:
+            for data, key in pinned:
+                data.unpin(key)
+
+    def _get_pinned(self, update: object) -> list:
+        """
+        Returns the list of the pairs (the lazily loaded data, the key) used by the update.
+        """
+        pinned = []
+        if isinstance(update, telegram.Update):
+            if update.effective_chat is not None and isinstance(self.chat_data, LazyDict):
+                pinned.append((self.chat_data, update.effective_chat.id))
+            if update.effective_user is not None and isinstance(self.user_data, LazyDict):
+                pinned.append((self.user_data, update.effective_user.id))
+        return pinned
+
+    def update_persistence(self, update: object = None):
+        # The usual dispatcher saves the data under one lock, but the data of an update belongs to its chat
+        # and its user, whose updates are processed one by one, so the updates of different chats are saved
+        # concurrently and just saving all the data is done under the lock
+        if isinstance(update, telegram.Update):
+            self._Dispatcher__update_persistence(update)
+        else:
+            super().update_persistence(update)
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Waits until all the received updates are processed.
+
+        :param timeout: the maximum time to wait (in seconds) or None to wait forever
+        :return: True if all the updates were processed
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self):
+        # No update is taken from the update queue after that, the received ones are processed
+        super().stop()
+        with self._condition:
+            self._stopping = True
+        self.join()
+        self._executor.shutdown(wait=True)
+
+        # The persistence may be flushed while the last updates were processed, so it's flushed again
+        if self.persistence:
+            self.update_persistence()
+            self.persistence.flush()
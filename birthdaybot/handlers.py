@@ -1,18 +1,24 @@
 """
 Module for all the handlers which will be processed by the ConversationHandler
 """
-import datetime as dt
-import re
+import html
 import telegram
 import birthdaybot.menus as menus
+import birthdaybot.parser as parser
 import logging
 from birthdaybot.db.database import Database
-from birthdaybot.localization import localization, date
+from birthdaybot.jobs import MESSAGE_LIMIT
+from birthdaybot.localization import localization
 from telegram.ext import Updater, JobQueue
 
 # Define all the states of the bot
 MAIN_MENU, ADD_LISTS = range(2)
 
+# The maximum number of the incorrect lines sent back to the user
+MAX_SHOWN_ERRORS = 50
+# The maximum length of a shown incorrect line
+MAX_SHOWN_LENGTH = 100
+
 
 def start_handler(update: telegram.Update, context: telegram.ext.CallbackContext):
     """
@@ -100,57 +106,41 @@ def process_entries(text: str, update: telegram.Update, context: telegram.ext.Ca
     Method processes the text received from the user and checks that entries are correct.
     This method will be called by add_lists_handler that processes adding new lists of entries.
 
-    Returns a list of tuples that contain the name of an entry and the date.
+    Returns a set of tuples that contain the name of an entry, the date and the time.
     """
-    language_code = update.effective_user.language_code if update.effective_user.language_code == 'ru' else 'en'
-
-    incorrect_lines = set()
-    entries = set()
-    for line in text.splitlines():
-        line.strip()
-        # Check the line matches the pattern
-        if not re.match(
-                r"^[\w ]+ *- *((0?[1-9])|([1-2][0-9])|(3[0-1]))(( +[а-яА-Яa-zA-Z]{3,9})|([./]((0?[1-9])|(1[0-2]))))"
-                r"( +((0?[0-9])|(1[0-9])|(2[0-3])):([0-5][0-9])(:[0-5][0-9])?)?$",
-                line, re.IGNORECASE):
-            incorrect_lines.add(line)
-        else:
-            # Get the name and the date of an entry
-            name, date_entry = [x.strip() for x in line.split('-')]
-
-            time = None
-            _splits = re.split(r'[ ./]+', date_entry, maxsplit=2)
-            if len(_splits) == 2:
-                day, month = _splits
-            elif len(_splits) == 3:
-                day, month, time = _splits
-                time = time.split(':')
-                if len(time) == 2:
-                    time = dt.time(hour=int(time[0]), minute=int(time[1]))
-                elif len(time) == 3:
-                    time = dt.time(hour=int(time[0]), minute=int(time[1]), second=int(time[2]))
-                else:
-                    time = dt.time.fromisoformat('12:00:00')
-            else:
-                raise ValueError("Incorrect entry in the process_entries function")
-
-            if re.match(r'^[a-zA-Zа-яА-Я]+$', month):
-                month = date.MONTHS[language_code].get(month, 0)
-
-            year = dt.datetime.now().year
-
-            # A day or a month may be incorrect
-            try:
-                date_entry = dt.date(year=year, month=int(month), day=int(day))
-                entries.add((name, date_entry, time))
-            except ValueError:
-                incorrect_lines.add(line)
+    result = parser.parse(text)
 
     # Send incorrect lines to the user
-    if incorrect_lines:
+    if result.errors:
         chat_id = update.effective_chat.id
         code = update.effective_user.language_code
+        template = localization.error_adding_entry(code)
+        limit = MESSAGE_LIMIT - len(template.format(""))
         context.bot.sendMessage(chat_id=chat_id,
-                                text=localization.error_adding_entry(code).format('\n'.join(incorrect_lines)),
+                                text=template.format(format_errors(result.errors, limit)),
                                 parse_mode=telegram.ParseMode.HTML)
-    return entries
+    return result.entries
+
+
+def format_errors(errors: list, limit: int = MESSAGE_LIMIT) -> str:
+    """
+    Function formats the incorrect lines to send them to the user, just the first MAX_SHOWN_ERRORS lines
+    which fit into the limit are shown.
+
+    :param errors: the list of ParseError
+    :param limit: the maximum length of the text
+    :return: the HTML text
+    """
+    lines, length = [], 0
+    for number, error in enumerate(errors[:MAX_SHOWN_ERRORS], 1):
+        line = "{}: {}".format(error.number, html.escape(error.line[:MAX_SHOWN_LENGTH]))
+        # The place of the line with the number of the hidden errors is kept while some errors are hidden
+        reserved = len("\n… (+{})".format(len(errors))) if number < len(errors) else 0
+        if length + len(line) + reserved + (1 if lines else 0) > limit:
+            break
+        length += len(line) + (1 if lines else 0)
+        lines.append(line)
+
+    if len(lines) < len(errors):
+        lines.append("… (+{})".format(len(errors) - len(lines)))
+    return '\n'.join(lines)
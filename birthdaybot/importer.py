@@ -0,0 +1,255 @@
+"""
+This module contains the import of the documents with birthdays: CSV tables, vCard contacts and iCalendar events.
+
+A document is read line by line, the records are validated and passed into the database by chunks,
+so the whole document is never held in memory.
+"""
+import csv
+import datetime as dt
+import io
+import os
+import re
+from birthdaybot import parser
+from birthdaybot.db.database import Database
+
+CSV = 'csv'
+VCARD = 'vcard'
+ICALENDAR = 'icalendar'
+
+# The number of entries passed into the database at once
+CHUNK_SIZE = 5000
+# The delimiters of the columns of a CSV table
+CSV_DELIMITERS = (',', ';', '\t')
+# The maximum length of the name of an entry
+MAX_NAME_LENGTH = 4096
+
+_EXTENSIONS = {'.csv': CSV, '.vcf': VCARD, '.vcard': VCARD, '.ics': ICALENDAR, '.ical': ICALENDAR}
+_MIME_TYPES = {'text/csv': CSV, 'text/vcard': VCARD, 'text/x-vcard': VCARD, 'text/directory': VCARD,
+               'text/calendar': ICALENDAR}
+
+# "1990-03-12", "19900312", "--03-12", "--0312", the time part of a datetime is ignored
+_ISO_DATE = re.compile(r"(?:\d{4}|--)-?(?P<month>\d{2})-?(?P<day>\d{2})(?:T[\d:]+Z?)?")
+# "12.03.1990", "12/03/1990"
+_DOTTED_DATE = re.compile(r"(?P<day>\d{1,2})[./](?P<month>\d{1,2})[./]\d{4}")
+_TIME = re.compile(r"(?P<hour>[01]?[0-9]|2[0-3]):(?P<minute>[0-5][0-9])(?::(?P<second>[0-5][0-9]))?")
+_VCARD_ESCAPES = re.compile(r"\\(.)")
+
+
+class ImportResult:
+    """
+    The result of an import: the number of the added entries and the rejected records.
+    """
+
+    def __init__(self):
+        self.added = 0
+        self.processed = 0
+        self.errors = []
+
+
+def detect_format(file_name: str, mime_type: str) -> str:
+    """
+    Function detects the format of a document by its extension or its MIME type.
+
+    :return: CSV, VCARD, ICALENDAR or None if the format isn't supported
+    """
+    extension = os.path.splitext(file_name or '')[1].lower()
+    return _EXTENSIONS.get(extension) or _MIME_TYPES.get((mime_type or '').lower())
+
+
+def parse_value(name: str, value: str, time: str, today: dt.date):
+    """
+    Function parses a record of a document.
+
+    :param name: the name of an entry
+    :param value: the date in the ISO format, "dd.mm.yyyy" or any format of the lists of entries
+    :param time: the time of recalling or None
+    :param today: the current date
+    :return: the tuple (name, date, time) or the reason why the record is incorrect
+    """
+    name = name.strip()
+    value = value.strip()
+    if not name or len(name) > MAX_NAME_LENGTH or not value:
+        return parser.INVALID_FORMAT
+
+    match = _ISO_DATE.fullmatch(value) or _DOTTED_DATE.fullmatch(value)
+    if match is None:
+        # The date may be written as in a list of entries: "12 march", "12.03"
+        entry = parser.parse_line("_ - {}".format(value), today)
+        if isinstance(entry, tuple):
+            entry = (name, entry[1], entry[2])
+    else:
+        try:
+            entry = (name, parser.get_entry_date(int(match.group('month')), int(match.group('day')), today), None)
+        except ValueError:
+            return parser.INVALID_DATE
+
+    if isinstance(entry, tuple) and time:
+        match = _TIME.fullmatch(time.strip())
+        if match is None:
+            return parser.INVALID_FORMAT
+        entry = (entry[0], entry[1], dt.time(int(match.group('hour')), int(match.group('minute')),
+                                             int(match.group('second') or 0)))
+    return entry
+
+
+def iter_csv(stream: io.TextIOBase):
+    """
+    Function reads the rows "name, date[, time]" of a CSV table. The delimiter is detected by the first line,
+    the first row is skipped if it's a header.
+
+    :return: the generator of tuples (the number of the line, the text, the name, the date, the time)
+    """
+    # The most frequent delimiter of the first line is taken
+    first_line = stream.readline()
+    stream.seek(0)
+    delimiter = max(CSV_DELIMITERS, key=first_line.count)
+
+    reader = csv.reader(stream, delimiter=delimiter)
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        # The header has no digits in the column of the dates
+        if reader.line_num == 1 and len(row) > 1 and not any(char.isdigit() for char in row[1]):
+            continue
+
+        text = delimiter.join(row)
+        if len(row) < 2:
+            yield reader.line_num, text, '', '', None
+        else:
+            yield reader.line_num, text, row[0], row[1], row[2] if len(row) > 2 else None
+
+
+def _iter_properties(stream: io.TextIOBase):
+    """
+    Function reads the properties of a vCard or an iCalendar document, the folded lines are unfolded.
+
+    :return: the generator of tuples (the number of the line, the name of the property, the value)
+    """
+    number, line = 0, None
+    for current, text in enumerate(stream, 1):
+        text = text.rstrip('\r\n')
+        if text[:1] in (' ', '\t') and line is not None:
+            line += text[1:]
+            continue
+
+        if line is not None:
+            yield _split_property(number, line)
+        number, line = current, text
+
+    if line is not None:
+        yield _split_property(number, line)
+
+
+def _split_property(number: int, line: str) -> tuple:
+    name, _, value = line.partition(':')
+    # "item1.BDAY;VALUE=date" -> "BDAY"
+    name = name.split(';', 1)[0].rsplit('.', 1)[-1].upper()
+    return number, name, value
+
+
+def _unescape(value: str) -> str:
+    return _VCARD_ESCAPES.sub(lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def iter_vcard(stream: io.TextIOBase):
+    """
+    Function reads the contacts of a vCard document. The contacts without a birthday are skipped.
+
+    :return: the generator of tuples (the number of the line, the text, the name, the date, the time)
+    """
+    number, card = 0, None
+    for line, name, value in _iter_properties(stream):
+        if name == 'BEGIN' and value.upper() == 'VCARD':
+            number, card = line, {}
+        elif card is None:
+            continue
+        elif name == 'END' and value.upper() == 'VCARD':
+            full_name = card.get('FN')
+            if not full_name and card.get('N'):
+                # "Family;Given;Additional;Prefixes;Suffixes"
+                parts = [_unescape(part) for part in re.split(r"(?<!\\);", card['N'])]
+                full_name = ' '.join(part for part in parts[1:2] + parts[:1] if part)
+            if card.get('BDAY'):
+                yield number, "{}: {}".format(full_name or '', card['BDAY']), full_name or '', card['BDAY'], None
+            card = None
+        elif name in ('FN', 'BDAY'):
+            card[name] = _unescape(value).strip()
+        elif name == 'N':
+            card[name] = value
+
+
+def iter_icalendar(stream: io.TextIOBase):
+    """
+    Function reads the events of an iCalendar document, the summary of an event is the name of an entry.
+
+    :return: the generator of tuples (the number of the line, the text, the name, the date, the time)
+    """
+    number, event = 0, None
+    for line, name, value in _iter_properties(stream):
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            number, event = line, {}
+        elif event is None:
+            continue
+        elif name == 'END' and value.upper() == 'VEVENT':
+            summary, start = event.get('SUMMARY', ''), event.get('DTSTART', '')
+            yield number, "{}: {}".format(summary, start), summary, start, None
+            event = None
+        elif name in ('SUMMARY', 'DTSTART'):
+            event[name] = _unescape(value).strip()
+
+
+_READERS = {CSV: iter_csv, VCARD: iter_vcard, ICALENDAR: iter_icalendar}
+
+
+def _iter_chunks(records, result: ImportResult, today: dt.date, progress=None):
+    """
+    Function validates the records and groups the correct ones into chunks.
+
+    :return: the generator of lists of tuples (the number of the line, the name, the date, the time)
+    """
+    chunk = []
+    for number, text, name, value, time in records:
+        result.processed += 1
+        entry = parse_value(name, value, time, today)
+        if isinstance(entry, tuple):
+            chunk.append((number,) + entry)
+        else:
+            result.errors.append(parser.ParseError(number, text, entry))
+
+        if len(chunk) >= CHUNK_SIZE:
+            yield chunk
+            chunk = []
+            if progress is not None:
+                progress(result.processed)
+    if chunk:
+        yield chunk
+
+
+def import_document(database: Database, chat_id: int, stream, document_format: str, progress=None,
+                    today: dt.date = None) -> ImportResult:
+    """
+    Function imports the entries of a document into the chat. The entries are added in one transaction,
+    so a failed import doesn't add anything.
+
+    :param database: the Database instance
+    :param chat_id: the id of the chat
+    :param stream: the binary file object of the document
+    :param document_format: CSV, VCARD or ICALENDAR
+    :param progress: the function that will be called with the number of the processed records after each chunk,
+                     it's called inside the transaction of the import, so it must return at once
+    :param today: the current date
+    :return: ImportResult
+    :raise UnicodeDecodeError: if the document isn't encoded in UTF-8
+    :raise csv.Error: if the CSV table is malformed
+    """
+    today = today or dt.date.today()
+    result = ImportResult()
+
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if document_format == CSV else None)
+    try:
+        records = _READERS[document_format](text)
+        result.added = database.import_entries(chat_id, _iter_chunks(records, result, today, progress))
+    finally:
+        # The stream is closed by the caller
+        text.detach()
+    return result
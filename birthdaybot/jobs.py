@@ -5,22 +5,128 @@ This module contains the callable functions.
 import telegram.ext
 import datetime as dt
 import telegram
-import pytz
 import logging
-from birthdaybot.db.database import Database, Entry
+import html
+import re
+from birthdaybot.db.database import Database
 from birthdaybot.localization import localization
-from telegram.ext import JobQueue
+from birthdaybot.scheduler import RecallScheduler
+from birthdaybot.sender import RecallSender
+from birthdaybot.sharding import ShardCoordinator, get_partition
 
+# The maximum length of a message in Telegram
+MESSAGE_LIMIT = 4096
+# The line of a digest containing the name of an entry
+DIGEST_LINE = "• <b>{}</b>"
+# The number of days the records of the ledger are kept
+LEDGER_KEEP_DAYS = 30
+# The number of days the entries which weren't accepted or discarded by a user are kept
+PENDING_KEEP_DAYS = 2
 
-def recall_send_callback(context: telegram.ext.CallbackContext):
+# A tag, an entity or a text of an HTML message
+_HTML_TOKEN = re.compile(r"<(/?)([a-zA-Z]+)[^>]*>|&#?\w+;|[^<&]+|[<&]")
+
+
+def cut_html(text: str, limit: int) -> str:
     """
-    This is a callback function that will be called when a job will be handled.
-    This function send to a user the recall about his friends' birthday.
+    Function cuts the HTML text to the limit. The tags and the entities aren't split and the tags left open
+    are closed, so the cut text is still parsed by Telegram.
+
+    :param text: the HTML text
+    :param limit: the maximum length of the cut text
+    :return: the cut text
     """
-    entry = context.job.context
-    context.bot.sendMessage(chat_id=entry.chat_id,
-                            text=localization.recall_message(entry.language_code).format(entry.name),
-                            parse_mode=telegram.ParseMode.HTML)
+    if len(text) <= limit:
+        return text
+
+    parts, tags, length = [], [], 0
+    for match in _HTML_TOKEN.finditer(text):
+        token, closing, tag = match.group(0, 1, 2)
+        if tag and closing:
+            # The place of the closing tag is already reserved
+            parts.append(token)
+            length += len(token)
+            if tag in tags:
+                tags.remove(tag)
+            continue
+
+        reserved = sum(len(open_tag) + 3 for open_tag in tags)
+        required = len(token) + (len(tag) + 3 if tag else 0)
+        if length + reserved + required > limit:
+            if not tag and not token.startswith('&'):
+                parts.append(token[:limit - length - reserved])
+            break
+
+        parts.append(token)
+        length += len(token)
+        if tag:
+            tags.append(tag)
+
+    parts.extend("</{}>".format(tag) for tag in reversed(tags))
+    return ''.join(parts)
+
+
+def split_digest(template: str, lines: list, limit: int = MESSAGE_LIMIT) -> list:
+    """
+    Function renders the lines into the template of a digest. If the digest is longer than the limit,
+    the lines are split into several messages.
+
+    :param template: the template of the digest containing one field for the lines
+    :param lines: the lines of the digest
+    :param limit: the maximum length of a message
+    :return: the list of the texts of the messages
+    """
+    messages = []
+    available = limit - len(template.format(""))
+    chunk, length = [], 0
+    for line in lines:
+        # The messages are split between the lines, just a line longer than a message is cut
+        line = cut_html(line, available)
+        # Each line but the first is preceded by a line break
+        if chunk and length + 1 + len(line) > available:
+            messages.append(template.format("\n".join(chunk)))
+            chunk, length = [], 0
+        length += len(line) + (1 if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        messages.append(template.format("\n".join(chunk)))
+    return messages
+
+
+def recall_send_callback(context: telegram.ext.CallbackContext, entries: list, sender: RecallSender,
+                         coordinator: ShardCoordinator = None):
+    """
+    This is a callback function that will be called when a job of the scheduler will be handled.
+    This function passes to the sender the recalls about the friends' birthday of the users.
+    The recalls of the same chat are sent as one digest.
+
+    :param context: the context of the job
+    :param entries: the entries recalled at this time
+    :param sender: the RecallSender instance delivering the messages
+    :param coordinator: the ShardCoordinator instance, if the scheduler is sharded, just the entries of
+                        the partitions owned by this worker at the moment are sent
+    """
+    chats = {}
+    for entry in entries:
+        if coordinator is None or coordinator.owns(entry.chat_id):
+            chats.setdefault(entry.chat_id, []).append(entry)
+
+    for chat_id, chat_entries in chats.items():
+        language_code = chat_entries[0].language_code
+        due = min(entry.entry_date for entry in chat_entries).timestamp()
+
+        if len(chat_entries) == 1:
+            texts = [localization.recall_message(language_code).format(html.escape(chat_entries[0].name))]
+        else:
+            lines = [DIGEST_LINE.format(html.escape(entry.name))
+                     for entry in sorted(chat_entries, key=lambda entry: entry.name)]
+            texts = split_digest(localization.recall_digest(language_code), lines)
+
+        # The notes are recorded into the ledger when the last part of the recall is sent
+        notes = [(entry.note_id, entry.entry_date) for entry in chat_entries]
+        for number, text in enumerate(texts, 1):
+            sender.submit(chat_id=chat_id, text=text, due=due, notes=notes if number == len(texts) else None,
+                          parse_mode=telegram.ParseMode.HTML)
 
 
 def process_entries_callback(context: telegram.ext.CallbackContext):
@@ -32,99 +138,164 @@ def process_entries_callback(context: telegram.ext.CallbackContext):
 
     if isinstance(context, telegram.ext.CallbackContext):
         bot = context.job.context
-        bot.start_time = dt.datetime.now(tz=pytz.timezone('Europe/Moscow'))
-        bot.finish_time = dt.datetime.now(tz=pytz.timezone('Europe/Moscow')) + dt.timedelta(days=1)
+        # The fire times of the notes are stored in UTC, the time zones of chats are applied by the database
+        bot.start_time = dt.datetime.now(tz=dt.timezone.utc)
+        bot.finish_time = bot.start_time + dt.timedelta(days=1)
     else:
         logging.error("Not CallbackContext was passed into the 'callback_check_entries' function")
         exit(-1)
 
-    run_entries_jobs(bot.job_queue, bot.database, bot.start_time, bot.finish_time)
+    partitions = None
+    if bot.coordinator is not None:
+        partitions = (bot.coordinator.partitions, bot.coordinator.owned)
+    # The notes recalled before the catch-up period are moved to their next occurrence. They aren't notified,
+    # so they're moved before the period is scheduled
+    bot.database.roll_forward(bot.start_time - bot.catch_up_period, partitions)
+    run_entries_jobs(bot.scheduler, bot.database, bot.start_time, bot.finish_time, partitions)
+
+    bot.database.purge_ledger(bot.start_time.date() - dt.timedelta(days=LEDGER_KEEP_DAYS))
+    bot.database.purge_pending_entries(bot.start_time - dt.timedelta(days=PENDING_KEEP_DAYS))
+
+
+def catch_up_callback(context: telegram.ext.CallbackContext):
+    """
+    This is a callback function that will be called once at startup. It sends the recalls which had to be sent
+    while the bot was stopped and which weren't recorded into the ledger as sent.
+    """
+    bot = context.job.context
+
+    partitions = None
+    if bot.coordinator is not None:
+        partitions = (bot.coordinator.partitions, bot.coordinator.owned)
+    send_missed_recalls(context, bot, partitions)
+
+
+def send_missed_recalls(context: telegram.ext.CallbackContext, bot, partitions: tuple = None):
+    """
+    Function sends the recalls which had to be sent during the catch-up period before now and which weren't
+    recorded into the ledger as sent.
+
+    :param context: the context of the job
+    :param bot: the BirthdayBot instance
+    :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
+    """
+    finish_time = dt.datetime.now(tz=dt.timezone.utc)
+    start_time = finish_time - bot.catch_up_period
+
+    entries = bot.database.get_missed_entries(start_time, finish_time, partitions)
+    if entries:
+        logging.info("{} missed recalls will be sent".format(len(entries)))
+        bot.send_recalls(context, entries)
 
 
-def run_entries_jobs(job_queue: JobQueue, database: Database, start_time: dt.datetime, finish_time: dt.datetime):
+def rebalance_callback(context: telegram.ext.CallbackContext):
+    """
+    This is a callback function that will be called periodically if the scheduler is sharded.
+    It claims the partitions assigned to this worker, schedules the entries of the gained partitions and
+    removes the entries of the lost ones.
+    """
+    bot = context.job.context
+    coordinator = bot.coordinator
+
+    gained, lost = coordinator.rebalance()
+    if lost:
+        bot.scheduler.unschedule_where(lambda entry: get_partition(entry.chat_id, coordinator.partitions) in lost)
+        # The new owner checks the ledger for the recalls of these partitions which were already sent
+        bot.ledger.flush()
+    if gained:
+        # The entries of the gained partitions are scheduled till the end of the current period
+        if bot.finish_time is not None:
+            run_entries_jobs(bot.scheduler, bot.database, dt.datetime.now(tz=bot.finish_time.tzinfo),
+                             bot.finish_time, (coordinator.partitions, gained))
+        # The recalls which came due while the partitions had no owner are sent now
+        send_missed_recalls(context, bot, (coordinator.partitions, gained))
+
+
+def run_entries_jobs(scheduler: RecallScheduler, database: Database, start_time: dt.datetime,
+                     finish_time: dt.datetime, partitions: tuple = None):
     """
     Function will get entries from the database between the specific period and
     run new jobs that will call the function of recalling about events.
 
-    :param job_queue: the JobQueue instance
+    :param scheduler: the RecallScheduler instance
     :param database: the Database instance
     :param start_time: the start time of the period
     :param finish_time: the end time of the period
+    :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
     """
-    entries = database.get_entries(start_time, finish_time)
-    for entry in entries:
-        job_queue.run_once(callback=recall_send_callback,
-                           when=entry.entry_date,
-                           context=entry)
+    # The entries are scheduled while they're received from the database
+    for entry in database.iter_entries(start_time, finish_time, partitions=partitions):
+        scheduler.schedule(entry)
 
 
-def process_inserting_entry_callback(job_queue: JobQueue, database: Database, finish_time: dt.datetime):
+def resync_entries_jobs(scheduler: RecallScheduler, database: Database, finish_time: dt.datetime,
+                        partitions: tuple = None):
+    """
+    Function reloads the entries of the rest of the period from the database. The changed entries are
+    rescheduled and the entries which were deleted or moved out of the period are removed.
+
+    :param scheduler: the RecallScheduler instance
+    :param database: the Database instance
+    :param finish_time: the end time of the period
+    :param partitions: the tuple (the number of partitions, the partitions of chats) or None for all chats
+    """
+    start_time = dt.datetime.now(tz=finish_time.tzinfo)
+    actual = set()
+    for entry in database.iter_entries(start_time, finish_time, partitions=partitions):
+        actual.add(entry.note_id)
+        scheduler.schedule(entry)
+
+    # The entries which are being recalled right now are left
+    scheduler.unschedule_where(lambda entry: entry.note_id not in actual and entry.entry_date >= start_time)
+
+
+def _get_changed_entries(database: Database, finish_time: dt.datetime, changes: list) -> list:
+    """
+    Function gets from the database the changed entries that must be recalled before finish_time.
+    """
+    start_time = dt.datetime.now(tz=finish_time.tzinfo)
+    note_ids = [change.note_id for change in changes if start_time <= change.entry_date < finish_time]
+    return database.get_entries_by_ids(note_ids, start_time, finish_time)
+
+
+def process_inserting_entry_callback(scheduler: RecallScheduler, database: Database, finish_time: dt.datetime,
+                                     changes: list):
     """
     This callback function will be called, when an Insert operation will be occurred in the database.
+    Just the inserted entries are scheduled.
     """
-    jobs = job_queue.jobs()
-    entries = database.get_entries(dt.datetime.now(), finish_time)
-    for entry in entries:
-        ran = False
-        # Check that entry wasn't ran and put into the job_queue
-        for job in jobs:
-            if isinstance(job.context, Entry):
-                if job.context.chat_id == entry.chat_id and job.context.name == entry.name:
-                    ran = True
-                    break
-        if not ran:
-            job_queue.run_once(callback=recall_send_callback,
-                               when=entry.entry_date,
-                               context=entry)
+    if finish_time is None:
+        return
+
+    changes = [change for change in changes if change.note_id not in scheduler]
+    for entry in _get_changed_entries(database, finish_time, changes):
+        scheduler.schedule(entry)
 
 
-def process_updating_entry_callback(job_queue: JobQueue, database: Database, finish_time: dt.datetime):
+def process_updating_entry_callback(scheduler: RecallScheduler, database: Database, finish_time: dt.datetime,
+                                    changes: list):
     """
     This callback function will be called, when an Update operation will be occurred in the database.
+    The jobs of the updated entries are rescheduled, the entries moved out of the period are removed.
     """
-    jobs = job_queue.jobs()
-    entries = database.get_entries(dt.datetime.now(), finish_time)
-    for job in jobs:
-        if isinstance(job.context, Entry):
-            exist = False
-            for entry in entries:
-                if job.context.note_id == entry.note_id:
-                    if job.context.chat_id == entry.chat_id and job.context.name == entry.name:
-                        if job.context.entry_date == entry.entry_date:
-                            exist = True
-                            break
-                        else:
-                            job.schedule_removal()
-                            if entry.entry_date <= finish_time:
-                                job_queue.run_once(callback=recall_send_callback,
-                                                   when=entry.entry_date,
-                                                   context=entry)
-                            break
-                    else:
-                        job.schedule_removal()
-                        if entry.entry_date <= finish_time:
-                            job_queue.run_once(callback=recall_send_callback,
-                                               when=entry.entry_date,
-                                               context=entry)
-                        break
-
-            if not exist:
-                job.schedule_removal()
-
-
-def process_deleting_entry_callback(job_queue: JobQueue, database: Database, finish_time: dt.datetime):
+    if finish_time is None:
+        return
+
+    entries = _get_changed_entries(database, finish_time, changes)
+    actual = {entry.note_id for entry in entries}
+    for change in changes:
+        if change.note_id not in actual:
+            scheduler.unschedule(change.note_id)
+
+    for entry in entries:
+        scheduler.schedule(entry)
+
+
+def process_deleting_entry_callback(scheduler: RecallScheduler, database: Database, finish_time: dt.datetime,
+                                    changes: list):
     """
     This callback function will be called, when a Delete operation will be occurred in the database.
+    The jobs of the deleted entries are removed.
     """
-    jobs = job_queue.jobs()
-    entries = database.get_entries(dt.datetime.now(), finish_time)
-    for job in jobs:
-        if isinstance(job.context, Entry):
-            exist = False
-            for entry in entries:
-                if job.context.note_id == entry.note_id:
-                    if job.context.chat_id == entry.chat_id and job.context.name == entry.name:
-                        exist = True
-                        break
-            if not exist:
-                job.schedule_removal()
+    for change in changes:
+        scheduler.unschedule(change.note_id)
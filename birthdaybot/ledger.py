@@ -0,0 +1,77 @@
+"""
+This module contains the ledger of the sent recalls.
+"""
+import datetime as dt
+import logging
+import threading
+import psycopg2
+from birthdaybot.db.database import Database
+
+
+class RecallLedger:
+    """
+    The ledger collects the sent recalls and writes them into the recall_ledger table in batches,
+    every `interval` seconds or when `batch_size` records were collected.
+    """
+
+    def __init__(self, database: Database, interval: float = 5.0, batch_size: int = 500):
+        self.database = database
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._records = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts writing the records in the background"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write, name="recall_ledger", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops writing in the background and writes the rest of the records"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def record(self, notes: list):
+        """
+        Records the notes as sent now.
+
+        :param notes: the list of tuples (note_id, the datetime of the occurrence)
+        """
+        sent_at = dt.datetime.now(tz=dt.timezone.utc)
+        with self._lock:
+            self._records.extend((note_id, occurrence.astimezone(dt.timezone.utc).date(), sent_at)
+                                 for note_id, occurrence in notes)
+            full = len(self._records) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Writes the collected records into the database"""
+        with self._flush_lock:
+            with self._lock:
+                records, self._records = self._records, []
+
+            try:
+                self.database.add_ledger_records(records)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # The records are written again when the database is available
+                logging.error("The sent recalls weren't recorded into the ledger: {}".format(e))
+                with self._lock:
+                    self._records[:0] = records
+            except Exception as e:
+                # The records which can't be written are dropped, otherwise they would block all the next ones
+                logging.error("{} sent recalls were dropped from the ledger: {}".format(len(records), e))
+
+    def _write(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
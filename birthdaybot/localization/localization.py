@@ -4,6 +4,14 @@ Module for printing and processing all the information about the bot or about ac
 import codecs
 import os
 import json
+import threading
+import time
+from string import Formatter
+from types import MappingProxyType
+
+# The directory containing a subdirectory for each language pack
+LOCALIZATION_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LANGUAGE = "en"
 
 
 def _get_info(filename: str) -> str:
@@ -18,10 +26,141 @@ def _get_info(filename: str) -> str:
 
 
 def _get_menu(filename: str) -> dict:
-    with open(filename) as file:
+    with codecs.open(filename, 'r', 'utf-8') as file:
         return json.load(file)
 
 
+class Template(str):
+    """
+    A string whose `str.format` template is split into literal parts and fields once, when it's loaded.
+    Formatting with positional arguments (the only kind used by the localization files) just joins the parts,
+    any other call falls back to the usual `str.format`.
+    """
+
+    def __new__(cls, text: str):
+        template = super().__new__(cls, text)
+        template._parts = None
+
+        parts = []
+        auto_index = 0
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            # Fields with a format spec or a conversion are formatted by str.format
+            if spec or conversion or field not in ("", str(auto_index)):
+                return template
+            parts.append(auto_index)
+            auto_index += 1
+
+        template._parts = tuple(parts)
+        template._fields = auto_index
+        return template
+
+    def format(self, *args, **kwargs):
+        if self._parts is None or kwargs or len(args) < self._fields:
+            return super().format(*args, **kwargs)
+        return "".join(part if isinstance(part, str) else str(args[part]) for part in self._parts)
+
+
+class Catalog:
+    """
+    The in-memory catalog of all the language packs. Every language pack is read from the disk once and kept
+    as an immutable mapping: {language_code: {"info": {name: Template}, "menu": {name: {key: caption}}}}.
+
+    If hot_reload is set, the modification times of the files are checked at most once per reload_interval seconds
+    and the catalog is reloaded entirely if any of them was changed.
+    """
+
+    def __init__(self, directory: str, hot_reload: bool = False, reload_interval: float = 5.0):
+        self._directory = directory
+        self._hot_reload = hot_reload
+        self._reload_interval = reload_interval
+        self._lock = threading.Lock()
+
+        self._languages = MappingProxyType({})
+        self._mtime = None
+        self._checked = 0.0
+        self.reload()
+
+    def _files(self):
+        """
+        Yields tuples (language_code, kind, name, path) of all the files of the language packs.
+        """
+        for language_code in sorted(os.listdir(self._directory)):
+            language_directory = os.path.join(self._directory, language_code)
+            if not os.path.isdir(language_directory) or language_code.startswith("__"):
+                continue
+
+            for kind, extension in (("info", ".html"), ("menu", ".json")):
+                kind_directory = os.path.join(language_directory, kind)
+                if not os.path.isdir(kind_directory):
+                    continue
+                for filename in sorted(os.listdir(kind_directory)):
+                    name, file_extension = os.path.splitext(filename)
+                    if file_extension == extension:
+                        yield language_code, kind, name, os.path.join(kind_directory, filename)
+
+    def _get_mtime(self) -> float:
+        return max((os.stat(path).st_mtime for _, _, _, path in self._files()), default=0.0)
+
+    def reload(self):
+        """
+        Reads all the language packs from the disk and replaces the content of the catalog.
+        """
+        with self._lock:
+            mtime = self._get_mtime()
+
+            languages = {}
+            for language_code, kind, name, path in self._files():
+                language = languages.setdefault(language_code, {"info": {}, "menu": {}})
+                if kind == "info":
+                    language[kind][name] = Template(_get_info(path))
+                else:
+                    language[kind][name] = MappingProxyType(_get_menu(path))
+
+            self._languages = MappingProxyType({
+                code: MappingProxyType({kind: MappingProxyType(items) for kind, items in language.items()})
+                for code, language in languages.items()
+            })
+            self._mtime = mtime
+            self._checked = time.monotonic()
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if now - self._checked < self._reload_interval:
+            return
+
+        self._checked = now
+        if self._get_mtime() != self._mtime:
+            self.reload()
+
+    def _get(self, language_code: str, kind: str, name: str):
+        if self._hot_reload:
+            self._check_reload()
+
+        language = self._languages.get(language_code)
+        if language is None:
+            language = self._languages[DEFAULT_LANGUAGE]
+        return language[kind][name]
+
+    def info(self, language_code: str, name: str) -> Template:
+        return self._get(language_code, "info", name)
+
+    def menu(self, language_code: str, name: str) -> MappingProxyType:
+        return self._get(language_code, "menu", name)
+
+    @property
+    def languages(self):
+        return tuple(self._languages)
+
+
+# Language packs are loaded once, when the module is imported
+catalog = Catalog(LOCALIZATION_DIRECTORY,
+                  hot_reload=os.environ.get("BIRTHDAYBOT_LOCALIZATION_RELOAD", "") == "1")
+
+
 def get_language_code(language_code: str):
     # Define the language directory containing information in the certain language
     # TODO: Now just English and Russian are available to use
@@ -34,36 +173,60 @@ def get_language_code(language_code: str):
 
 # Localization files
 def start_info(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "start_info.html"))
+    return catalog.info(get_language_code(language_code), "start_info")
 
 
 def stop_bot_info(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "stop_bot_info.html"))
+    return catalog.info(get_language_code(language_code), "stop_bot_info")
 
 
 def main_menu(language_code: str):
-    return _get_menu(os.path.join("./localization", get_language_code(language_code), "menu", "main.json"))
+    return catalog.menu(get_language_code(language_code), "main")
 
 
 def accept_cancel_menu(language_code: str):
-    return _get_menu(os.path.join("./localization", get_language_code(language_code), "menu", "accept_cancel.json"))
+    return catalog.menu(get_language_code(language_code), "accept_cancel")
 
 
 def add_lists_info(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "add_lists_info.html"))
+    return catalog.info(get_language_code(language_code), "add_lists_info")
 
 
 def error_adding_entry(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "error_adding_entry.html"))
+    return catalog.info(get_language_code(language_code), "error_adding_entry")
 
 
 def cancel(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "cancel.html"))
+    return catalog.info(get_language_code(language_code), "cancel")
 
 
 def accept(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "accept.html"))
+    return catalog.info(get_language_code(language_code), "accept")
 
 
 def recall_message(language_code: str):
-    return _get_info(os.path.join("./localization", get_language_code(language_code), "info", "recall_message.html"))
+    return catalog.info(get_language_code(language_code), "recall_message")
+
+
+def recall_digest(language_code: str):
+    return catalog.info(get_language_code(language_code), "recall_digest")
+
+
+def import_progress(language_code: str):
+    return catalog.info(get_language_code(language_code), "import_progress")
+
+
+def import_summary(language_code: str):
+    return catalog.info(get_language_code(language_code), "import_summary")
+
+
+def import_unsupported(language_code: str):
+    return catalog.info(get_language_code(language_code), "import_unsupported")
+
+
+def pending_limit(language_code: str):
+    return catalog.info(get_language_code(language_code), "pending_limit")
+
+
+def accept_empty(language_code: str):
+    return catalog.info(get_language_code(language_code), "accept_empty")
@@ -2,6 +2,7 @@ import sys
 from birthdaybot.configurator import Configurator
 from birthdaybot.bot import BirthdayBot
 from birthdaybot.db.database import Database
+from birthdaybot.sharding import ShardCoordinator
 
 import psycopg2
 
@@ -10,13 +11,38 @@ def main():
     configurator = Configurator(sys.argv[1:])
     database = None
 
+    dbconfig = configurator.get_dbconfig()
+    dispatch_workers = configurator.get_dispatch_workers()
+    if dispatch_workers:
+        # Each worker of the dispatcher may use a connection at the same time, the rest is left for the jobs
+        pool_size = int(dbconfig.get("PG_POOL_SIZE", Database.DEFAULT_POOL_SIZE))
+        dbconfig["PG_POOL_SIZE"] = max(pool_size, dispatch_workers + Database.DEFAULT_POOL_SIZE)
+
     try:
-        database = Database(configurator.get_dbconfig())
+        database = Database(dbconfig)
     except KeyError as e:
         print("Error: Undefined parameter {}".format(e), file=sys.stderr)
         exit(-1)
+    except psycopg2.OperationalError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        exit(-2)
+
+    coordinator = None
+    if configurator.get_partitions():
+        coordinator = ShardCoordinator(database.credentials, configurator.get_partitions(),
+                                       worker_id=configurator.get_worker_id())
 
-    bot = BirthdayBot(configurator.get_token(), database)
+    bot = BirthdayBot(configurator.get_token(), database,
+                      write_interval=configurator.get_write_interval(),
+                      notify_debounce=configurator.get_notify_debounce(),
+                      coordinator=coordinator,
+                      polling=configurator.is_polling(),
+                      catch_up_period=configurator.get_catch_up_period(),
+                      webhook_url=configurator.get_webhook_url(),
+                      webhook_address=configurator.get_webhook_address(),
+                      webhook_queue_size=configurator.get_webhook_queue_size(),
+                      dispatch_workers=dispatch_workers,
+                      state_cache_size=configurator.get_state_cache_size())
     bot.run()
 
 
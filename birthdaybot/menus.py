@@ -1,6 +1,7 @@
 """
 Module to build menus for a conversation.
 """
+import threading
 from telegram.keyboardbutton import KeyboardButton
 from telegram.replykeyboardmarkup import ReplyKeyboardMarkup
 from telegram.replykeyboardremove import ReplyKeyboardRemove
@@ -14,6 +15,68 @@ STOP_BOT_BUTTON = "STOP_BOT_BUTTON"
 ACCEPT_BUTTON = "ACCEPT"
 CANCEL_BUTTON = "CANCEL"
 
+# The names of the menus
+MAIN_MENU = "main"
+ACCEPT_CANCEL_MENU = "accept_cancel"
+
+
+class SharedReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """
+    An immutable ReplyKeyboardMarkup which is built once and shared between all the messages.
+    The JSON form of the markup is serialized once, when the instance is created.
+    """
+    __slots__ = ('_json', '_frozen')
+
+    def __init__(self, keyboard, **kwargs):
+        super().__init__(keyboard, **kwargs)
+        self.keyboard = tuple(tuple(row) for row in self.keyboard)
+        self._id_attrs = (self.keyboard,)
+        self._json = super().to_json()
+        self._frozen = True
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("The shared keyboard can't be changed")
+        super().__setattr__(key, value)
+
+    def to_json(self) -> str:
+        return self._json
+
+
+class KeyboardRegistry:
+    """
+    The registry of the keyboards. Each markup is built once for a pair (menu, language) and then the same
+    instance is returned. If the localization catalog was reloaded, the markup is built again.
+    """
+
+    def __init__(self):
+        self._keyboards = {}
+        self._lock = threading.Lock()
+
+    def get(self, menu_name: str, language_code: str) -> SharedReplyKeyboardMarkup:
+        language_code = localization.get_language_code(language_code)
+        menu = localization.catalog.menu(language_code, menu_name)
+
+        keyboard = self._keyboards.get((menu_name, language_code))
+        if keyboard is not None and keyboard[0] is menu:
+            return keyboard[1]
+
+        with self._lock:
+            button_list = [KeyboardButton(menu[button]) for button in _BUTTONS[menu_name]]
+            reply_markup = SharedReplyKeyboardMarkup(build_menu(button_list, n_cols=1), resize_keyboard=True)
+            self._keyboards[(menu_name, language_code)] = (menu, reply_markup)
+        return reply_markup
+
+
+# The keys of the buttons of each menu in the order they're shown
+_BUTTONS = {
+    MAIN_MENU: [ADD_LIST_BUTTON, SETTINGS_BUTTON, EDIT_LISTS_BUTTON, STOP_BOT_BUTTON],
+    ACCEPT_CANCEL_MENU: [ACCEPT_BUTTON, CANCEL_BUTTON]
+}
+
+keyboards = KeyboardRegistry()
+_remove_keyboard = ReplyKeyboardRemove()
+
 
 def build_menu(buttons, n_cols=1, header_buttons=None, footer_buttons=None):
     """
@@ -35,37 +98,20 @@ def build_menu(buttons, n_cols=1, header_buttons=None, footer_buttons=None):
 
 def get_main_menu(language_code: str):
     """
-    Creates a KeyboardMarkup for the main menu and returns it.
+    Returns the shared KeyboardMarkup for the main menu.
     """
-
-    # The dict of the menus
-    main_menu = localization.main_menu(language_code)
-
-    button_list = [
-        KeyboardButton(main_menu[ADD_LIST_BUTTON]),
-        KeyboardButton(main_menu[SETTINGS_BUTTON]),
-        KeyboardButton(main_menu[EDIT_LISTS_BUTTON]),
-        KeyboardButton(main_menu[STOP_BOT_BUTTON])
-    ]
-
-    reply_markup = ReplyKeyboardMarkup(build_menu(button_list, n_cols=1), resize_keyboard=True)
-    return reply_markup
+    return keyboards.get(MAIN_MENU, language_code)
 
 
 def remove_keyboard():
     """
-    Creates a RemoveMarkup to remove a keyboard of the bot
+    Returns the shared RemoveMarkup to remove a keyboard of the bot
     """
-    return ReplyKeyboardRemove()
+    return _remove_keyboard
 
 
 def accept_cancel_keyboard(language_code: str):
-    accept_cancel = localization.accept_cancel_menu(language_code)
-
-    button_list = [
-        KeyboardButton(accept_cancel[ACCEPT_BUTTON]),
-        KeyboardButton(accept_cancel[CANCEL_BUTTON])
-    ]
-
-    reply_markup = ReplyKeyboardMarkup(build_menu(button_list, n_cols=1), resize_keyboard=True)
-    return reply_markup
+    """
+    Returns the shared KeyboardMarkup for the menu to accept or cancel changes.
+    """
+    return keyboards.get(ACCEPT_CANCEL_MENU, language_code)
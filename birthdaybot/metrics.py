@@ -0,0 +1,35 @@
+"""
+This module contains the simple thread-safe metrics of the bot.
+"""
+import threading
+
+
+class LatencyStats:
+    """
+    Collects the number, the average and the maximum of the measured durations (in seconds).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.last = None
+
+    def add(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.maximum = max(self.maximum, value)
+            self.last = value
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {"count": self.count,
+                    "average": self.total / self.count if self.count else 0.0,
+                    "max": self.maximum,
+                    "last": self.last}
@@ -0,0 +1,143 @@
+"""
+This module contains the parser of the lists of entries sent by users.
+
+Each line of a list looks like "Name - 12 march", "Name - 12.03" or "Name - 12/03 10:30[:15]".
+"""
+import datetime as dt
+import re
+from birthdaybot.localization import date
+
+# The reasons why a line is incorrect
+INVALID_FORMAT = 'format'
+UNKNOWN_MONTH = 'month'
+INVALID_DATE = 'date'
+
+# The minimum length of an abbreviation of a month
+MONTH_ABBREVIATION = 3
+
+_LINE = re.compile(r"(?P<name>\w[\w '’.-]*?)\s*-\s*"
+                   r"(?P<day>0?[1-9]|[12][0-9]|3[01])"
+                   r"(?:\s+(?P<month_name>[^\W\d_]{3,9})|[./](?P<month>0?[1-9]|1[0-2]))"
+                   r"(?:\s+(?P<hour>[01]?[0-9]|2[0-3]):(?P<minute>[0-5][0-9])(?::(?P<second>[0-5][0-9]))?)?")
+
+
+def _build_months(months: dict) -> dict:
+    """
+    Function builds the table of the casefolded names of the months of all languages and their unambiguous
+    abbreviations.
+
+    :param months: dictionary containing the language code and the names of the months with their numbers
+    :return: dictionary containing a casefolded name and the number of the month
+    """
+    table = {}
+    ambiguous = set()
+    for names in months.values():
+        for name, number in names.items():
+            name = name.casefold()
+            for length in range(MONTH_ABBREVIATION, len(name) + 1):
+                prefix = name[:length]
+                if table.get(prefix, number) != number:
+                    ambiguous.add(prefix)
+                table[prefix] = number
+
+    # The full names are never ambiguous
+    for names in months.values():
+        for name, number in names.items():
+            ambiguous.discard(name.casefold())
+            table[name.casefold()] = number
+    return {name: number for name, number in table.items() if name not in ambiguous}
+
+
+MONTHS = _build_months(date.MONTHS)
+
+
+class ParseError:
+    """
+    The incorrect line of a list.
+    """
+
+    def __init__(self, number: int, line: str, reason: str):
+        self.number = number
+        self.line = line
+        self.reason = reason
+
+
+class ParseResult:
+    """
+    The entries and the errors of a parsed list. An entry is a tuple containing the name, the date and
+    the time of recalling (or None).
+    """
+
+    def __init__(self):
+        self.entries = set()
+        self.errors = []
+
+
+def get_entry_date(month: int, day: int, today: dt.date) -> dt.date:
+    """
+    Function returns the date of an entry in the current year. The 29th of February is valid in any year,
+    so the last leap year is taken for it.
+
+    :raise ValueError: if the day or the month is incorrect
+    """
+    year = today.year
+    if month == 2 and day == 29:
+        while year % 4 or (year % 100 == 0 and year % 400):
+            year -= 1
+    return dt.date(year, month, day)
+
+
+def parse_line(line: str, today: dt.date):
+    """
+    Function parses one line of a list.
+
+    :param line: the stripped line
+    :param today: the current date, its year is the year of the date of an entry
+    :return: the tuple (name, date, time) or the reason why the line is incorrect
+    """
+    match = _LINE.fullmatch(line)
+    if match is None:
+        return INVALID_FORMAT
+
+    name, day, month_name, month, hour, minute, second = match.group(
+        'name', 'day', 'month_name', 'month', 'hour', 'minute', 'second')
+
+    if month_name is not None:
+        month = MONTHS.get(month_name.casefold())
+        if month is None:
+            return UNKNOWN_MONTH
+    else:
+        month = int(month)
+
+    try:
+        entry_date = get_entry_date(month, int(day), today)
+    except ValueError:
+        return INVALID_DATE
+
+    time = None
+    if hour is not None:
+        time = dt.time(int(hour), int(minute), int(second or 0))
+    return name, entry_date, time
+
+
+def parse(text: str, today: dt.date = None) -> ParseResult:
+    """
+    Function parses the list of entries, the empty lines are skipped.
+
+    :param text: the text of the list
+    :param today: the current date, it's taken once for the whole list
+    :return: ParseResult
+    """
+    today = today or dt.date.today()
+    result = ParseResult()
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        entry = parse_line(line, today)
+        if isinstance(entry, tuple):
+            result.entries.add(entry)
+        else:
+            result.errors.append(ParseError(number, line, entry))
+    return result
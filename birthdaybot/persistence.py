@@ -1,33 +1,327 @@
 """
 This method implements the inheritance from the BasePersistence class to provide the persistence of the bot.
 """
+import logging
+import threading
 from birthdaybot.db.database import Database
 from telegram.ext import BasePersistence
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import deepcopy
 
 
+class LazyDict(defaultdict):
+    """
+    The dictionary loads a value by the load function on the first access to its key and keeps just
+    `capacity` recently used values. The least recently used values are evicted and passed into
+    the on_evict function. The pinned keys (e.g. the ones whose updates are being processed) aren't evicted,
+    so the dictionary may keep more values until they're unpinned.
+
+    If there is no default_factory, the keys without a value aren't kept among the values: they're remembered
+    separately (at most `capacity` recently used ones), so they're neither loaded again nor evict the values.
+    """
+
+    def __init__(self, load, capacity: int, on_evict=None, default_factory=dict):
+        """
+        :param load: the function receiving a key and returning its value or None if there is no value
+        :param capacity: the maximum number of the kept values
+        :param on_evict: the function that will be called with the key and the value after they were evicted
+        :param default_factory: the function returning the value of a key without a value
+        """
+        super().__init__(default_factory)
+        self.capacity = capacity
+        self._load = load
+        self._on_evict = on_evict
+        self._pinned = {}
+        self._absent = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            if dict.__contains__(self, key):
+                # Move the key to the end of the order of the least recently used ones
+                value = dict.pop(self, key)
+                dict.__setitem__(self, key, value)
+                return value
+            if key in self._absent:
+                self._absent.move_to_end(key)
+                raise KeyError(key)
+        return self.__missing__(key)
+
+    def __missing__(self, key):
+        # The value is loaded without the lock, the value loaded concurrently by another thread is kept
+        value = self._load(key)
+        if value is None and self.default_factory is not None:
+            value = self.default_factory()
+
+        with self._lock:
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+            if value is None:
+                self._set_absent(key)
+                raise KeyError(key)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        evicted = []
+        with self._lock:
+            self._absent.pop(key, None)
+            dict.pop(self, key, None)
+            dict.__setitem__(self, key, value)
+            while len(self) > self.capacity:
+                old_key = next((old_key for old_key in dict.__iter__(self)
+                                if old_key != key and old_key not in self._pinned), None)
+                if old_key is None:
+                    break
+                evicted.append((old_key, dict.pop(self, old_key)))
+
+        if self._on_evict is not None:
+            for old_key, old_value in evicted:
+                self._on_evict(old_key, old_value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            dict.__delitem__(self, key)
+            if self.default_factory is None:
+                self._set_absent(key)
+
+    def _set_absent(self, key):
+        self._absent[key] = None
+        self._absent.move_to_end(key)
+        while len(self._absent) > self.capacity:
+            self._absent.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def pin(self, key):
+        """
+        Forbids evicting the key until it's unpinned, the key may be pinned several times.
+        """
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def unpin(self, key):
+        """
+        Allows evicting the key again when it's unpinned as many times as it was pinned.
+        """
+        with self._lock:
+            count = self._pinned.pop(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+
+
 class BotPersistence(BasePersistence):
     def __init__(self, database: Database,
                  store_user_data=True,
                  store_chat_data=True,
                  store_bot_data=True,
-                 on_flush=False):
+                 on_flush=False,
+                 write_interval=None,
+                 cache_size=None):
+        """
+        :param database: the Database instance
+        :param on_flush: if True, the changed data will be saved into the database just in the flush method
+        :param write_interval: if it's set, the changed data will be saved into the database in batches
+                               every write_interval seconds (and in the flush method)
+        :param cache_size: if it's set, the data of a user, a chat or a conversation is loaded from the database
+                           on the first access and just cache_size recently used ones are kept in memory,
+                           otherwise all the data is loaded at once
+        """
         super(BotPersistence, self).__init__(store_user_data=store_user_data,
                                              store_chat_data=store_chat_data,
                                              store_bot_data=store_bot_data)
         self.database = database
         self.on_flush = on_flush
+        self.write_interval = write_interval
+        self.cache_size = cache_size
+        # The data saved into the database, the changed data is compared with it
         self.user_data = None
         self.chat_data = None
         self.bot_data = None
         self.conversations = None
 
+        # The keys of the data that were changed but haven't been saved into the database yet
+        self._dirty_users = set()
+        self._dirty_chats = set()
+        self._dirty_conversations = set()
+        # The pairs (the kind of the data, the key) which are being written into the database
+        self._writing = set()
+        self._lock = threading.RLock()
+
+        self._writer_stop = threading.Event()
+        self._writer = None
+        if write_interval and not on_flush:
+            self._writer = threading.Thread(target=self._write_behind, name="persistence_writer", daemon=True)
+            self._writer.start()
+
+    @property
+    def _write_through(self) -> bool:
+        """True if the changed data must be saved into the database immediately"""
+        return not self.on_flush and not self.write_interval
+
+    def _write_behind(self):
+        """
+        Saves the changed data into the database every write_interval seconds until the flush method is called.
+        """
+        while not self._writer_stop.wait(self.write_interval):
+            try:
+                self._write_dirty()
+            except Exception as e:
+                logging.error("The changed data weren't saved into the database: {}".format(e))
+
+    def _take_dirty(self, dirty: set, kind: str) -> set:
+        """
+        Takes the changed keys which aren't being written by another thread and marks them as being written.
+        """
+        keys = {key for key in dirty if (kind, key) not in self._writing}
+        dirty -= keys
+        self._writing.update((kind, key) for key in keys)
+        return keys
+
+    def _write_dirty(self):
+        """
+        Saves only the changed users, chats and conversations into the database. The changed data is copied
+        under the lock and written without it, so the handlers of other chats aren't blocked by the database.
+        A key which is being written by another thread is left changed and written by the next pass.
+        """
+        while True:
+            with self._lock:
+                # The users and the chats refer to the conversations, so they aren't taken while another thread
+                # writes conversations, that thread takes them by its next pass
+                if any(kind == 'conversations' for kind, _ in self._writing):
+                    user_ids = chat_ids = set()
+                else:
+                    user_ids = self._take_dirty(self._dirty_users, 'users')
+                    chat_ids = self._take_dirty(self._dirty_chats, 'chats')
+                conversation_keys = self._take_dirty(self._dirty_conversations, 'conversations')
+                if not user_ids and not chat_ids and not conversation_keys:
+                    return
+
+                user_data = {user_id: deepcopy(self.user_data[user_id]) for user_id in user_ids}
+                chat_data = {chat_id: deepcopy(self.chat_data[chat_id]) for chat_id in chat_ids}
+                conversations = {}
+                for name, key in conversation_keys:
+                    conversations.setdefault(name, {})[key] = self.conversations[name][key]
+
+            # The users and the chats refer to the conversations, so the conversations are written first.
+            # The keys stay dirty until they're written, so they're written again after an error
+            written = set()
+            try:
+                if conversations:
+                    self.database.update_conversations(conversations)
+                written.add('conversations')
+                if chat_data:
+                    self.database.update_chat_data(chat_data)
+                written.add('chats')
+                if user_data:
+                    self.database.update_user_data(user_data)
+                written.add('users')
+            finally:
+                with self._lock:
+                    for kind, dirty, keys in (('conversations', self._dirty_conversations, conversation_keys),
+                                              ('chats', self._dirty_chats, chat_ids),
+                                              ('users', self._dirty_users, user_ids)):
+                        self._writing.difference_update((kind, key) for key in keys)
+                        if kind not in written:
+                            dirty.update(keys)
+
+                    # The ended conversations aren't kept, since a missing state is the same as None
+                    if 'conversations' in written:
+                        for name, key in conversation_keys:
+                            states = self.conversations[name]
+                            if (name, key) not in self._dirty_conversations and key in states and \
+                                    states[key] is None:
+                                del states[key]
+
+    def _load(self, saved: dict, table_name: str, key):
+        """
+        Loads the row of the table and remembers it as saved.
+        """
+        with self._lock:
+            # The data that was evicted but wasn't saved is newer than the row
+            if key in saved:
+                return deepcopy(saved[key])
+
+        data = self.database.get_row(table_name, key) or {}
+        with self._lock:
+            saved.setdefault(key, deepcopy(data))
+        return data
+
+    def _evict(self, save, saved: dict, key, dirty: set, kind: str, dirty_key):
+        """
+        Saves the evicted data into the database if it was changed and forgets it. The eviction is caused
+        by a handler of another chat, so an error isn't raised into it: the data stays changed and it's
+        saved by the next write.
+
+        :param save: the function updating the evicted data in the persistence
+        :param saved: the saved data containing the key
+        :param key: the evicted key
+        :param dirty: the set of the changed keys
+        :param kind: the kind of the data: 'users', 'chats' or 'conversations'
+        :param dirty_key: the key in the set of the changed keys
+        """
+        try:
+            save()
+            if dirty_key in dirty:
+                self._write_dirty()
+            with self._lock:
+                # The data written by another thread is kept until it's written, since it may fail
+                if dirty_key not in dirty and (kind, dirty_key) not in self._writing:
+                    saved.pop(key, None)
+        except Exception as e:
+            logging.error("The evicted data of {} wasn't saved into the database: {}".format(key, e))
+
+    def _evict_user(self, user_id, data):
+        self._evict(lambda: self.update_user_data(user_id, data), self.user_data, user_id,
+                    self._dirty_users, 'users', user_id)
+
+    def _evict_chat(self, chat_id, data):
+        self._evict(lambda: self.update_chat_data(chat_id, data), self.chat_data, chat_id,
+                    self._dirty_chats, 'chats', chat_id)
+
+    def _load_conversation(self, name: str, key: tuple):
+        with self._lock:
+            states = self.conversations.setdefault(name, {})
+            if key in states:
+                return states[key]
+
+        data = self.database.get_row('conversations', key[0]) or {}
+        state = data.get(name)
+        # A missing state is the same as None, so the keys without a state aren't kept
+        if state is not None:
+            with self._lock:
+                self.conversations.setdefault(name, {}).setdefault(key, state)
+        return state
+
+    def _evict_conversation(self, name: str, key: tuple, state):
+        def save():
+            if state is not None:
+                self.update_conversation(name, key, state)
+
+        self._evict(save, self.conversations.setdefault(name, {}), key, self._dirty_conversations,
+                    'conversations', (name, key))
+
+    def insert_bot(self, obj):
+        # The lazily loaded data is returned as it is, since it must not be copied
+        if isinstance(obj, LazyDict):
+            return obj
+        return super().insert_bot(obj)
+
     def get_user_data(self):
         """Returns the user_data from the pickle file if it exsists or an empty defaultdict.
         Returns:
             :obj:`defaultdict`: The restored user data.
         """
+        if self.cache_size:
+            self.user_data = {}
+            return LazyDict(lambda user_id: self._load(self.user_data, 'users', user_id), self.cache_size,
+                            self._evict_user)
+
         if self.user_data:
             pass
         else:
@@ -46,6 +340,11 @@ class BotPersistence(BasePersistence):
 
         :return: The restored chat data.
         """
+        if self.cache_size:
+            self.chat_data = {}
+            return LazyDict(lambda chat_id: self._load(self.chat_data, 'chats', chat_id), self.cache_size,
+                            self._evict_chat)
+
         if self.chat_data:
             pass
         else:
@@ -59,6 +358,12 @@ class BotPersistence(BasePersistence):
         return deepcopy(self.chat_data)
 
     def get_conversations(self, name):
+        if self.cache_size:
+            if self.conversations is None:
+                self.conversations = {}
+            return LazyDict(lambda key: self._load_conversation(name, key), self.cache_size,
+                            lambda key, state: self._evict_conversation(name, key, state), default_factory=None)
+
         if self.conversations:
             pass
         else:
@@ -76,13 +381,15 @@ class BotPersistence(BasePersistence):
         :param chat_id: The chat the data might have been changed for.
         :param data: The :attr:`telegram.ext.dispatcher.chat_data` [chat_id].
         """
-        if self.chat_data is None:
-            self.chat_data = defaultdict(dict)
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
-        if not self.on_flush:
-            self.database.update_chat_data(self.chat_data)
+        with self._lock:
+            if self.chat_data is None:
+                self.chat_data = defaultdict(dict)
+            if self.chat_data.get(chat_id) == data:
+                return
+            self.chat_data[chat_id] = data
+            self._dirty_chats.add(chat_id)
+        if self._write_through:
+            self._write_dirty()
 
     def update_user_data(self, user_id, data):
         """Will update the user_data (if changed) and depending on :attr:`on_flush` save the
@@ -92,13 +399,15 @@ class BotPersistence(BasePersistence):
             user_id (:obj:`int`): The user the data might have been changed for.
             data (:obj:`dict`): The :attr:`telegram.ext.dispatcher.user_data` [user_id].
         """
-        if self.user_data is None:
-            self.user_data = defaultdict(dict)
-        if self.user_data.get(user_id) == data:
-            return
-        self.user_data[user_id] = data
-        if not self.on_flush:
-            self.database.update_user_data(self.user_data)
+        with self._lock:
+            if self.user_data is None:
+                self.user_data = defaultdict(dict)
+            if self.user_data.get(user_id) == data:
+                return
+            self.user_data[user_id] = data
+            self._dirty_users.add(user_id)
+        if self._write_through:
+            self._write_dirty()
 
     def update_conversation(self, name: str, key: tuple, new_state: int):
         """
@@ -107,28 +416,34 @@ class BotPersistence(BasePersistence):
 
         :param name: The handlers name.
         :param key: The key the state is changed for.
-        :param new_state: The new state for the given key.
+        :param new_state: The new state for the given key or the tuple (the old state, Promise).
         """
-        # Since, this bot can't be invited into a group, it has just chat_id (as key) and will have no name
-        if self.conversations.setdefault(name, {}).get(key) == new_state:
-            return
+        # A handler run asynchronously sets the state (the old state, Promise), the old state is saved
+        # until the promise is resolved and the handler sets the new state
+        if isinstance(new_state, tuple):
+            new_state = new_state[0]
 
-        self.conversations[name][key] = new_state
+        with self._lock:
+            # Since, this bot can't be invited into a group, it has just chat_id (as key) and will have no name
+            if self.conversations.setdefault(name, {}).get(key) == new_state:
+                return
 
-        if not self.on_flush:
-            self.database.update_conversations(self.conversations)
+            self.conversations[name][key] = new_state
+            self._dirty_conversations.add((name, key))
+
+        if self._write_through:
+            self._write_dirty()
 
     def flush(self):
-        if self.user_data:
-            self.database.update_user_data(self.user_data)
-        if self.chat_data:
-            self.database.update_chat_data(self.chat_data)
-        if self.bot_data:
-            pass
-        if self.conversations:
-            self.database.update_conversations(self.conversations)
+        """
+        Saves all the changed data into the database. The database is closed by the bot, since it's used
+        after the persistence was flushed.
+        """
+        self._writer_stop.set()
+        if self._writer is not None:
+            self._writer.join()
 
-        self.database.connection.close()
+        self._write_dirty()
 
     def update_bot_data(self, data):
         pass
@@ -0,0 +1,145 @@
+"""
+This module contains the registry of the scheduled recalls.
+"""
+import datetime as dt
+import math
+import threading
+from telegram.ext import JobQueue, CallbackContext
+from birthdaybot.db.database import Entry
+
+
+class Bucket:
+    """
+    The entries that will be recalled at the same time by one job.
+    """
+
+    def __init__(self, fire_time: dt.datetime):
+        self.fire_time = fire_time
+        self.entries = {}
+        self.job = None
+
+
+class RecallScheduler:
+    """
+    The registry of the recalls scheduled in the JobQueue. The entries are grouped into buckets by the time
+    of recalling (rounded up to `resolution` seconds) and one job is scheduled for each bucket, so the number
+    of jobs depends on the number of distinct times instead of the number of entries.
+
+    The entries are indexed by the note_id and by the pair (chat_id, name), so an entry may be scheduled,
+    found or removed without iterating through the jobs or the buckets.
+    """
+
+    def __init__(self, job_queue: JobQueue, callback, resolution: int = 60):
+        """
+        :param job_queue: the JobQueue instance
+        :param callback: the function that will be called with the context and the list of entries of a bucket
+        :param resolution: the length of a bucket in seconds
+        """
+        self.job_queue = job_queue
+        self.resolution = resolution
+        self._callback = callback
+
+        self._buckets = {}
+        self._entries = {}
+        self._keys = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, note_id: int):
+        return note_id in self._entries
+
+    @property
+    def buckets(self) -> int:
+        """The number of the scheduled jobs"""
+        return len(self._buckets)
+
+    def get(self, note_id: int) -> Entry:
+        """Returns the scheduled entry of the note or None"""
+        scheduled = self._entries.get(note_id)
+        return scheduled[0] if scheduled is not None else None
+
+    def get_by_key(self, chat_id: int, name: str) -> Entry:
+        """Returns the scheduled entry with the name in the chat or None"""
+        with self._lock:
+            note_id = self._keys.get((chat_id, name))
+            return self.get(note_id) if note_id is not None else None
+
+    def _get_fire_time(self, entry_date: dt.datetime) -> dt.datetime:
+        timestamp = math.ceil(entry_date.timestamp() / self.resolution) * self.resolution
+        return dt.datetime.fromtimestamp(timestamp, tz=dt.timezone.utc)
+
+    def schedule(self, entry: Entry) -> bool:
+        """
+        Schedules the recall about the entry. If the entry has been already scheduled with other values,
+        the old one is replaced.
+
+        :param entry: the entry
+        :return: True if the entry was scheduled
+        """
+        with self._lock:
+            scheduled = self.get(entry.note_id)
+            if scheduled is not None:
+                if scheduled.chat_id == entry.chat_id and scheduled.name == entry.name and \
+                        scheduled.entry_date == entry.entry_date:
+                    return False
+                self.unschedule(entry.note_id)
+
+            fire_time = self._get_fire_time(entry.entry_date)
+            bucket = self._buckets.get(fire_time)
+            if bucket is None:
+                bucket = Bucket(fire_time)
+                bucket.job = self.job_queue.run_once(callback=self._run, when=fire_time, context=bucket)
+                self._buckets[fire_time] = bucket
+
+            bucket.entries[entry.note_id] = entry
+            self._entries[entry.note_id] = (entry, bucket)
+            self._keys[(entry.chat_id, entry.name)] = entry.note_id
+            return True
+
+    def unschedule(self, note_id: int) -> bool:
+        """
+        Removes the recall of the note. The job of the bucket is removed if the bucket becomes empty.
+
+        :param note_id: the id of the note
+        :return: True if the note was scheduled
+        """
+        with self._lock:
+            scheduled = self._entries.pop(note_id, None)
+            if scheduled is None:
+                return False
+
+            entry, bucket = scheduled
+            self._keys.pop((entry.chat_id, entry.name), None)
+            bucket.entries.pop(note_id, None)
+            if not bucket.entries and self._buckets.get(bucket.fire_time) is bucket:
+                del self._buckets[bucket.fire_time]
+                bucket.job.schedule_removal()
+            return True
+
+    def unschedule_where(self, predicate) -> int:
+        """
+        Removes the recalls of all the entries satisfying the predicate.
+
+        :param predicate: the function receiving an entry and returning True if it must be removed
+        :return: the number of the removed entries
+        """
+        with self._lock:
+            note_ids = [note_id for note_id, (entry, _) in self._entries.items() if predicate(entry)]
+            for note_id in note_ids:
+                self.unschedule(note_id)
+            return len(note_ids)
+
+    def _run(self, context: CallbackContext):
+        bucket = context.job.context
+        with self._lock:
+            if self._buckets.get(bucket.fire_time) is bucket:
+                del self._buckets[bucket.fire_time]
+            for entry in bucket.entries.values():
+                self._entries.pop(entry.note_id, None)
+                self._keys.pop((entry.chat_id, entry.name), None)
+            entries = list(bucket.entries.values())
+
+        if entries:
+            self._callback(context, entries)
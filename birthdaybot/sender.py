@@ -0,0 +1,252 @@
+"""
+This module contains the sender which delivers the recalls to the users within the limits of Telegram.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+import telegram
+from telegram.error import RetryAfter, BadRequest, Unauthorized, ChatMigrated, NetworkError, TelegramError
+from birthdaybot.metrics import LatencyStats
+
+
+class TokenBucket:
+    """
+    The token bucket limiting the number of the sent messages per second for the whole bot.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: the number of tokens added per second
+        :param capacity: the maximum number of tokens (the size of a burst)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waits until a token is available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        """
+        Stops giving the tokens during the time, it's used when Telegram asked to retry after the time.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class Message:
+    """
+    The message waiting in the queue of the sender.
+    """
+
+    def __init__(self, chat_id: int, text: str, due: float, kwargs: dict, notes: list = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.due = due
+        self.kwargs = kwargs
+        self.notes = notes
+        self.attempts = 0
+
+
+class RecallSender:
+    """
+    The sender delivers the messages by a pool of workers. The messages are ordered by their due time,
+    the rate of all messages is limited by the token bucket and the messages of one chat are sent
+    at least chat_interval seconds apart. If Telegram answers RetryAfter, the sending is paused and
+    the message is sent again later.
+    """
+    # Telegram allows about 30 messages per second for a bot and one message per second for a chat
+    RATE = 30
+    CHAT_INTERVAL = 1.0
+    WORKERS = 4
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, bot: telegram.Bot, workers: int = WORKERS, rate: float = RATE,
+                 chat_interval: float = CHAT_INTERVAL, on_sent=None):
+        """
+        :param bot: the Bot instance
+        :param workers: the number of the workers
+        :param rate: the maximum number of messages per second
+        :param chat_interval: the minimum interval between the messages of one chat
+        :param on_sent: the function that will be called with the notes of a message after it was sent
+        """
+        self.bot = bot
+        self.on_sent = on_sent
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(rate)
+
+        # The heap of the tuples (not_before, due, sequence number, message)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._chat_next = {}
+        self._threads = []
+        self._running = False
+
+        self.latency = LatencyStats()
+        self.send_time = LatencyStats()
+        self._counters_lock = threading.Lock()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        """Starts the workers"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name="recall_sender_{}".format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        """Stops the workers, the messages which weren't sent are dropped"""
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        if self._queue:
+            logging.warning("{} recalls weren't sent because the sender was stopped".format(len(self._queue)))
+
+    def submit(self, chat_id: int, text: str, due: float = None, notes: list = None, **kwargs):
+        """
+        Puts the message into the queue.
+
+        :param chat_id: the id of the chat
+        :param text: the text of the message
+        :param due: the timestamp when the message had to be sent, the earlier messages are sent first
+        :param notes: the notes recalled by the message, they're passed into on_sent after sending
+        :param kwargs: the other arguments of Bot.sendMessage
+        """
+        message = Message(chat_id, text, due if due is not None else time.time(), kwargs, notes)
+        self._put(message, 0.0)
+
+    def _put(self, message: Message, not_before: float):
+        with self._condition:
+            heapq.heappush(self._queue, (not_before, message.due, next(self._sequence), message))
+            self._condition.notify()
+
+    def _take(self) -> Message:
+        """
+        Takes the earliest message that may be sent now, taking into account the interval of its chat.
+        Returns None if the sender was stopped.
+        """
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                not_before = self._queue[0][0]
+                if not_before > now:
+                    self._condition.wait(not_before - now)
+                    continue
+
+                message = heapq.heappop(self._queue)[3]
+                chat_next = self._chat_next.get(message.chat_id, 0.0)
+                if chat_next > now:
+                    heapq.heappush(self._queue, (chat_next, message.due, next(self._sequence), message))
+                    continue
+
+                self._chat_next[message.chat_id] = now + self.chat_interval
+                if len(self._chat_next) > 10000:
+                    self._chat_next = {chat_id: moment for chat_id, moment in self._chat_next.items()
+                                       if moment > now}
+                return message
+            return None
+
+    def _count(self, counter: str):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _retry(self, message: Message, delay: float):
+        message.attempts += 1
+        if message.attempts >= self.MAX_ATTEMPTS:
+            self._count('failed')
+            logging.error("The recall to the chat {} wasn't sent after {} attempts".format(message.chat_id,
+                                                                                          message.attempts))
+            return
+
+        self._count('retried')
+        with self._condition:
+            self._chat_next[message.chat_id] = max(self._chat_next.get(message.chat_id, 0.0),
+                                                   time.monotonic() + delay)
+        self._put(message, time.monotonic() + delay)
+
+    def _work(self):
+        while True:
+            message = self._take()
+            if message is None:
+                return
+
+            self._bucket.acquire()
+            started = time.monotonic()
+            try:
+                self.bot.sendMessage(chat_id=message.chat_id, text=message.text, **message.kwargs)
+            except RetryAfter as e:
+                # The limit of Telegram was exceeded, so all the sending is paused
+                self._bucket.pause(e.retry_after)
+                self._retry(message, e.retry_after)
+            except ChatMigrated as e:
+                message.chat_id = e.new_chat_id
+                self._retry(message, 0.0)
+            except (BadRequest, Unauthorized) as e:
+                # The message can't be sent to this chat at all (e.g. the user blocked the bot)
+                self._count('failed')
+                logging.warning("The recall to the chat {} wasn't sent: {}".format(message.chat_id, e))
+            except NetworkError as e:
+                logging.warning("The recall to the chat {} wasn't sent, retrying: {}".format(message.chat_id, e))
+                self._retry(message, 2 ** message.attempts)
+            except TelegramError as e:
+                self._count('failed')
+                logging.error("The recall to the chat {} wasn't sent: {}".format(message.chat_id, e))
+            else:
+                self._count('sent')
+                self.send_time.add(time.monotonic() - started)
+                self.latency.add(max(0.0, time.time() - message.due))
+                if message.notes and self.on_sent is not None:
+                    self.on_sent(message.notes)
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns the metrics of the sender: the depth of the queue, the number of sent, retried and failed
+        messages, the latency from the due time to sending and the duration of the request to Telegram.
+        """
+        return {"queue": len(self._queue),
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "latency": self.latency.to_dict(),
+                "send_time": self.send_time.to_dict()}
@@ -0,0 +1,145 @@
+"""
+This module implements the sharding of the scheduler between several processes of the bot.
+
+The chats are divided into a fixed number of partitions by their chat_id. The partitions are assigned to
+the live workers by consistent hashing, and a worker owns a partition just while it holds the PostgreSQL
+advisory lock of this partition, so a partition is never owned by two workers at once.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import uuid
+import psycopg2
+from psycopg2 import sql
+from birthdaybot.db.db_connection import DatabaseConnection
+
+# The first key of the advisory locks of the partitions
+ADVISORY_LOCK_NAMESPACE = 0x62627462
+# The number of points of each worker on the ring
+RING_REPLICAS = 100
+
+
+def get_partition(chat_id: int, partitions: int) -> int:
+    """
+    Returns the partition of the chat, it's the same as "((chat_id % partitions) + partitions) % partitions" in SQL.
+    """
+    return chat_id % partitions
+
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+def assign_partitions(workers: list, partitions: int) -> dict:
+    """
+    Function assigns the partitions to the workers by consistent hashing, so just a small part of the partitions
+    moves to other workers when a worker joins or leaves.
+
+    :param workers: the ids of the live workers
+    :param partitions: the number of partitions
+    :return: dictionary containing the id of a worker and the set of its partitions
+    """
+    assignment = {worker: set() for worker in workers}
+    if not workers:
+        return assignment
+
+    ring = sorted((_hash("{}#{}".format(worker, replica)), worker)
+                  for worker in workers for replica in range(RING_REPLICAS))
+    keys = [key for key, _ in ring]
+    for partition in range(partitions):
+        index = bisect.bisect(keys, _hash("partition#{}".format(partition))) % len(ring)
+        assignment[ring[index][1]].add(partition)
+    return assignment
+
+
+class ShardCoordinator(DatabaseConnection):
+    """
+    The coordinator registers the worker in the scheduler_workers table, keeps its heartbeat and claims
+    the partitions assigned to it. The advisory locks belong to the own connection of the coordinator,
+    so they're released by PostgreSQL if the worker dies.
+    """
+
+    def __init__(self, json_obj, partitions: int, heartbeat: float = 10, worker_id: str = None):
+        """
+        :param json_obj: the configurations of the database
+        :param partitions: the number of partitions, it must be the same for all workers
+        :param heartbeat: the interval of the heartbeat (in seconds), a worker without a heartbeat during
+                          three intervals is considered as left
+        :param worker_id: the unique id of the worker
+        """
+        super().__init__(json_obj)
+        self.connection.autocommit = True
+
+        self.partitions = partitions
+        self.heartbeat = heartbeat
+        self.worker_id = worker_id or "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self._owned = frozenset()
+
+    @property
+    def owned(self) -> frozenset:
+        """The partitions owned by this worker"""
+        return self._owned
+
+    def owns(self, chat_id: int) -> bool:
+        """Checks that the chat belongs to a partition owned by this worker"""
+        return get_partition(chat_id, self.partitions) in self._owned
+
+    def rebalance(self) -> tuple:
+        """
+        Updates the heartbeat of the worker, drops the left workers and claims the partitions assigned to
+        this worker. The partitions which aren't assigned anymore are released.
+
+        :return: the tuple of the sets: the gained partitions and the lost partitions
+        """
+        owned = set(self._owned)
+        try:
+            with self.connection.cursor() as cur:
+                cur.execute("INSERT INTO scheduler_workers(worker_id, heartbeat) VALUES (%s, now()) "
+                            "ON CONFLICT (worker_id) DO UPDATE SET heartbeat = excluded.heartbeat;",
+                            (self.worker_id,))
+                cur.execute("DELETE FROM scheduler_workers WHERE heartbeat < now() - %s * interval '1 second';",
+                            (self.heartbeat * 3,))
+                cur.execute("SELECT worker_id FROM scheduler_workers;")
+                workers = [row[0] for row in cur.fetchall()]
+
+                assigned = assign_partitions(workers, self.partitions).get(self.worker_id, set())
+
+                for partition in owned - assigned:
+                    cur.execute("SELECT pg_advisory_unlock(%s, %s);", (ADVISORY_LOCK_NAMESPACE, partition))
+                    owned.discard(partition)
+
+                # A partition may still be locked by the previous owner, it will be claimed by the next rebalance
+                for partition in assigned - owned:
+                    cur.execute("SELECT pg_try_advisory_lock(%s, %s);", (ADVISORY_LOCK_NAMESPACE, partition))
+                    if cur.fetchone()[0]:
+                        owned.add(partition)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # The locks were released together with the session, so all the partitions are lost
+            logging.error("The connection of the shard coordinator was lost: {}".format(e))
+            owned = set()
+            self.connection = self._connect()
+            self.connection.autocommit = True
+
+        gained, lost = owned - self._owned, self._owned - owned
+        self._owned = frozenset(owned)
+        if gained or lost:
+            logging.info("The worker {} owns {} partitions (gained {}, lost {})".format(
+                self.worker_id, len(owned), len(gained), len(lost)))
+        return gained, lost
+
+    def leave(self):
+        """
+        Removes the worker from the table and releases all its partitions.
+        """
+        try:
+            with self.connection.cursor() as cur:
+                cur.execute(sql.SQL("DELETE FROM scheduler_workers WHERE worker_id = {};").format(
+                    sql.Literal(self.worker_id)))
+                cur.execute("SELECT pg_advisory_unlock_all();")
+        except psycopg2.Error as e:
+            logging.warning("The worker {} didn't leave cleanly: {}".format(self.worker_id, e))
+        finally:
+            self._owned = frozenset()
+            self.close()
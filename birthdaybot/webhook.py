@@ -0,0 +1,154 @@
+"""
+This module contains the local HTTP server receiving the updates which Telegram sends to the webhook of the bot.
+"""
+import http.server
+import json
+import logging
+import secrets
+import threading
+import telegram
+from urllib.parse import urlparse
+
+# The header containing the secret token of the webhook
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# The maximum size of an update (in bytes)
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    # Telegram keeps the connections to the webhook alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        length = int(self.headers.get('Content-Length') or 0)
+
+        if self.path != webhook.url_path or \
+                not secrets.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), webhook.secret_token):
+            status = 403
+        elif length <= 0 or length > MAX_BODY_SIZE:
+            status = 413 if length > 0 else 400
+        else:
+            status = webhook.submit(self.rfile.read(length))
+
+        if status == 413:
+            # The body wasn't read, so the connection can't be reused
+            self.close_connection = True
+
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', str(webhook.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Webhook: " + format, *args)
+
+
+class WebhookServer:
+    """
+    The server receives the updates by HTTP, parses them and puts them into the queue of the dispatcher.
+    If the dispatcher has too many pending updates, the server answers "429 Too Many Requests" and Telegram
+    sends the update again later.
+    """
+
+    def __init__(self, bot: telegram.Bot, update_queue, url: str, listen: str = '127.0.0.1', port: int = 8443,
+                 max_pending: int = 1000, max_connections: int = 40, retry_after: int = 1):
+        """
+        :param bot: the Bot instance
+        :param update_queue: the queue of the updates of the dispatcher
+        :param url: the public URL of the webhook, its path is the path of the local server
+        :param listen: the address of the local server
+        :param port: the port of the local server
+        :param max_pending: the maximum number of the updates waiting for the dispatcher
+        :param max_connections: the maximum number of the simultaneous connections of Telegram to the webhook
+        :param retry_after: the delay (in seconds) suggested to Telegram when the queue is full
+        """
+        self.bot = bot
+        self.update_queue = update_queue
+        self.url = url
+        self.url_path = urlparse(url).path or '/'
+        self.address = (listen, port)
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+        self.retry_after = retry_after
+        # A new secret token is set with the webhook at each start
+        self.secret_token = secrets.token_hex(32)
+
+        self._server = None
+        self._thread = None
+
+        # The counters of the updates
+        self._stats_lock = threading.Lock()
+        self._accepted = 0
+        self._rejected = 0
+        self._invalid = 0
+
+    def submit(self, body: bytes) -> int:
+        """
+        Parses the body of a request and puts the update into the queue.
+
+        :param body: the body of a request
+        :return: the HTTP status of the response
+        """
+        if self.update_queue.qsize() >= self.max_pending:
+            self._count('_rejected')
+            return 429
+
+        try:
+            update = telegram.Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning("Incorrect update was received by the webhook: {}".format(e))
+            self._count('_invalid')
+            return 400
+
+        self.update_queue.put(update)
+        self._count('_accepted')
+        return 200
+
+    def _count(self, counter: str):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns the counters of the updates: the accepted ones, the ones rejected because the queue was full
+        and the incorrect ones.
+        """
+        with self._stats_lock:
+            return {"accepted": self._accepted,
+                    "rejected": self._rejected,
+                    "invalid": self._invalid,
+                    "pending": self.update_queue.qsize()}
+
+    def start(self, set_webhook: bool = True):
+        """
+        Starts the server in a separate thread and sets the webhook of the bot.
+
+        :param set_webhook: if False, the webhook isn't set (it's used for local testing)
+        """
+        if self._server is not None:
+            return
+
+        self._server = http.server.ThreadingHTTPServer(self.address, _WebhookHandler)
+        self._server.daemon_threads = True
+        self._server.webhook = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook", daemon=True)
+        self._thread.start()
+        logging.info("The webhook is listening on {}:{}".format(*self._server.server_address[:2]))
+
+        if set_webhook:
+            self.bot.set_webhook(url=self.url, max_connections=self.max_connections, secret_token=self.secret_token)
+
+    def stop(self):
+        """
+        Stops the server. The webhook isn't deleted, so Telegram keeps the updates until the bot is started again.
+        """
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = self._thread = None
@@ -0,0 +1,34 @@
+"""
+Tests of the handlers of the bot working with the database.
+"""
+from types import SimpleNamespace
+from birthdaybot import handlers, menus
+from birthdaybot.bot import BirthdayBot
+from birthdaybot.localization import localization
+
+
+class FakeDatabase:
+    def __init__(self, pending: int):
+        self.pending = pending
+
+    def accept_entries(self, chat_id: int) -> int:
+        accepted, self.pending = self.pending, 0
+        return accepted
+
+
+def _accept(pending: int):
+    messages = []
+    bot = SimpleNamespace(database=FakeDatabase(pending))
+    update = SimpleNamespace(effective_user=SimpleNamespace(language_code='en'),
+                             effective_chat=SimpleNamespace(id=1),
+                             message=SimpleNamespace(text=localization.accept_cancel_menu('en')[menus.ACCEPT_BUTTON]))
+    context = SimpleNamespace(bot=SimpleNamespace(sendMessage=lambda **kwargs: messages.append(kwargs['text'])))
+    return BirthdayBot.add_lists_handler(bot, update, context), messages
+
+
+def test_accepted_entries_return_to_the_main_menu():
+    assert _accept(3) == (handlers.MAIN_MENU, [localization.accept('en')])
+
+
+def test_purged_entries_are_reported():
+    assert _accept(0) == (None, [localization.accept_empty('en')])
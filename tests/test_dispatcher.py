@@ -0,0 +1,47 @@
+"""
+Tests of the dispatcher processing the updates of different chats concurrently.
+"""
+import logging
+import threading
+import time
+import telegram
+from queue import Queue
+from telegram.ext import TypeHandler
+from birthdaybot.dispatcher import ChatDispatcher
+
+
+def _create_update(update_id: int, chat_id: int, bot: telegram.Bot) -> telegram.Update:
+    return telegram.Update.de_json({"update_id": update_id,
+                                    "message": {"message_id": update_id, "date": 0, "text": "text",
+                                                "chat": {"id": chat_id, "type": "private"}}}, bot)
+
+
+def test_stop_processes_the_received_updates_in_order(caplog):
+    bot = telegram.Bot("123456:TOKEN")
+    # The bot doesn't request its user from Telegram
+    bot._bot = telegram.User(123456, "bot", True, username="bot")
+    dispatcher = ChatDispatcher(bot, Queue(), workers=1, use_context=True, chat_workers=4)
+    processed = {}
+    lock = threading.Lock()
+
+    def handler(update, context):
+        time.sleep(0.001)
+        with lock:
+            processed.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    dispatcher.add_handler(TypeHandler(telegram.Update, handler))
+    thread = threading.Thread(target=dispatcher.start)
+    thread.start()
+    for update_id in range(300):
+        dispatcher.update_queue.put(_create_update(update_id, update_id % 3, bot))
+
+    with caplog.at_level(logging.ERROR):
+        dispatcher.stop()
+        thread.join()
+        # The updates passed after stopping are processed at once
+        dispatcher.process_update(_create_update(300, 0, bot))
+
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+    assert sum(map(len, processed.values())) == 301 - dispatcher.update_queue.qsize()
+    for updates in processed.values():
+        assert updates == sorted(updates)
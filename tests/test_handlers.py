@@ -0,0 +1,23 @@
+"""
+Tests of the handlers of the conversation.
+"""
+from birthdaybot import handlers
+from birthdaybot.jobs import MESSAGE_LIMIT
+from birthdaybot.localization import localization
+from birthdaybot.parser import ParseError, INVALID_FORMAT
+
+
+def test_errors_fit_into_a_message():
+    errors = [ParseError(number, "<" * 200, INVALID_FORMAT) for number in range(1, 1001)]
+    template = localization.error_adding_entry('en')
+    text = template.format(handlers.format_errors(errors, MESSAGE_LIMIT - len(template.format(""))))
+
+    assert len(text) <= MESSAGE_LIMIT
+    shown = text.count("&lt;" * handlers.MAX_SHOWN_LENGTH)
+    assert 0 < shown < handlers.MAX_SHOWN_ERRORS
+    assert text.endswith("… (+{})".format(len(errors) - shown))
+
+
+def test_all_errors_are_shown_if_they_fit():
+    errors = [ParseError(number, "line", INVALID_FORMAT) for number in range(1, 4)]
+    assert handlers.format_errors(errors) == "1: line\n2: line\n3: line"
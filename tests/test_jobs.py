@@ -0,0 +1,101 @@
+"""
+Tests of the callback functions of the jobs.
+"""
+import datetime as dt
+import html
+from types import SimpleNamespace
+from birthdaybot import jobs
+from birthdaybot.db.database import Entry
+from birthdaybot.sharding import get_partition
+
+PARTITIONS = 4
+
+
+class FakeDatabase:
+    def __init__(self, entries: list):
+        self.entries = entries
+
+    def _select(self, start_time, finish_time, partitions):
+        return [entry for entry in self.entries if start_time <= entry.entry_date < finish_time and
+                (partitions is None or get_partition(entry.chat_id, partitions[0]) in partitions[1])]
+
+    def get_missed_entries(self, start_time, finish_time, partitions=None):
+        return self._select(start_time, finish_time, partitions)
+
+    def iter_entries(self, start_time, finish_time, partitions=None):
+        return iter(self._select(start_time, finish_time, partitions))
+
+
+class FakeCoordinator:
+    partitions = PARTITIONS
+
+    def __init__(self, gained: set, lost: set = frozenset()):
+        self.changes = (set(gained), set(lost))
+
+    def rebalance(self):
+        return self.changes
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.entries = []
+
+    def schedule(self, entry):
+        self.entries.append(entry)
+
+    def unschedule_where(self, predicate):
+        self.entries = [entry for entry in self.entries if not predicate(entry)]
+
+
+def _create_bot(entries: list, coordinator: FakeCoordinator):
+    sent = []
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    bot = SimpleNamespace(database=FakeDatabase(entries), coordinator=coordinator, scheduler=FakeScheduler(),
+                          ledger=SimpleNamespace(flush=lambda: None), catch_up_period=dt.timedelta(days=1),
+                          finish_time=now + dt.timedelta(hours=12),
+                          send_recalls=lambda context, recalled: sent.extend(recalled))
+    return bot, sent
+
+
+def test_gained_partition_sends_the_recalls_due_during_the_handover():
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    # The first note came due after the previous owner lost the partition, the second one is in the future
+    due = Entry(1, 1, 'due', now - dt.timedelta(minutes=5), 'en')
+    future = Entry(2, 5, 'future', now + dt.timedelta(hours=1), 'en')
+    other = Entry(3, 2, 'other partition', now - dt.timedelta(minutes=5), 'en')
+
+    bot, sent = _create_bot([due, future, other], FakeCoordinator(gained={1}))
+    jobs.rebalance_callback(SimpleNamespace(job=SimpleNamespace(context=bot)))
+
+    assert sent == [due]
+    assert bot.scheduler.entries == [future]
+
+
+def test_lost_partition_is_unscheduled():
+    now = dt.datetime.now(tz=dt.timezone.utc)
+    entry = Entry(1, 1, 'name', now + dt.timedelta(hours=1), 'en')
+
+    bot, sent = _create_bot([entry], FakeCoordinator(gained=set(), lost={1}))
+    bot.scheduler.schedule(entry)
+    jobs.rebalance_callback(SimpleNamespace(job=SimpleNamespace(context=bot)))
+
+    assert sent == []
+    assert bot.scheduler.entries == []
+
+
+def test_digest_is_split_between_lines():
+    lines = [jobs.DIGEST_LINE.format(html.escape("Name & <{}>".format(number))) for number in range(1000)]
+    messages = jobs.split_digest("Today:\n{}", lines, limit=4096)
+
+    assert len(messages) > 1
+    assert all(len(message) <= 4096 for message in messages)
+    assert [line for message in messages for line in message[len("Today:\n"):].split('\n')] == lines
+
+
+def test_long_line_is_cut_outside_tags_and_entities():
+    line = jobs.DIGEST_LINE.format(html.escape("&" * 5000))
+    message, = jobs.split_digest("{}", [line], limit=4096)
+
+    assert len(message) <= 4096
+    assert message.startswith("• <b>&amp;") and message.endswith("&amp;</b>")
+    assert message.count("&amp;") == message.count("&")
@@ -0,0 +1,44 @@
+"""
+Tests of the ledger of the sent recalls.
+"""
+import datetime as dt
+import psycopg2
+from birthdaybot.ledger import RecallLedger
+
+
+class FakeDatabase:
+    def __init__(self, error=None):
+        self.error = error
+        self.records = []
+
+    def add_ledger_records(self, records: list):
+        if self.error is not None:
+            raise self.error
+        self.records.extend(records)
+
+
+def _record(ledger: RecallLedger):
+    ledger.record([(1, dt.datetime(2024, 3, 12, 12, tzinfo=dt.timezone.utc))])
+
+
+def test_records_are_kept_while_the_database_is_unavailable():
+    database = FakeDatabase(psycopg2.OperationalError("The connection was lost"))
+    ledger = RecallLedger(database)
+    _record(ledger)
+    ledger.flush()
+
+    database.error = None
+    ledger.flush()
+    assert [record[:2] for record in database.records] == [(1, dt.date(2024, 3, 12))]
+
+
+def test_rejected_records_are_dropped():
+    database = FakeDatabase(psycopg2.IntegrityError("The note was deleted"))
+    ledger = RecallLedger(database)
+    _record(ledger)
+    ledger.flush()
+
+    database.error = None
+    _record(ledger)
+    ledger.flush()
+    assert len(database.records) == 1
@@ -0,0 +1,187 @@
+"""
+Tests of the persistence saving the data of the bot into the database.
+"""
+import logging
+import threading
+import time
+from birthdaybot.persistence import BotPersistence, LazyDict
+from telegram.ext.utils.promise import Promise
+
+
+class FakeDatabase:
+    """
+    The database keeping the rows in dictionaries. The users and the chats refer to the conversations
+    like the foreign keys of the real tables.
+    """
+
+    def __init__(self):
+        self.conversations = {}
+        self.chats = {}
+        self.users = {}
+        self.failures = 0
+        self.loaded = 0
+        self.delay = 0.0
+
+    def _check(self, chat_ids):
+        time.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("The connection was lost")
+        for chat_id in chat_ids:
+            if chat_id not in self.conversations:
+                raise RuntimeError("The conversation {} doesn't exist".format(chat_id))
+
+    def get_row(self, table_name: str, key):
+        self.loaded += 1
+        row = {'conversations': self.conversations, 'chats': self.chats, 'users': self.users}[table_name].get(key)
+        return dict(row) if row is not None else None
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_conversations(self):
+        return {}
+
+    def update_conversations(self, conversations: dict):
+        self._check([])
+        for name, states in conversations.items():
+            for key, state in states.items():
+                self.conversations.setdefault(key[0], {})[name] = state
+
+    def update_chat_data(self, chat_data: dict):
+        self._check(chat_data)
+        self.chats.update(chat_data)
+
+    def update_user_data(self, user_data: dict):
+        self._check(data['chat_id'] for data in user_data.values())
+        self.users.update(user_data)
+
+
+def _wait(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_write_behind_saves_a_new_chat():
+    database = FakeDatabase()
+    persistence = BotPersistence(database, store_bot_data=False, write_interval=0.05)
+    persistence.get_conversations('main_menu_state')
+
+    persistence.update_user_data(7, {'chat_id': 1, 'username': 'user'})
+    persistence.update_chat_data(1, {'title': 'chat'})
+    persistence.update_conversation('main_menu_state', (1,), 0)
+
+    assert _wait(lambda: database.users and database.chats)
+    persistence.flush()
+    assert database.conversations == {1: {'main_menu_state': 0}}
+    assert database.chats == {1: {'title': 'chat'}}
+    assert database.users == {7: {'chat_id': 1, 'username': 'user'}}
+
+
+def test_failed_write_keeps_the_changes():
+    database = FakeDatabase()
+    persistence = BotPersistence(database, store_bot_data=False, on_flush=True)
+    persistence.get_conversations('main_menu_state')
+    persistence.update_conversation('main_menu_state', (1,), 1)
+    persistence.update_chat_data(1, {'title': 'chat'})
+
+    database.failures = 1
+    try:
+        persistence.flush()
+    except RuntimeError:
+        pass
+    assert database.chats == {}
+
+    persistence.flush()
+    assert database.conversations == {1: {'main_menu_state': 1}}
+    assert database.chats == {1: {'title': 'chat'}}
+
+
+def test_asynchronous_state_saves_the_old_state():
+    database = FakeDatabase()
+    persistence = BotPersistence(database, store_bot_data=False)
+    persistence.get_conversations('main_menu_state')
+
+    promise = Promise(lambda: 0, (), {})
+    persistence.update_conversation('main_menu_state', (1,), (1, promise))
+    assert database.conversations == {1: {'main_menu_state': 1}}
+
+    promise.run()
+    persistence.update_conversation('main_menu_state', (1,), promise.result())
+    assert database.conversations == {1: {'main_menu_state': 0}}
+
+
+def test_pinned_key_is_not_evicted():
+    evicted = []
+    data = LazyDict(lambda key: None, 1, lambda key, value: evicted.append(key))
+    data.pin(1)
+    data[1]['name'] = 'one'
+    data[2]
+    assert evicted == []
+    assert data[1] == {'name': 'one'}
+
+    data.unpin(1)
+    data[3]
+    assert evicted == [2, 1]
+
+
+def test_failed_eviction_keeps_the_changes(caplog):
+    database = FakeDatabase()
+    database.conversations = {1: {}, 2: {}}
+    persistence = BotPersistence(database, store_bot_data=False, cache_size=1)
+    chat_data = persistence.get_chat_data()
+    chat_data[1]['title'] = 'one'
+
+    database.failures = 1
+    with caplog.at_level(logging.ERROR):
+        chat_data[2]
+    assert database.chats == {}
+    assert [record for record in caplog.records if record.levelno == logging.ERROR]
+
+    # The evicted changes are loaded instead of the outdated row and saved by the next write
+    assert chat_data[1] == {'title': 'one'}
+    persistence.flush()
+    assert database.chats == {1: {'title': 'one'}}
+
+
+def test_conversation_without_state_is_loaded_once():
+    database = FakeDatabase()
+    database.conversations = {1: {'main_menu_state': 0}}
+    persistence = BotPersistence(database, store_bot_data=False, cache_size=1)
+    conversations = persistence.get_conversations('main_menu_state')
+
+    assert conversations.get((1,)) == 0
+    assert conversations.get((2,)) is None
+    assert conversations.get((2,)) is None
+    assert database.loaded == 2
+    # The key without a state doesn't evict the state of another conversation
+    assert (1,) in conversations
+
+    conversations[(2,)] = 1
+    assert conversations.get((2,)) == 1
+    del conversations[(2,)]
+    assert conversations.get((2,)) is None
+    assert database.loaded == 2
+
+
+def test_chats_are_written_concurrently():
+    database = FakeDatabase()
+    database.conversations = {chat_id: {} for chat_id in range(4)}
+    database.delay = 0.2
+    persistence = BotPersistence(database, store_bot_data=False)
+    threads = [threading.Thread(target=persistence.update_chat_data, args=(chat_id, {'title': chat_id}))
+               for chat_id in range(4)]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # The writes would take 0.8 seconds one by one
+    assert time.monotonic() - started < 0.6
+    assert database.chats == {chat_id: {'title': chat_id} for chat_id in range(4)}